@@ -2,30 +2,60 @@ import matplotlib.pyplot as plt
 from collections import deque
 import datetime
 import time
+import os
 import matplotlib.dates as mdates
+import numpy as np
+import Ringbuffer
+import Downsample
 
 
 class Plotobject():
     _plotframe = int(24*60*60/30)                            # saves every minute for 1 hour(s) (plot time frame for long time plot)
     _short_t = int(3*60*60/30)                               # plot time frame for short time plot
     _cycle_t = int(1.25*60/0.25)                               # plot one cycle
-    _data_deque = deque(maxlen=_plotframe)                    # holding measurement data
-    _time_deque = deque(maxlen=_plotframe)                    # holding time data
-    _cycle_data_deque = deque(maxlen=_cycle_t)
-    _cycle_time_deque = deque(maxlen=_cycle_t)
     _fig1, _ax1 = plt.subplots(2, 1)                          # long time plot figure, _ax1 array of axis
     _fig2, _ax2 = plt.subplots(2, 1)                          # short time plot figure
     _fig3, _ax3 = plt.subplots(1, 1)                          # cycle plot figure
 #    _figtext = _ax2[2].text(0.05, 0.05, " ", verticalalignment='bottom', transform=_ax1[2].transAxes) # figure text to indicate whether beam alignment measurement is on/off
+    _style = ['b-', 'r-', 'g-', 'c-', 'm-',  'y-', 'k-', 'b-.', 'r-.', 'g-.', 'c-.', 'm-.', 'y-.', 'k-.']
+    _downsample = 'minmax'                                    # reduce long windows to ~2 points per pixel column ('minmax', 'lttb' or None)
+    _xmargin = 0.05                                           # headroom of the time axes (fraction of the span), so that they move only now and then
     
-    def __init__(self):
-        print("The figure layout will normalise after two measurements have been received. The use of \
+    # headless:        type: bool, render to image files in image_path (Agg backend) instead of on screen
+    # image_path:      directory of the image files
+    # image_formats:   type: list of file extensions, e.g. ['png', 'svg']
+    # plotframe:       rows of the long time plot (default: _plotframe)
+    # cycle_t:         rows of the cycle plot (default: _cycle_t)
+    def __init__(self, headless=False, image_path="./", image_formats=('png',), plotframe=None, cycle_t=None):
+        self.headless = headless
+        if plotframe is not None:
+            self._plotframe = plotframe
+        if cycle_t is not None:
+            self._cycle_t = cycle_t
+        self.image_path = image_path
+        self.image_formats = list(image_formats)
+        if not headless:
+            print("The figure layout will normalise after two measurements have been received. The use of \
 matplotlib.pyplot.pause() will cause the warning 'MatplotlibDeprecationWarning: Using default event loop \
 until function specific to this GUI is implemented'. It seems there is no need for concern. For a discussion \
 confer https://github.com/matplotlib/matplotlib/pull/8185/commits/872675ce6d015b80e809c36aad60d4a52004d0a8 ;\
 https://github.com/matplotlib/matplotlib/pull/8185")
-        plt.ion()                                             # switch to interactive mode to be able to go back and forth between class and script calling class
-        plt.show()                                            # display figure
+            plt.ion()                                         # switch to interactive mode to be able to go back and forth between class and script calling class
+            plt.show()                                        # display figure
+        elif not os.path.isdir(image_path):
+            os.makedirs(image_path)
+        self._slow = None                                     # ring buffer holding time (date numbers) and measurement data, see Ringbuffer.py
+        self._cycle = None                                    # ring buffer holding the fast data of one cycle
+        self._lines = None                                    # Line2D artists, created once by setup_artists()
+        self._figs = [self._fig1, self._fig2, self._fig3]
+        self._blit = not headless and all([getattr(fig.canvas, 'supports_blit', False) for fig in self._figs])
+        self._background = {}                                 # saved figure backgrounds for blitting
+        for fig in self._figs:                                # a resized window needs new backgrounds
+            fig.canvas.mpl_connect('resize_event', lambda event: self._background.clear())
+        self.render_times = deque(maxlen=100)                 # duration of the last refreshes in s
+        self._saved = {}                                      # data version of the last image of each figure
+        self._reduced = Downsample.DownsampleCache(self._downsample) if self._downsample else None
+        self.images = {}                                      # image files of each figure
 
     # Funtion to clear the figures. Needed to remove old points from plot.
     def clear_fig(self):
@@ -43,109 +73,210 @@ https://github.com/matplotlib/matplotlib/pull/8185")
                 print("Data contains non-matching number of columns")  # code requires temp/hum pairs
         return [nb_voltval, nb_temphumpair]
 
-    # Function to produce plotable data from deque.
+    # Function to append rows to a ring buffer, which is (re)created with the width of the rows.
+    # buffer:          Ringbuffer.RingBuffer or None
+    # new_datetime:    type: list of datetime objects
+    # new_data:        type: list of lists (or array), one row per time
+    def append_rows(self, buffer, capacity, new_datetime, new_data):
+        if len(new_datetime) == 0:
+            return buffer
+        data = np.asarray(new_data, dtype=float).reshape(len(new_datetime), -1)
+        if buffer is None or buffer.nchannels != data.shape[1]:
+            buffer = Ringbuffer.RingBuffer(capacity, data.shape[1])
+        buffer.extend(mdates.date2num(new_datetime), data)
+        return buffer
+
+    # Function returning the last n rows (default: all) of a ring buffer as (times, data) views.
+    def window(self, buffer, n=None):
+        if buffer is None:
+            return np.zeros(0), np.zeros((0, 0))
+        return buffer.view(n)
+
+    # Function to produce plotable data: column views of the ring buffer, no copies.
     # valtype_nbs:    type: list, elements: 0 = number of voltage values, 1 number of temp/hum value pairs
-    def extract_data(self, valtype_nbs):
-        value_list, volt_list = [[], []], []                  # default one column for temperature, humidity, voltage. latter for now seperated
-        ############ set-up list sizes with sublist per 'device' ################
-        for voltval in range(valtype_nbs[0]):
-            volt_list.append([])
-        for columns in value_list:
-            for nb in range(valtype_nbs[1]):                  # add a sublist for each device
-                columns.append([])
-        ############ Sort data from deque into respective list ##################
-        for measurement in self._data_deque:                  # single measurement data
-            colcount = 0
-            for column in value_list:
-                subcolcount = 0                               # use col- and subcolcount to match value in measurement
-                for subcol in column:
-                    subcol.append(measurement[colcount+2*subcolcount+valtype_nbs[0]])
-                    subcolcount +=1                           # every second column has the same data type
-                colcount += 1
-            voltcount = 0
-            for voltcol in volt_list:                         # append leading voltage values
-                voltcol.append(measurement[voltcount])
-                voltcount += 1
+    # data:           type: array, rows x columns (default: all slow data)
+    def extract_data(self, valtype_nbs, data=None):
+        if data is None:
+            data = self.window(self._slow)[1]
+        if data.shape[0] == 0:
+            data = np.zeros((0, valtype_nbs[0]+2*valtype_nbs[1]))
+        first = valtype_nbs[0]                                # leading voltage values, then alternating humidity and temperature
+        value_list = [[data[:, first+2*nb] for nb in range(valtype_nbs[1])],
+                      [data[:, first+2*nb+1] for nb in range(valtype_nbs[1])]]
+        volt_list = [data[:, nb] for nb in range(valtype_nbs[0])]
         value_list.append(volt_list)                          # merge data sets
-        return value_list                                     # value list does not need to stored longer than an add_plot_data function call
+        return value_list
 
     def timelists(self):
-        time_list_short = []
-        if len(self._time_deque) > self._short_t:
-            for i in range(self._short_t, 0, -1):
-                time_list_short.append(self._time_deque[-i])
-        else:
-            for i in range(len(self._time_deque), 0, -1):
-                time_list_short.append(self._time_deque[-i])
-        return time_list_short
+        return self.window(self._slow, self._short_t)[0]
 
-    # Function that contains the actual plot commands as well as the figure adaptations.
+    # Function that creates the lines, labels, legends, limits and date formatters once. Later refreshes only
+    # update the data of the lines.
     # valtype_nbs:    type: list, elements: 0 = number of voltage values, 1 number of temp/hum value pairs
-    # new_date:       type: time.localtime objec
-    # trigger:        type: string, 0: measurement off - baseline voltage, 1: measurement on
-    def plot_data(self, valtype_nbs, new_date, received_trigger): 
-        plottable_data = self.extract_data(valtype_nbs)       # deque data is not readily plotable. Produce list
-        style = ['b-', 'r-', 'g-', 'c-', 'm-',  'y-', 'k-', 'b-.', 'r-.', 'g-.', 'c-.', 'm-.', 'y-.', 'k-.']
-        style2 = ['b-.', 'r-.', 'g-.', 'c-.', 'm-.', 'y-.', 'k-.']
-        time_list_short = self.timelists()                           # time data for short time plots
-        ### plotting humidity data ###
+    def setup_artists(self, valtype_nbs):
+        self.clear_fig()
+        style = self._style
+        self._lines = {'hum_long':[], 'hum_short':[], 'temp_long':[], 'temp_short':[], 'volt':[]}
+        self._legends = {}                                    # legends are copied back on top of the (blitted) lines
+        ### humidity ###
         self._ax1[0].set_ylabel("Humidity in %")
         self._ax2[0].set_ylabel("Humidity in %")
-        #self._ax3[0].set_ylabel("Humidity in %")
         self._ax1[0].set_ylim([30,50])
         self._ax2[0].set_ylim([30,50])
-        device_nb = 0                                         # used to match label and plotstyle for temperature and humidity of same device
-        for subcol in plottable_data[0]:
-            self._ax1[0].plot(self._time_deque, subcol, style[device_nb], label='Humidity{}'.format(device_nb+1))
-            self._ax2[0].plot(time_list_short, subcol[-self._short_t:], style[device_nb], label='Humidity{}'.format(device_nb+1))
-        #    if received_trigger:
-        #        self._ax3[0].plot(time_list_cycle, subcol[-self._cycle_t:], style[device_nb], label='Humidity{}'.format(device_nb+1))
-            device_nb += 1
-        self._ax1[0].legend(loc='upper left', fontsize = 'x-small', labels=('Above office','Test table east','Test table west','Test table centre','Experiment table','Laser table'))
-        ### plotting temperature data ####
+        for device_nb in range(valtype_nbs[1]):
+            line, = self._ax1[0].plot([], [], style[device_nb], label='Humidity{}'.format(device_nb+1), animated=self._blit)
+            self._lines['hum_long'].append(line)
+            line, = self._ax2[0].plot([], [], style[device_nb], label='Humidity{}'.format(device_nb+1), animated=self._blit)
+            self._lines['hum_short'].append(line)
+        self._legends[self._fig1] = self._ax1[0].legend(self._lines['hum_long'], ('Above office','Test table east','Test table west','Test table centre','Experiment table','Laser table')[:valtype_nbs[1]],
+                            loc='upper left', fontsize = 'x-small')
+        ### temperature ###
         self._ax1[1].set_ylabel("Temperature in Deg C")
         self._ax2[1].set_ylabel("Temperature in Deg C")
-        #self._ax3[1].set_ylabel("Temperature in Deg C")
         self._ax1[1].set_ylim([21.0,25.0])
         self._ax2[1].set_ylim([21.0,25.0])
-        device_nb = 0                                         # used to match label and plotstyle for temperature and humidity of same device
-        for subbcol in plottable_data[1]:
-            self._ax1[1].plot(self._time_deque, subbcol, style[device_nb], label='Temperature{}'.format(device_nb+1))
-            self._ax2[1].plot(time_list_short, subbcol[-self._short_t:], style[device_nb], label='Temperature{}'.format(device_nb+1))
-        #    if received_trigger:
-        #        self._ax3[1].plot(time_list_cycle, subbcol[-self._cycle_t:], style[device_nb], label='Temperature{}'.format(device_nb+1))
-            device_nb += 1
-        #self._ax3[1].legend(loc='upper left', fontsize = 'x-small')
-        ### plotting voltage data ###
-        #self._ax1[2].set_ylabel("$V_{ADC}$ in V")
-        #self._ax2[2].set_ylabel("$V_{ADC}$ in V")
+        for device_nb in range(valtype_nbs[1]):
+            line, = self._ax1[1].plot([], [], style[device_nb], label='Temperature{}'.format(device_nb+1), animated=self._blit)
+            self._lines['temp_long'].append(line)
+            line, = self._ax2[1].plot([], [], style[device_nb], label='Temperature{}'.format(device_nb+1), animated=self._blit)
+            self._lines['temp_short'].append(line)
+        ### voltage (cycle plot) ###
         self._ax3.set_ylabel("$V_{ADC}$ in V")
-        device_nb = 0                                         # used to match label and plotstyle for temperature and humidity of same device
-        for subbcol in range(0,12):
-        #    self._ax1[2].plot(self._time_deque, subbcol, style[device_nb], label='Voltage{}'.format(device_nb+1))
-        #    self._ax2[2].plot(time_list_short, subbcol[-self._short_t:], style[device_nb], label='Voltage{}'.format(device_nb+1))
-            if received_trigger:
-                data = [self._cycle_data_deque[row][subbcol] for row in range(0,len(self._cycle_time_deque))]
-                self._ax3.plot(self._cycle_time_deque, data, style[device_nb], label='Voltage{}'.format(device_nb+1))
-            device_nb += 1
-        self._ax3.legend(loc='upper left', fontsize = 'x-small')
-        #_figtext.remove()
-##        if trigger == "0":
-##            self._figtext = self._ax2[2].text(0.05, 0.05, "off", verticalalignment='bottom', transform=self._ax1[2].transAxes)
-##        else:
-##            self._figtext = self._ax2[2].text(0.05, 0.05, "on", verticalalignment='bottom', transform=self._ax1[2].transAxes)
-        ### Formatting time axis ticks and set date as title ###
+        for device_nb in range(0,12):
+            line, = self._ax3.plot([], [], style[device_nb], label='Voltage{}'.format(device_nb+1), animated=self._blit)
+            self._lines['volt'].append(line)
+        self._legends[self._fig3] = self._ax3.legend(loc='upper left', fontsize = 'x-small')
+        ### Formatting time axis ticks ###
+        for ax in list(self._ax1) + list(self._ax2) + [self._ax3]:
+            ax.xaxis.set_major_locator(mdates.AutoDateLocator())  # the lines get times as date numbers
+            ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
+            ax.xaxis.set_tick_params(rotation = 0)
+        self._background.clear()
+
+    # Function to reduce a window to about two points per pixel column of its axis (see Downsample.py). The
+    # result is cached and recomputed only when new data arrived or the axis was resized.
+    # name:           window name, e.g. 'long'
+    # version:        data version of the window (e.g. number of rows received)
+    # times, data:    type: arrays, rows and rows x columns
+    # Returns times and data of shape rows x columns.
+    def reduce(self, name, version, times, data, ax):
+        if self._reduced is None:
+            return Downsample._passthrough(times, data)
+        n_out = 2*int(ax.bbox.width)
+        return self._reduced.get(name, version, times, data, n_out)
+
+    # Function to move a time axis only when the data leaves it. Returns True if the limits changed.
+    # ax:             axis to adapt
+    # times:          type: array of date numbers (mdates.date2num), sorted
+    def update_xlim(self, ax, times):
+        if len(times) == 0:
+            return False
+        t0, t1 = times[0], times[-1]
+        lo, hi = ax.get_xlim()
+        margin = max(self._xmargin*(t1-t0), 1.0/86400)
+        if lo <= t0 and t0-lo <= 2*margin and t1 <= hi:
+            return False
+        ax.set_xlim(t0, t1+margin)
+        return True
+
+    # Function to draw a figure. With blitting, only the lines are drawn onto the saved background, unless the
+    # axes changed ('full').
+    def render(self, fig, lines, full):
+        canvas = fig.canvas
+        if not self._blit:
+            canvas.draw_idle()
+            return
+        if full or fig not in self._background:
+            canvas.draw()                                     # axes, ticks, labels, legends (without the animated lines)
+            legend = self._legends.get(fig)
+            self._background[fig] = (canvas.copy_from_bbox(fig.bbox),
+                                     canvas.copy_from_bbox(legend.get_window_extent()) if legend else None)
+        else:
+            canvas.restore_region(self._background[fig][0])
+        for line in lines:
+            line.axes.draw_artist(line)
+        if self._background[fig][1] is not None:
+            canvas.restore_region(self._background[fig][1])  # legend pixels on top; drawing its text each time is slow
+        canvas.blit(fig.bbox)
+
+    # Function to write a figure to image files. The files are written under a temporary name and renamed, so
+    # readers on the share never see a partial image. Nothing is rendered if the data did not change.
+    # name:           type: string, figure name in the file name, e.g. 'Long' > Plot_Long.png
+    # version:        data version of the figure (e.g. number of rows received)
+    def save_figure(self, fig, name, version):
+        if self._saved.get(name) == version:
+            return False
+        files = []
+        for fmt in self.image_formats:
+            filename = os.path.join(self.image_path, "Plot_{}.{}".format(name, fmt))
+            fig.savefig(filename + ".tmp", format=fmt)
+            os.replace(filename + ".tmp", filename)
+            files.append(filename)
+        self._saved[name] = version
+        self.images[name] = files
+        return True
+
+    # Function that updates the data of the lines and redraws the figures.
+    # valtype_nbs:    type: list, elements: 0 = number of voltage values, 1 number of temp/hum value pairs
+    # new_date:       type: time.localtime objec
+    # trigger:        type: string, 0: measurement off - baseline voltage, 1: measurement on
+    def plot_data(self, valtype_nbs, new_date, received_trigger): 
+        start = time.perf_counter()
+        if self._lines is None or len(self._lines['hum_long']) != valtype_nbs[1]:
+            self.setup_artists(valtype_nbs)
+        time_list_long, data_long = self.window(self._slow)   # views of the ring buffer
+        time_list_short, data_short = self.window(self._slow, self._short_t)  # time data for short time plots
+        slow_version = self._slow.count if self._slow else 0
+        for key, ax, times, data in (('_long', self._ax1[0], time_list_long, data_long),
+                                     ('_short', self._ax2[0], time_list_short, data_short)):
+            times, data = self.reduce(key, slow_version, times, data, ax)
+            plottable_data = self.extract_data(valtype_nbs, data)
+            plottable_times = self.extract_data(valtype_nbs, times)  # every column keeps its own points
+            for n, column in enumerate(('hum', 'temp')):
+                for device_nb in range(len(plottable_data[n])):
+                    self._lines[column+key][device_nb].set_data(plottable_times[n][device_nb], plottable_data[n][device_nb])
+        full1 = False
+        full2 = False
         for ax in range(len(self._ax1)):
-            self._ax1[ax].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-            self._ax2[ax].xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-            self._ax1[ax].xaxis.set_tick_params(rotation = 0)
-            self._ax2[ax].xaxis.set_tick_params(rotation = 0)
-        self._ax3.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M:%S'))
-        self._ax3.xaxis.set_tick_params(rotation = 0)
-##        self._fig1.suptitle("{1:02}-{0:02}-{2:04}".format(new_date.tm_mday, new_date.tm_mon, new_date.tm_year))
-##        self._fig2.suptitle("{1:02}-{0:02}-{2:04}".format(new_date.tm_mday, new_date.tm_mon, new_date.tm_year))
-##        self._fig3.suptitle("{1:02}-{0:02}-{2:04}".format(new_date.tm_mday, new_date.tm_mon, new_date.tm_year))
-        plt.pause(0.000000001)                               # figure should be updated after plt commands. plt.show()/plt.draw() do not work, plt.pause() does
+            full1 = self.update_xlim(self._ax1[ax], time_list_long) or full1
+            full2 = self.update_xlim(self._ax2[ax], time_list_short) or full2
+        full3 = False
+        if received_trigger:                                  # the cycle plot keeps showing the last triggered cycle
+            cycle_times, cycle_data = self.window(self._cycle)
+            cycle_times, cycle_data = self.reduce('cycle', self._cycle.count if self._cycle else 0, cycle_times, cycle_data, self._ax3)
+            for device_nb in range(len(self._lines['volt'])):
+                if device_nb < cycle_data.shape[1]:
+                    self._lines['volt'][device_nb].set_data(cycle_times[:,device_nb], cycle_data[:,device_nb])
+                else:
+                    self._lines['volt'][device_nb].set_data([], [])
+            self._ax3.relim()
+            self._ax3.autoscale_view()
+            full3 = True
+        if self.headless:
+            self.save_figure(self._fig1, 'Long', slow_version)
+            self.save_figure(self._fig2, 'Short', slow_version)
+            if received_trigger:
+                self.save_figure(self._fig3, 'Cycle', self._cycle.count if self._cycle else 0)
+        else:
+            self.render(self._fig1, self._lines['hum_long'] + self._lines['temp_long'], full1)
+            self.render(self._fig2, self._lines['hum_short'] + self._lines['temp_short'], full2)
+            self.render(self._fig3, self._lines['volt'], full3)
+            for fig in self._figs:
+                fig.canvas.flush_events()                     # process GUI events (replaces plt.pause(), which redraws everything)
+        self.render_times.append(time.perf_counter() - start)
+
+    # Function to process GUI events (e.g. window moves) between refreshes.
+    def process_events(self):
+        if not self.headless:
+            for fig in self._figs:
+                fig.canvas.flush_events()
+
+    # Function returning statistics of the render times in ms (last, mean, max of the last refreshes).
+    def render_stats(self):
+        if len(self.render_times) == 0:
+            return {}
+        times = np.array(self.render_times)*1000
+        return {'last':times[-1], 'mean':float(np.mean(times)), 'max':float(np.max(times)), 'count':len(times)}
     
     # Main function of class.
     # new_datetime:    type: list of datetime objects
@@ -153,13 +284,27 @@ https://github.com/matplotlib/matplotlib/pull/8185")
     # trigger:         type: list of strings, 0: measurement off - baseline voltage, 1: measurement on
     def add_plot_data(self, received_trigger, new_datetime_fast, new_data_fast, triggers_fast,
                       new_datetime_slow, new_data_slow, triggers_slow):
-        self.clear_fig()
-        self._data_deque.extend(new_data_slow) # saves data to deque for efficient storage of limited number of measurements
-        self._time_deque.extend(new_datetime_slow)
-        if(received_trigger):
-            self._cycle_data_deque.extend(new_data_fast)
-            self._cycle_time_deque.extend(new_datetime_fast)
+        self._slow = self.append_rows(self._slow, self._plotframe, new_datetime_slow, new_data_slow)
+        # the fast data arrives incrementally, so keep all of it; the cycle is
+        # only plotted when triggered
+        self._cycle = self.append_rows(self._cycle, self._cycle_t, new_datetime_fast, new_data_fast)
         #valtype_nbs = self.find_valtype(new_data_slow[0][:])# find the numbers for value types 
         valtype_nbs = [0, 6]
         self.plot_data(valtype_nbs, time.localtime(), received_trigger)
-        
+
+    # Function to plot a snapshot of the data windows, e.g. handed over from another process (see Plotter.py).
+    # Only the rows that are new since the last snapshot are appended to the ring buffers.
+    # received_trigger:  type: bool, a cycle was triggered since the last snapshot
+    # slow, fast:        type: tuples (times as date numbers, rows x columns array, number of rows received in total)
+    def show_snapshot(self, received_trigger, slow, fast):
+        for attr, capacity, (times, data, count) in (('_slow', self._plotframe, slow), ('_cycle', self._cycle_t, fast)):
+            buffer = getattr(self, attr)
+            if len(times) == 0:
+                continue
+            if buffer is None or buffer.nchannels != data.shape[1]:
+                buffer = Ringbuffer.RingBuffer(capacity, data.shape[1])
+                setattr(self, attr, buffer)
+            if not buffer.sync(times, data, count) and self._reduced is not None:
+                self._reduced.clear()                         # row numbers changed, the cached buckets do not fit
+        valtype_nbs = [0, 6]
+        self.plot_data(valtype_nbs, time.localtime(), received_trigger)
@@ -0,0 +1,393 @@
+# Benchmarks of the acquisition and plotting paths
+#
+#   Runs on a simulated i2c bus (SimBus), so the results do not depend on
+#   the sensors that happen to be connected, and saves them as JSON:
+#   - devices:   transactions, bytes and wall time per get() of each py2C
+#                device class
+#   - sweep:     one DataLogger sweep over 6 ... 64 HIH sensors behind
+#                TCA9548A switches (eight sensors per switch)
+#   - averaging: averaging, line formatting and binary packing throughput
+#   - parsing:   reading a synthetic day of log lines (Logreader and the
+#                History store used by the Plotter, cold and warm)
+#   - plotting:  Plotobject refresh time (Agg backend)
+#   Wall times measure the Python side only; the time the bytes would take
+#   on a real bus is modelled from the byte counts ('bus_*', 9 clock cycles
+#   per byte at 'clock' Hz) and reported separately, as are the pauses
+#   between devices that the DataLogger adds.
+#
+#   Off the Pi, the hardware modules the drivers import are simulated too
+#   (smbus by a SimBus, RPi.GPIO by an empty module).
+#
+#   Wall times are the best of REPEAT runs. Run and compare with an earlier
+#   run:
+#       python3 Benchmark.py --output bench_new.json --compare bench_old.json
+#
+import Binlog
+import numpy as np
+import argparse
+import datetime
+import platform
+import subprocess
+import tempfile
+import random
+import shutil
+import types
+import json
+import time
+import sys
+import os
+
+# device classes measured by default, with the settings used in the lab
+DEVICES = [\
+    ('ADS1115',{'cycle':[0b100,0b101,0b110,0b111]}),\
+    ('ADS1015',{'cycle':[0b100,0b101,0b110,0b111]}),\
+    ('ADS1114',{}),\
+    ('ADS1113',{}),\
+    ('ADS1014',{}),\
+    ('ADS1013',{}),\
+    ('HIH8121',{'cycle':[0,1]}),\
+    ('LSM9DS1_MAG',{}),\
+    ('LSM9DS1_ACC',{}),\
+    ]
+# runs per measurement, of which the fastest counts
+REPEAT = 3
+
+
+class SimBus():
+    """ Stand-in for smbus.SMBus that answers like the lab's devices and
+    counts the transactions and bytes on the bus (address byte included).
+    Registers keep what was written to them; ADC conversions are ready at
+    once; HIH sensors report about 40 % and 23 C with some noise. """
+
+    def __init__(self,clock=100e3,seed=0):
+        self.clock = clock
+        self._rng = random.Random(seed)
+        self._regs = {}
+        self._last = {}
+        self.reset()
+
+    def reset(self):
+        """ Clears the counters. """
+        self.transactions = 0
+        self.bytes = 0
+
+    @property
+    def bus_time(self):
+        """ Modelled time on the bus in s (9 clock cycles per byte). """
+        return self.bytes*9/self.clock
+
+    def _count(self,nbytes):
+        self.transactions += 1
+        self.bytes += nbytes + 1
+
+    def write_byte(self,addr,data):
+        self._count(1)
+        self._last[addr] = data
+
+    def read_byte(self,addr):
+        self._count(1)
+        return self._last.get(addr,0)
+
+    def write_i2c_block_data(self,addr,ctrl,data):
+        self._count(1+len(data))
+        self._regs[(addr,ctrl)] = list(data)
+
+    def read_i2c_block_data(self,addr,ctrl,nbytes):
+        self._count(1+nbytes)
+        if nbytes == 4 and addr == 0x27:
+            # HIH humidity/temperature: status 0, 14 bit values
+            hum = int((40+self._rng.random())/100.0*(2**14-2))
+            temp = int((23+self._rng.random()+40)/165.0*(2**14-2)) << 2
+            return [hum >> 8,hum & 0xff,temp >> 8,temp & 0xff]
+        if (addr,ctrl) in self._regs:
+            data = self._regs[(addr,ctrl)][:nbytes]
+            data += [0]*(nbytes-len(data))
+            if ctrl == 0x01 and nbytes == 2:
+                # ADS config register: conversion done
+                data[0] |= 0x80
+            return data
+        return [self._rng.randint(0,255) for i in range(0,nbytes)]
+
+
+def simulate_hardware():
+    """ Installs stand-ins for the hardware modules that cannot be
+    imported: py2C opens smbus.SMBus(1) when its classes are defined, and
+    the DataLogger imports RPi.GPIO (unused here). """
+    try:
+        import smbus
+    except ImportError:
+        smbus = types.ModuleType('smbus')
+        smbus.SMBus = lambda bus=1: SimBus()
+        sys.modules['smbus'] = smbus
+    try:
+        import RPi.GPIO
+    except ImportError:
+        rpi = types.ModuleType('RPi')
+        rpi.GPIO = types.ModuleType('RPi.GPIO')
+        sys.modules['RPi'] = rpi
+        sys.modules['RPi.GPIO'] = rpi.GPIO
+
+simulate_hardware()
+import py2C as i2c
+
+
+def _best(fn,repeat=REPEAT):
+    """ Runs 'fn' 'repeat' times and returns the shortest wall time in s. """
+    best = None
+    for i in range(0,repeat):
+        start = time.perf_counter()
+        fn()
+        dt = time.perf_counter() - start
+        best = dt if best is None else min(best,dt)
+    return best
+
+def bench_devices(n=500,clock=100e3,repeat=REPEAT):
+    """ Transactions, bytes and time per get() of each device class. """
+    calls = repeat*n
+    out = {}
+    for name,kwargs in DEVICES:
+        bus = SimBus(clock)
+        try:
+            device = getattr(i2c,name)(bus=bus,**kwargs)
+            device.get()
+            bus.reset()
+            dt = _best(lambda: [device.get() for i in range(0,n)],repeat)
+        except Exception as e:
+            out[name] = {'error':"{}: {}".format(type(e).__name__,e)}
+            continue
+        out[name] = {'transactions_per_get':bus.transactions/calls,\
+                     'bytes_per_get':bus.bytes/calls,\
+                     'wall_us_per_get':dt/n*1e6,\
+                     'bus_us_per_get':bus.bus_time/calls*1e6}
+    # a sensor behind a switch, as the HIH sensors in the lab
+    bus = SimBus(clock)
+    tca = i2c.TCA9548A(addr=0x70,bus=bus)
+    hih = i2c.HIH8121(addr=0x27,bus=bus,cycle=[0,1],\
+                      group={'me':1,'channels':[1,2],'switch':tca})
+    hih.get()
+    bus.reset()
+    dt = _best(lambda: [hih.get() for i in range(0,n)],repeat)
+    out['HIH8121 (switched)'] = {\
+        'transactions_per_get':bus.transactions/calls,\
+        'bytes_per_get':bus.bytes/calls,\
+        'wall_us_per_get':dt/n*1e6,\
+        'bus_us_per_get':bus.bus_time/calls*1e6}
+    return out
+
+def lab_sensors(count,bus):
+    """ 'count' HIH sensors on TCA9548A switches (eight per switch), each
+    listed twice (humidity and temperature), as in the lab script. """
+    devices = []
+    for s in range(0,(count+7)//8):
+        tca = i2c.TCA9548A(addr=0x70+s,bus=bus)
+        channels = list(range(0,min(8,count-8*s)))
+        for ch in channels:
+            hih = i2c.HIH8121(addr=0x27,bus=bus,cycle=[0,1],\
+                              group={'me':ch,'channels':channels,\
+                                     'switch':tca})
+            devices += [hih,hih]
+    return devices
+
+def bench_sweep(counts=(6,16,32,64),sweeps=20,device_pause=0.010,\
+                clock=100e3,repeat=REPEAT):
+    """ Time of one DataLogger sweep (get_measurements) against the number
+    of HIH sensors. The pauses between devices are not slept but added to
+    the estimate. """
+    import pyKraken_Lattice_New as pk
+    out = []
+    for count in counts:
+        bus = SimBus(clock)
+        devices = lab_sensors(count,bus)
+        log = pk.DataLogger(devices=devices,device_pause=0.0)
+        log.get_measurements()
+        bus.reset()
+        dt = _best(lambda: [log.get_measurements() \
+                            for i in range(0,sweeps)],repeat)/sweeps
+        bus_time = bus.bus_time/(repeat*sweeps)
+        pause = len(devices)*device_pause
+        out.append({'sensors':count,'reads':len(devices),\
+                    'transactions':bus.transactions/(repeat*sweeps),\
+                    'wall_ms':dt*1e3,'bus_ms':bus_time*1e3,\
+                    'pause_ms':pause*1e3,\
+                    'estimate_ms':(dt+bus_time+pause)*1e3})
+    return out
+
+def bench_averaging(window=10,nchannels=12,n=2000):
+    """ Throughput (samples/s) of averaging a window of measurements,
+    formatting a log line and packing a binary record. """
+    import pyKraken_Lattice_New as pk
+    rng = np.random.default_rng(0)
+    group = pk.DeviceGroup("",[],0.1,1.0)
+    group.data = rng.random((window,nchannels)).tolist()
+    avg = group.average()
+    now = datetime.datetime(2020,4,13,12)
+    def fmt():
+        return pk.format_timestamp(now) + "," \
+               + ",".join(["{:.4f}".format(a) for a in avg]) + ",0\n"
+    tmp = tempfile.mkdtemp()
+    try:
+        log = Binlog.BinaryLog(os.path.join(tmp,"bench.bin"),\
+                               ["ch{}".format(i) for i in range(0,nchannels)])
+        t = np.array([Binlog.datetime2ns(now)])
+        values = np.array([avg])
+        flags = np.zeros(1,dtype='u1')
+        out = {'window':window,'channels':nchannels}
+        out['average_per_s'] = n/_best(lambda: [group.average() \
+                                                for i in range(0,n)])
+        out['format_per_s'] = n/_best(lambda: [fmt() for i in range(0,n)])
+        out['pack_per_s'] = n/_best(lambda: [log.pack(t,values,flags) \
+                                             for i in range(0,n)])
+    finally:
+        shutil.rmtree(tmp)
+    return out
+
+def bench_parsing(lines=86400,nchannels=12):
+    """ Time to read a synthetic day of log lines: Logreader.read_log, and
+    the History store of the Plotter (first query parses the text and
+    writes the sidecar, later queries use the memory map). """
+    import Logreader
+    import History
+    tmp = tempfile.mkdtemp()
+    try:
+        day = datetime.datetime(2020,4,13)
+        filename = os.path.join(tmp,"Datalog_Slow_2020-04-13.txt")
+        Logreader.synthetic_day(filename,lines,nchannels,start=day)
+        out = {'lines':lines,'channels':nchannels,\
+               'bytes':os.path.getsize(filename)}
+        out['read_log_s'] = _best(lambda: Logreader.read_log(filename))
+        start = Binlog.datetime2ns(day)
+        end = Binlog.datetime2ns(day+datetime.timedelta(days=1))
+        t0 = time.perf_counter()
+        store = History.HistoryStore(tmp,filemask_bin=None)
+        times,values,flags = store.query(start,end)
+        out['history_cold_s'] = time.perf_counter() - t0
+        assert len(times) == lines,"Unexpected number of samples!"
+        out['history_warm_s'] = _best(lambda: store.query(start,end))
+        out['history_reopen_s'] = _best(lambda: History.HistoryStore(\
+            tmp,filemask_bin=None).query(start,end))
+    finally:
+        shutil.rmtree(tmp)
+    return out
+
+def bench_plotting(rows=2880,refreshes=30,nchannels=12):
+    """ Plotobject refresh time with a full day of slow data, adding one row
+    per refresh (and a triggered cycle every tenth refresh). """
+    import matplotlib
+    matplotlib.use('Agg')
+    from Autoplot_Lists import Plotobject
+    tmp = tempfile.mkdtemp()
+    try:
+        plotobj = Plotobject(headless=True,image_path=tmp)
+        rng = np.random.default_rng(0)
+        t0 = datetime.datetime(2020,4,13)
+        times = [t0 + datetime.timedelta(seconds=30*i) \
+                 for i in range(0,rows+refreshes)]
+        values = np.tile([40.0,23.0],nchannels//2) \
+                 + rng.random((rows+refreshes,nchannels))
+        fast_t = [t0 + datetime.timedelta(seconds=0.25*i) \
+                  for i in range(0,300)]
+        fast_v = rng.random((300,nchannels))
+        plotobj.add_plot_data(True,fast_t,fast_v,np.zeros(300),\
+                              times[:rows],values[:rows],np.zeros(rows))
+        dts = []
+        for k in range(rows,rows+refreshes):
+            start = time.perf_counter()
+            plotobj.add_plot_data(k % 10 == 0,fast_t,fast_v,np.zeros(300),\
+                                  times[k:k+1],values[k:k+1],np.zeros(1))
+            dts.append(time.perf_counter() - start)
+        dts = np.array(dts)*1e3
+        return {'rows':rows,'refreshes':refreshes,\
+                'refresh_median_ms':float(np.median(dts)),\
+                'refresh_max_ms':float(np.max(dts))}
+    finally:
+        shutil.rmtree(tmp)
+
+def environment():
+    """ Where and on which version the benchmarks ran. """
+    out = {'time':datetime.datetime.now().isoformat(timespec='seconds'),\
+           'python':platform.python_version(),'numpy':np.__version__,\
+           'machine':platform.machine(),'node':platform.node()}
+    try:
+        out['commit'] = subprocess.check_output(\
+            ["git","rev-parse","--short","HEAD"],\
+            cwd=os.path.dirname(os.path.abspath(__file__)),\
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError,subprocess.CalledProcessError):
+        out['commit'] = None
+    return out
+
+SUITES = ['devices','sweep','averaging','parsing','plotting']
+
+def run(suites=SUITES,quick=False,clock=100e3):
+    """ Runs the benchmarks and returns the results as a dictionary. """
+    out = {'environment':environment(),'clock':clock}
+    if 'devices' in suites:
+        out['devices'] = bench_devices(n=100 if quick else 500,clock=clock)
+    if 'sweep' in suites:
+        out['sweep'] = bench_sweep(sweeps=5 if quick else 20,clock=clock)
+    if 'averaging' in suites:
+        out['averaging'] = bench_averaging(n=500 if quick else 2000)
+    if 'parsing' in suites:
+        out['parsing'] = bench_parsing(lines=8640 if quick else 86400)
+    if 'plotting' in suites:
+        out['plotting'] = bench_plotting(refreshes=10 if quick else 30)
+    return out
+
+def _flatten(results,prefix=""):
+    """ Numeric results as {'suite/key/...': value}. """
+    out = {}
+    if isinstance(results,dict):
+        items = results.items()
+    elif isinstance(results,list):
+        items = [(str(r.get('sensors',i)),r) for i,r in enumerate(results)]
+    else:
+        return out
+    for key,value in items:
+        name = prefix + str(key)
+        if isinstance(value,(dict,list)):
+            out.update(_flatten(value,name + "/"))
+        elif isinstance(value,(int,float)) and not isinstance(value,bool):
+            out[name] = value
+    return out
+
+def compare(old,new):
+    """ Returns lines comparing the numeric results of two runs. """
+    a = _flatten(old)
+    b = _flatten(new)
+    lines = []
+    for key in b:
+        if key in a and a[key]:
+            lines.append("{:<50} {:>12.4g} {:>12.4g} {:>7.2f}x".format(\
+                key,a[key],b[key],b[key]/a[key]))
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=\
+        "Benchmarks py2C devices, DataLogger sweeps and the plotting path "\
+        "on a simulated i2c bus.")
+    parser.add_argument('--output',default=None,\
+                        help="JSON file for the results (default: "\
+                        "benchmark_<date>.json)")
+    parser.add_argument('--compare',default=None,\
+                        help="JSON file of an earlier run")
+    parser.add_argument('--suites',nargs='*',default=SUITES,choices=SUITES)
+    parser.add_argument('--quick',action='store_true',\
+                        help="fewer repetitions and a smaller day")
+    parser.add_argument('--clock',type=float,default=100e3,\
+                        help="modelled i2c clock in Hz (default: 100 kHz)")
+    args = parser.parse_args()
+    results = run(args.suites,args.quick,args.clock)
+    output = args.output
+    if output is None:
+        output = "benchmark_{:%Y-%m-%d_%H%M%S}.json".format(\
+            datetime.datetime.now())
+    with open(output,'w') as f:
+        json.dump(results,f,indent=1)
+    print(json.dumps(results,indent=1))
+    print("Results written to {}".format(output))
+    if args.compare:
+        with open(args.compare,'r') as f:
+            old = json.load(f)
+        print("{:<50} {:>12} {:>12} {:>8}".format("","old","new","ratio"))
+        print("\n".join(compare(old,results)))
@@ -0,0 +1,268 @@
+# Compact binary log format for the pyKraken data logger
+#
+#   A binary log consists of a short header, holding the channel schema
+#   (names, units, device mapping) as JSON, followed by fixed-size records
+#       (int64 timestamp in ns, float32 value per channel, uint8 flags).
+#   Timestamps are local wall-clock time counted in ns from 1970-01-01, i.e.
+#   the same (naive) convention as numpy's datetime64[ns] and the timestamps
+#   in the text logs. Files can be read with numpy.memmap without parsing.
+#
+#   Convert an existing text log with
+#       python3 Binlog.py Datalog_Slow_2020-04-13.txt [more files ...]
+#
+import numpy as np
+import datetime
+import json
+import os
+import struct
+import sys
+
+MAGIC = b"KRAKNLOG"
+VERSION = 1
+# magic, version, header length (JSON part, padded)
+_PREFIX = struct.Struct("<8sII")
+# records start at a multiple of this many bytes
+_ALIGN = 8
+
+# flag bits stored with every record
+FLAG_TRIGGERED = 0x01   # trigger was high during the averaging window
+FLAG_LEVEL = 0x02       # trigger level at the end of the window
+FLAG_EDGE = 0x04        # at least one trigger edge within the window
+FLAG_OVERRUN = 0x08     # acquisition in a sustained overrun (Loopstats.py)
+
+_EPOCH = datetime.datetime(1970,1,1)
+
+
+def record_dtype(nchannels):
+    """ Returns the (packed) numpy dtype of a single record with 'nchannels'
+    float32 channels. """
+    return np.dtype([('time','<i8'),\
+                     ('data','<f4',(nchannels,)),\
+                     ('flags','u1')])
+
+def datetime2ns(dt):
+    """ Converts a (naive) datetime object to integer ns since 1970-01-01,
+    without any time zone conversion. """
+    delta = dt - _EPOCH
+    return ((delta.days*86400 + delta.seconds)*1000000 \
+            + delta.microseconds)*1000
+
+def ns2datetime(ns):
+    """ Inverse of datetime2ns (to microsecond precision). """
+    return _EPOCH + datetime.timedelta(microseconds=int(ns)//1000)
+
+def parse_timestamp(ts):
+    """ Parses a pyKraken timestamp 'YYYY MM DD HH:MM:SS.f' to integer ns.
+    The digits after the dot are the microseconds as written by the logger
+    (an integer, not a decimal fraction). """
+    fields = ts.split()
+    hms,_,us = fields[3].partition(".")
+    hh,mm,ss = hms.split(":")
+    dt = datetime.datetime(int(fields[0]),int(fields[1]),int(fields[2]),\
+                           int(hh),int(mm),int(ss),int(us) if us else 0)
+    return datetime2ns(dt)
+
+def channel_schema(devices,names=None,units=None):
+    """ Builds the channel schema for a list of devices as used by the
+    DataLogger (one channel per entry, repeated entries cycle through the
+    device's 'cycle'). Returns a dictionary with 'channels', 'units' and
+    'devices'. Explicit 'names' and 'units' take precedence. """
+    out_names = []
+    out_units = []
+    mapping = []
+    seen = {}
+    for i,d in enumerate(devices):
+        dev_type = getattr(d,'dev_type',type(d).__name__)
+        addr = getattr(d,'addr',None)
+        cycle = getattr(d,'cycle',None)
+        # which entry of the cycle is read by this occurrence of the device
+        k = seen.get(id(d),0)
+        seen[id(d)] = k+1
+        sel = cycle[k%len(cycle)] if cycle else None
+        entry = {'index':i,'type':dev_type,'addr':addr,'cycle':sel}
+        group = getattr(d,'group',None)
+        if group:
+            entry['switch_channel'] = group['me']
+        mapping.append(entry)
+        # guess a sensible name and unit
+        base = "{}_0x{:02X}".format(dev_type,addr) if addr is not None \
+               else dev_type
+        if group:
+            base += "_ch{}".format(group['me'])
+        if dev_type.startswith('HIH'):
+            sel = getattr(d,'get_temp',0) if sel is None else sel
+            quantity,unit = [("humidity","%RH"),("temperature","degC")][sel]
+        elif dev_type.startswith('ADS'):
+            quantity = "ain" if sel is None else "mux{}".format(sel)
+            unit = "V"
+        else:
+            quantity = "ch{}".format(i)
+            unit = ""
+        out_names.append(base + "_" + quantity)
+        out_units.append(unit)
+    if names is not None:
+        assert len(names) == len(devices),"Expecting one name per channel!"
+        out_names = list(names)
+    if units is not None:
+        assert len(units) == len(devices),"Expecting one unit per channel!"
+        out_units = list(units)
+    return {'channels':out_names,'units':out_units,'devices':mapping}
+
+
+def read_header(filename):
+    """ Reads the header of a binary log. Returns the schema dictionary,
+    with the additional entries 'offset' (first byte of record data) and
+    'dtype' (numpy record type). """
+    with open(filename,'rb') as f:
+        prefix = f.read(_PREFIX.size)
+        assert len(prefix) == _PREFIX.size,\
+               "File '{}' too short for a binary log!".format(filename)
+        magic,version,hlen = _PREFIX.unpack(prefix)
+        assert magic == MAGIC,"Not a binary log: '{}'!".format(filename)
+        assert version == VERSION,\
+               "Unsupported binary log version {}!".format(version)
+        header = json.loads(f.read(hlen).decode('utf-8'))
+    header['offset'] = _PREFIX.size + hlen
+    header['dtype'] = record_dtype(len(header['channels']))
+    return header
+
+def open_binlog(filename,mode='r'):
+    """ Memory-maps the records of a binary log. Returns (header, records),
+    where records is a structured numpy.memmap with the fields 'time',
+    'data' (n x channels) and 'flags'. An incomplete trailing record (e.g.
+    while the logger is writing) is ignored. """
+    header = read_header(filename)
+    dtype = header['dtype']
+    nrec = (os.path.getsize(filename)-header['offset'])//dtype.itemsize
+    if nrec <= 0:
+        return header,np.zeros(0,dtype=dtype)
+    records = np.memmap(filename,dtype=dtype,mode=mode,\
+                        offset=header['offset'],shape=(nrec,))
+    return header,records
+
+
+class BinaryLog():
+    """ Appends fixed-size records to a binary log file. The header is
+    written when the file is created; appending to an existing file checks
+    that its schema has the same number of channels. """
+
+    def __init__(self,filename,channels,units=None,devices=None,meta=None):
+        self.filename = filename
+        self.channels = list(channels)
+        self.units = list(units) if units else [""]*len(self.channels)
+        self.devices = devices if devices else []
+        self.meta = meta if meta else {}
+        self.dtype = record_dtype(len(self.channels))
+        self._checked = False
+
+    def header_bytes(self):
+        """ Returns the encoded header (prefix and padded JSON schema). """
+        schema = {'channels':self.channels,'units':self.units,\
+                  'devices':self.devices,'meta':self.meta,\
+                  'record_size':self.dtype.itemsize}
+        text = json.dumps(schema).encode('utf-8')
+        pad = (-(_PREFIX.size+len(text)))%_ALIGN
+        text += b" "*pad
+        return _PREFIX.pack(MAGIC,VERSION,len(text)) + text
+
+    def _check(self):
+        """ Creates the file with header, or validates an existing one. """
+        if not os.path.exists(self.filename) \
+           or os.path.getsize(self.filename) == 0:
+            with open(self.filename,'wb') as f:
+                f.write(self.header_bytes())
+        else:
+            header = read_header(self.filename)
+            assert len(header['channels']) == len(self.channels),\
+                   "Channel count does not match existing file '{}'!"\
+                   .format(self.filename)
+            # drop a partially written record, if any
+            size = os.path.getsize(self.filename)
+            extra = (size-header['offset'])%self.dtype.itemsize
+            if extra:
+                with open(self.filename,'r+b') as f:
+                    f.truncate(size-extra)
+        self._checked = True
+
+    def pack(self,times,values,flags=0):
+        """ Returns the records for 'times' (ns), 'values' (n x channels)
+        and 'flags' as a numpy array. Single records are accepted, too. """
+        times = np.atleast_1d(np.asarray(times,dtype='<i8'))
+        rec = np.zeros(len(times),dtype=self.dtype)
+        rec['time'] = times
+        rec['data'] = np.asarray(values,dtype='<f4')\
+                      .reshape(len(times),len(self.channels))
+        rec['flags'] = flags
+        return rec
+
+    def append(self,times,values,flags=0):
+        """ Appends one or more records to the file. """
+        if not self._checked or not os.path.exists(self.filename):
+            self._check()
+        rec = self.pack(times,values,flags)
+        with open(self.filename,'ab') as f:
+            f.write(rec.tobytes())
+
+
+def read_csv_log(filename):
+    """ Reads a pyKraken text log (timestamp, channels ..., trigger flag).
+    Returns (times [ns], values [n x channels], triggers). """
+    times = []
+    values = []
+    triggers = []
+    with open(filename,'r') as f:
+        for line in f:
+            fields = line.strip().split(",")
+            if len(fields) < 2:
+                continue
+            try:
+                t = parse_timestamp(fields[0])
+                v = [float(x) for x in fields[1:-1]]
+                tr = int(float(fields[-1]))
+            except ValueError:
+                # skip partially written or corrupted lines
+                continue
+            if values and len(v) != len(values[0]):
+                continue
+            times.append(t)
+            values.append(v)
+            triggers.append(tr)
+    times = np.array(times,dtype='<i8')
+    values = np.array(values,dtype='<f4')
+    triggers = np.array(triggers,dtype='u1')
+    if len(times) == 0:
+        values = values.reshape(0,0)
+    return times,values,triggers
+
+def convert_csv(infile,outfile=None,channels=None,units=None,devices=None):
+    """ Converts a pyKraken text log to the binary format. Channel names
+    default to 'ch0', 'ch1', ...; 'outfile' defaults to the input name with
+    the extension replaced by '.bin'. Returns the output file name. """
+    if outfile is None:
+        outfile = os.path.splitext(infile)[0] + ".bin"
+    times,values,triggers = read_csv_log(infile)
+    nch = values.shape[1]
+    if channels is None:
+        channels = ["ch{}".format(i) for i in range(0,nch)]
+    assert len(channels) == nch,\
+           "Expecting {} channel names, got {}!".format(nch,len(channels))
+    log = BinaryLog(outfile,channels,units=units,devices=devices,\
+                    meta={'source':os.path.basename(infile)})
+    # start from scratch
+    with open(outfile,'wb') as f:
+        f.write(log.header_bytes())
+    log._checked = True
+    flags = np.where(triggers > 0,FLAG_TRIGGERED,0).astype('u1')
+    log.append(times,values,flags)
+    return outfile
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 Binlog.py LOGFILE.txt [LOGFILE.txt ...]")
+        sys.exit(1)
+    for infile in sys.argv[1:]:
+        outfile = convert_csv(infile)
+        print("{} ({} bytes) > {} ({} bytes)".format(\
+            infile,os.path.getsize(infile),\
+            outfile,os.path.getsize(outfile)))
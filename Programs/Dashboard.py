@@ -0,0 +1,255 @@
+# HTTP dashboard of the pyKraken logs
+#
+#   A small web server for the lab network that answers with JSON:
+#       /api/current                  latest sample of today's slow log
+#       /api/series?start=2020-04-13T14:00&end=2020-04-13T15:00
+#                  &channels=0,2&points=800&method=minmax
+#       /api/series?last=3600         the last hour (seconds before now)
+#   Series are read through a History.HistoryStore and reduced on the
+#   server to about 'points' points per channel (see Downsample.py). Each
+#   channel keeps its own points, so every series has its own times
+#   ('YYYY-MM-DDTHH:MM:SS.fff', local time as in the logs). Responses are
+#   cached by (range, resolution, channels, data version): the version
+#   changes only when lines are appended to the logs, so many clients
+#   polling the same view are served without reading the logs again.
+#   The page at / shows the current values.
+#   The sidecar files of the text logs are kept in a local directory
+#   ('cache_dir', default: ~/.cache/pykraken/dashboard/), not next to the
+#   logs; a restart continues with the sidecars of the last run.
+#
+#   Start with
+#       python3 Dashboard.py [--port 8080] [--path /home/pi/.../Logs/]
+#
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from collections import OrderedDict
+from urllib.parse import urlparse,parse_qs
+import numpy as np
+import Downsample
+import History
+import Binlog
+import argparse
+import datetime
+import threading
+import hashlib
+import json
+import os
+
+_PAGE = b"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Pi Monitoring</title></head>
+<body style="font-family:sans-serif">
+<h2>Pi Monitoring</h2><p id="time"></p><table id="values"></table>
+<p>JSON: <a href="/api/current">/api/current</a>,
+<a href="/api/series?last=3600&amp;points=400">/api/series?last=3600</a></p>
+<script>
+function update() {
+  fetch("/api/current").then(r => r.json()).then(d => {
+    document.getElementById("time").textContent = d.time;
+    document.getElementById("values").innerHTML = d.channels.map((c,i) =>
+      "<tr><td>" + c + "</td><td>" + d.values[i] + "</td></tr>").join("");
+  });
+}
+update(); setInterval(update, 5000);
+</script></body></html>
+"""
+
+
+def _parse_time(text):
+    """ Parses 'YYYY-MM-DDTHH:MM[:SS]' (or with a space) to ns, None stays
+    None. """
+    if text is None:
+        return None
+    return Binlog.datetime2ns(datetime.datetime.fromisoformat(text))
+
+def _times(t):
+    """ Formats ns timestamps as ISO strings (ms). """
+    return np.datetime_as_string(np.asarray(t).astype('datetime64[ns]'),\
+                                 unit='ms').tolist()
+
+def _values(v,decimals):
+    """ Rounds values for JSON; NaN (missing) becomes null. """
+    v = np.round(np.asarray(v,dtype=np.float64),decimals)
+    return [None if x != x else x for x in v.tolist()]
+
+
+class Dashboard():
+    """ Builds the JSON responses from the logs in 'path' and caches them. """
+
+    _default = {\
+        'filemask':"Datalog_Slow_{2:04}-{1:02}-{0:02}.txt",\
+        'filemask_bin':"Datalog_Slow_{2:04}-{1:02}-{0:02}.bin",\
+        'cache_dir':None,\
+        'points':800,\
+        'max_points':5000,\
+        'method':'minmax',\
+        'decimals':4,\
+        'cache_size':64,\
+        }
+
+    def __init__(self,path,**kwargs):
+        self.path = path
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        if self.cache_dir is None:
+            self.cache_dir = os.path.join(History.CACHE_DIR,"dashboard")
+        self.store = History.HistoryStore(path,filemask=self.filemask,\
+                                          filemask_bin=self.filemask_bin,\
+                                          cache_dir=self.cache_dir)
+        # the log store is not thread safe
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self,key,build):
+        """ Returns (body, etag) for 'key', building it if needed. """
+        etag = '"{}"'.format(hashlib.sha1(repr(key).encode()).hexdigest())
+        body = self._cache.get(key)
+        if body is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return body,etag
+        self.misses += 1
+        body = json.dumps(build(),separators=(',',':')).encode()
+        self._cache[key] = body
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return body,etag
+
+    def current(self):
+        """ Latest sample of today's log: (body, etag). """
+        with self._lock:
+            version = self.store.version()
+            def build():
+                times,values,flags = self.store.query()
+                if len(times) == 0:
+                    return {'time':None,'values':[],'channels':[]}
+                nch = values.shape[1]
+                return {'time':_times(times[-1:])[0],\
+                        'values':_values(values[-1],self.decimals),\
+                        'channels':self.channel_names(nch),\
+                        'triggered':bool(flags[-1] & Binlog.FLAG_TRIGGERED)}
+            return self._cached(('current',version),build)
+
+    def channel_names(self,nch):
+        """ Channel names from the header of today's log (default: ch0 ...). """
+        log = self.store.log(self.store.day_file(datetime.date.today()))
+        if log.header and len(log.header['channels']) == nch:
+            return list(log.header['channels'])
+        return ["ch{}".format(i) for i in range(0,nch)]
+
+    def series(self,start=None,end=None,last=None,channels=None,\
+               points=None,method=None):
+        """ Downsampled series of a time range: (body, etag). 'last' (s)
+        selects the time before now instead of start and end. """
+        points = min(int(points or self.points),self.max_points)
+        method = method or self.method
+        assert method in Downsample.METHODS,\
+               "Unknown downsampling method '{}'!".format(method)
+        if channels is not None:
+            channels = tuple(channels)
+        with self._lock:
+            if last is not None:
+                # relative ranges are cached until new data arrives
+                rng = ('last',float(last))
+                # the logs hold local time
+                start = Binlog.datetime2ns(datetime.datetime.now()) \
+                        - int(float(last)*1e9)
+                end = None
+            else:
+                rng = (start,end)
+            version = self.store.version(start,end)
+            def build():
+                times,values,flags = self.store.query(start,end,channels)
+                index = list(channels) if channels is not None \
+                        else list(range(0,values.shape[1]))
+                t,v = Downsample.METHODS[method](times,values,points)
+                return {'start':_times([times[0]])[0] if len(times) else None,\
+                        'end':_times([times[-1]])[0] if len(times) else None,\
+                        'samples':len(times),'points':points,\
+                        'method':method,\
+                        'series':[{'channel':c,'t':_times(t[:,i]),\
+                                   'v':_values(v[:,i],self.decimals)} \
+                                  for i,c in enumerate(index) \
+                                  if i < v.shape[1]]}
+            return self._cached(('series',rng,channels,points,method,version),\
+                                build)
+
+
+class DashboardHandler(BaseHTTPRequestHandler):
+    """ Maps the URLs to the Dashboard of the server. """
+
+    def _send(self,code,body,etag=None,ctype="application/json"):
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag',etag)
+            self.end_headers()
+            return
+        self.send_response(code)
+        self.send_header('Content-Type',ctype)
+        self.send_header('Content-Length',str(len(body)))
+        self.send_header('Access-Control-Allow-Origin','*')
+        if etag is not None:
+            self.send_header('ETag',etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k:v[-1] for k,v in parse_qs(url.query).items()}
+        dashboard = self.server.dashboard
+        try:
+            if url.path == "/":
+                self._send(200,_PAGE,ctype="text/html; charset=utf-8")
+            elif url.path == "/api/current":
+                self._send(200,*dashboard.current())
+            elif url.path == "/api/series":
+                channels = query.get('channels')
+                if channels is not None:
+                    channels = [int(c) if c.isdigit() else c \
+                                for c in channels.split(",")]
+                self._send(200,*dashboard.series(\
+                    start=_parse_time(query.get('start')),\
+                    end=_parse_time(query.get('end')),\
+                    last=query.get('last'),channels=channels,\
+                    points=query.get('points'),method=query.get('method')))
+            else:
+                self._send(404,json.dumps({'error':"Not found"}).encode())
+        except (AssertionError,ValueError,IndexError) as e:
+            self._send(400,json.dumps({'error':str(e)}).encode())
+
+    def log_message(self,format,*args):
+        # no line per request
+        pass
+
+
+def serve(path,port=8080,host="",**kwargs):
+    """ Serves the dashboard of the logs in 'path' until interrupted. """
+    server = ThreadingHTTPServer((host,port),DashboardHandler)
+    server.daemon_threads = True
+    server.dashboard = Dashboard(path,**kwargs)
+    print("Dashboard on port {} for {}".format(port,path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=\
+        "Serves the pyKraken logs as JSON over HTTP.")
+    parser.add_argument('--path',default=\
+                        "/home/pi/YDrive/share/Pi_Monitoring/Logs/",\
+                        help="directory with the daily log files")
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--cache',default=None,\
+                        help="local directory for the sidecar files "\
+                        "(default: {})".format(\
+                        os.path.join(History.CACHE_DIR,"dashboard")))
+    args = parser.parse_args()
+    serve(args.path,args.port,cache_dir=args.cache)
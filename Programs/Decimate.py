@@ -0,0 +1,124 @@
+# Multi-resolution decimation of logged samples
+#
+#   A Decimator aggregates samples into time buckets (aligned to the clock,
+#   e.g. 10 s, 1 min, 1 h) and keeps count, sum, sum of squares, minimum and
+#   maximum per channel. Every level is built from the completed buckets of
+#   the level below, so the cascade costs the same as a single level. Each
+#   completed bucket yields mean, min, max and (population) standard
+#   deviation per channel.
+#
+#   The DataLogger writes one file per level and day, with lines
+#       timestamp (bucket start), mean,min,max,std for every channel, count
+#
+import numpy as np
+import math
+
+
+def level_label(period):
+    """ Returns a short label for a bucket length in s, e.g. '10s', '1min',
+    '1h'. """
+    if period % 3600 == 0:
+        return "{}h".format(int(period//3600))
+    if period % 60 == 0:
+        return "{}min".format(int(period//60))
+    return "{:g}s".format(period)
+
+
+class Bucket():
+    """ Running aggregate of the samples within one time bucket. """
+
+    def __init__(self,start,nchannels):
+        self.start = start
+        self.count = 0
+        self.sum = np.zeros(nchannels)
+        self.sumsq = np.zeros(nchannels)
+        self.min = np.full(nchannels,np.inf)
+        self.max = np.full(nchannels,-np.inf)
+
+    def add(self,values):
+        """ Adds a single sample. """
+        values = np.asarray(values,dtype=float)
+        self.count += 1
+        self.sum += values
+        self.sumsq += values*values
+        np.minimum(self.min,values,out=self.min)
+        np.maximum(self.max,values,out=self.max)
+
+    def merge(self,other):
+        """ Adds the samples of another (completed) bucket. """
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        np.minimum(self.min,other.min,out=self.min)
+        np.maximum(self.max,other.max,out=self.max)
+
+    def result(self):
+        """ Returns a dictionary with 'mean', 'min', 'max', 'std' (arrays
+        over channels) and 'count'. """
+        n = max(self.count,1)
+        mean = self.sum/n
+        var = np.maximum(self.sumsq/n - mean*mean,0.0)
+        return {'mean':mean,'min':self.min.copy(),'max':self.max.copy(),\
+                'std':np.sqrt(var),'count':self.count}
+
+
+class Decimator():
+    """ Cascaded aggregation of samples into buckets of the lengths given in
+    'levels' (in s, ascending; each a multiple of the previous one). """
+
+    def __init__(self,levels,nchannels):
+        levels = list(levels)
+        assert len(levels) > 0,"Need at least one decimation level!"
+        for i in range(1,len(levels)):
+            ratio = levels[i]/levels[i-1]
+            assert levels[i] > levels[i-1] \
+                   and abs(ratio-round(ratio)) < 1e-9,\
+                   "Levels must be ascending multiples of each other!"
+        self.levels = levels
+        self.nchannels = nchannels
+        self._buckets = [None]*len(levels)
+
+    def _start(self,level,t):
+        """ Start of the bucket of 'level' containing time 't'. """
+        period = self.levels[level]
+        return math.floor(t/period)*period
+
+    def add(self,t,values):
+        """ Adds a sample taken at time 't' (s, e.g. local time since epoch).
+        Returns the list of completed buckets as (period, start, result)
+        tuples, finest level first. """
+        done = []
+        start = self._start(0,t)
+        b = self._buckets[0]
+        if b is not None and b.start != start:
+            self._close(0,done)
+        if self._buckets[0] is None:
+            self._buckets[0] = Bucket(start,self.nchannels)
+        self._buckets[0].add(values)
+        return done
+
+    def _close(self,level,done):
+        """ Completes the current bucket of 'level' and passes it on to the
+        next coarser level. """
+        b = self._buckets[level]
+        self._buckets[level] = None
+        done.append((self.levels[level],b.start,b.result()))
+        if level+1 < len(self.levels):
+            start = self._start(level+1,b.start)
+            up = self._buckets[level+1]
+            if up is not None and up.start != start:
+                self._close(level+1,done)
+                up = None
+            if up is None:
+                up = Bucket(start,self.nchannels)
+                self._buckets[level+1] = up
+            up.merge(b)
+
+    def flush(self):
+        """ Completes all open buckets (e.g. at the end of a file). Returns
+        them like add(). """
+        done = []
+        for level in range(0,len(self.levels)):
+            if self._buckets[level] is not None:
+                self._close(level,done)
+        return done
@@ -0,0 +1,173 @@
+# Downsampling of time series for plotting
+#
+#   A line on screen cannot show more than about two points per pixel
+#   column, so long series are reduced to 'n_out' points before plotting:
+#   - minmax: the minimum and maximum of every bucket, in time order. Keeps
+#     the envelope, i.e. spikes stay visible.
+#   - lttb: Largest-Triangle-Three-Buckets (Steinarsson, 2013), one point
+#     per bucket chosen to keep the visual shape.
+#   Series are given as times (n) and values (n x channels); the results
+#   are times and values of shape (n_out x channels), since every channel
+#   keeps different points. A DownsampleCache recomputes a window only when
+#   its data or the requested size changed; for minmax, only the buckets
+#   with new rows are computed, so a refresh costs about the same however
+#   long the window is.
+#
+import numpy as np
+
+
+def _passthrough(t,y):
+    """ Returns times broadcast to the shape of the values (no copy). """
+    y = np.asarray(y)
+    if y.ndim == 1:
+        y = y[:,None]
+    return np.broadcast_to(np.asarray(t)[:,None],y.shape),y
+
+def _envelope(t,y,size):
+    """ Minimum and maximum of every 'size' rows (the last bucket may be
+    shorter), in time order. Returns times and values of shape (2 x
+    buckets) x channels. """
+    n = y.shape[0]
+    nb = int(np.ceil(n/size))
+    yf = y.astype(np.float64)
+    # pad the last bucket; NaN (missing values) never wins
+    lo = np.full((nb*size,y.shape[1]),np.inf)
+    hi = np.full((nb*size,y.shape[1]),-np.inf)
+    lo[:n] = np.where(np.isnan(yf),np.inf,yf)
+    hi[:n] = np.where(np.isnan(yf),-np.inf,yf)
+    base = (np.arange(nb)*size)[:,None]
+    imin = base + np.argmin(lo.reshape(nb,size,-1),axis=1)
+    imax = base + np.argmax(hi.reshape(nb,size,-1),axis=1)
+    # both points of every bucket, in time order
+    idx = np.empty((2*nb,y.shape[1]),dtype=np.int64)
+    idx[0::2] = np.minimum(imin,imax)
+    idx[1::2] = np.maximum(imin,imax)
+    idx = np.minimum(idx,n-1)
+    return np.take_along_axis(t,idx,axis=0),np.take_along_axis(y,idx,axis=0)
+
+def bucket_size(n,n_out):
+    """ Number of rows per min/max bucket for n rows and n_out points. """
+    return int(np.ceil(n/(n_out//2)))
+
+def minmax(t,y,n_out):
+    """ Reduces each channel to the minimum and maximum of n_out/2 buckets
+    of equal length (in samples), in time order. """
+    t,y = _passthrough(t,y)
+    n = y.shape[0]
+    if n <= n_out or n_out < 2:
+        return t,y
+    return _envelope(t,y,bucket_size(n,n_out))
+
+def lttb(t,y,n_out):
+    """ Reduces each channel to n_out points with the Largest-Triangle-
+    Three-Buckets algorithm. The first and last points are kept. """
+    t,y = _passthrough(t,y)
+    n = y.shape[0]
+    if n <= n_out or n_out < 3:
+        return t,y
+    x = np.asarray(t[:,0],dtype=np.float64)
+    edges = np.linspace(1,n-1,n_out-1).astype(np.int64)
+    nch = y.shape[1]
+    idx = np.zeros((n_out,nch),dtype=np.int64)
+    idx[-1] = n-1
+    yf = y.astype(np.float64)
+    cols = np.arange(nch)
+    a = np.zeros(nch,dtype=np.int64)
+    for i in range(0,n_out-2):
+        lo,hi = edges[i],edges[i+1]
+        # average of the next bucket (the last point for the last bucket)
+        nlo,nhi = hi,(edges[i+2] if i+2 < len(edges) else n)
+        cx = x[nlo:nhi].mean()
+        cy = yf[nlo:nhi].mean(axis=0)
+        ax = x[a]
+        ay = yf[a,cols]
+        # twice the triangle areas for all candidates in this bucket
+        area = np.abs((ax-cx)*(yf[lo:hi]-ay) \
+                      - (ax[None,:]-x[lo:hi,None])*(cy-ay))
+        area = np.where(np.isnan(area),-1.0,area)
+        a = lo + np.argmax(area,axis=0)
+        idx[i+1] = a
+    return np.take_along_axis(t,idx,axis=0),np.take_along_axis(y,idx,axis=0)
+
+METHODS = {'minmax':minmax,'lttb':lttb}
+
+
+class DownsampleCache():
+    """ Keeps the downsampled version of named windows. For 'minmax', the
+    buckets are aligned to the absolute row number ('version' is the number
+    of rows received, the window holds the last rows up to it), so only the
+    buckets with new rows are computed when data arrives. """
+
+    def __init__(self,method='minmax'):
+        assert method in METHODS,"Unknown downsampling method '{}'!"\
+                                 .format(method)
+        self.method = method
+        self._cache = {}
+        self._buckets = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _minmax(self,name,version,t,y,n_out):
+        """ Incremental min/max envelope of the rows [version-n, version). """
+        t,y = _passthrough(t,y)
+        n = y.shape[0]
+        if n <= n_out or n_out < 2:
+            return t,y
+        size = bucket_size(n,n_out)
+        a0 = version - n
+        first = -(-a0//size)            # first complete bucket
+        end = version//size             # buckets before this one are complete
+        if end - first < 1:
+            return _envelope(t,y,size)
+        state = self._buckets.get(name)
+        if state is None or state['size'] != size \
+           or state['version'] > version or state['end'] < first \
+           or state['t'].shape[1] != y.shape[1]:
+            state = {'size':size,'first':first,'end':first,\
+                     't':t[:0],'y':y[:0]}
+        # drop buckets that left the window, add the new complete ones
+        cut = 2*max(0,first-state['first'])
+        tc,yc = state['t'][cut:],state['y'][cut:]
+        start = max(state['end'],first)
+        if end > start:
+            lo,hi = start*size-a0,end*size-a0
+            tn,yn = _envelope(t[lo:hi],y[lo:hi],size)
+            tc,yc = np.concatenate((tc,tn)),np.concatenate((yc,yn))
+        state.update({'first':first,'end':end,'version':version,\
+                      't':tc,'y':yc})
+        self._buckets[name] = state
+        # partial buckets at both ends of the window
+        parts_t,parts_y = [],[]
+        if first*size > a0:
+            th,yh = _envelope(t[:first*size-a0],y[:first*size-a0],\
+                              first*size-a0)
+            parts_t.append(th)
+            parts_y.append(yh)
+        parts_t.append(tc)
+        parts_y.append(yc)
+        if version > end*size:
+            tt,yt = _envelope(t[end*size-a0:],y[end*size-a0:],\
+                              version-end*size)
+            parts_t.append(tt)
+            parts_y.append(yt)
+        return np.concatenate(parts_t),np.concatenate(parts_y)
+
+    def get(self,name,version,t,y,n_out):
+        """ Returns the downsampled (times, values) of window 'name'. They
+        are recomputed only if 'version' (e.g. the number of rows received)
+        or 'n_out' changed since the last call. """
+        entry = self._cache.get(name)
+        if entry is not None and entry[0] == (version,n_out):
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        if self.method == 'minmax':
+            result = self._minmax(name,version,t,y,n_out)
+        else:
+            result = METHODS[self.method](t,y,n_out)
+        self._cache[name] = ((version,n_out),result)
+        return result
+
+    def clear(self):
+        self._cache = {}
+        self._buckets = {}
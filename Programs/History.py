@@ -0,0 +1,360 @@
+# Memory-mapped access to the daily pyKraken logs
+#
+#   A HistoryStore answers time-range queries
+#       t,values,flags = store.query(start,end,channels)
+#   by a binary search on the (sorted) timestamps of memory-mapped binary
+#   logs, see Binlog.py. Within one file, the result is a slice of the
+#   memory map, so only the pages in the requested range are read.
+#   Days with a binary log written by the DataLogger (filemask_bin) use it
+#   directly. For text logs, a sidecar binary log '<log>.bin' is kept up to
+#   date (with its read position in '<log>.bin.json') by reading only the
+#   lines appended since the last query (Logreader.LogTail). Several
+#   processes may share a sidecar: the read position is taken from the
+#   '.json' file before every update, under a lock on '<log>.bin.lock'.
+#   Sidecars are kept locally (default: one directory per log directory in
+#   ~/.cache/pykraken/), not next to the logs on the share.
+#
+#   Print or export a range with
+#       python3 History.py /home/pi/YDrive/share/Pi_Monitoring/Logs/ \
+#           "2020-04-13 14:00" "2020-04-13 15:00" [--channels 1 3 5]
+#
+import numpy as np
+import Binlog
+import Logreader
+import contextlib
+import argparse
+import datetime
+import bisect
+import zlib
+import json
+import sys
+import os
+try:
+    import fcntl
+except ImportError:
+    # Windows: no locking between processes
+    fcntl = None
+
+# default location of the sidecar directories
+CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","pykraken")
+
+
+def to_ns(t):
+    """ Converts a datetime, datetime64 or integer ns to integer ns (None
+    stays None). """
+    if t is None:
+        return None
+    if isinstance(t,datetime.datetime):
+        return Binlog.datetime2ns(t)
+    if isinstance(t,np.datetime64):
+        return int(t.astype('datetime64[ns]').astype(np.int64))
+    return int(t)
+
+def default_cache_dir(logdir):
+    """ Local directory for the sidecars of the logs in 'logdir': a
+    subdirectory of CACHE_DIR named after the log directory. """
+    logdir = os.path.abspath(logdir)
+    name = "{}_{:08x}".format(os.path.basename(logdir),\
+                              zlib.crc32(logdir.encode()) & 0xffffffff)
+    return os.path.join(CACHE_DIR,name)
+
+@contextlib.contextmanager
+def _locked(filename):
+    """ Holds an exclusive lock on 'filename' (created if needed). """
+    with open(filename,'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+
+
+class DayLog():
+    """ Memory-mapped records of a single log file: a binary log ('.bin'),
+    or a text log through its sidecar binary log in 'cache_dir' (default:
+    see default_cache_dir). """
+
+    def __init__(self,filename,cache_dir=None):
+        self.filename = filename
+        self.binary = filename.endswith(".bin")
+        if self.binary:
+            self.sidecar = filename
+        else:
+            if cache_dir is None:
+                cache_dir = default_cache_dir(os.path.dirname(filename))
+            os.makedirs(cache_dir,exist_ok=True)
+            self.sidecar = os.path.join(cache_dir,\
+                                        os.path.basename(filename) + ".bin")
+        self.state_file = self.sidecar + ".json"
+        self.header = None
+        self.records = None
+        self.ordered = True
+        self._size = None
+        self._checked = 0
+        self._tail = None
+
+    def _load_tail(self):
+        """ Restores the read position in the text log, if it matches the
+        sidecar; otherwise the sidecar is rebuilt from the start. """
+        tail = Logreader.LogTail(self.filename)
+        if os.path.exists(self.state_file) and os.path.exists(self.sidecar):
+            with open(self.state_file,'r') as f:
+                state = json.load(f)
+            try:
+                header,records = Binlog.open_binlog(self.sidecar)
+                nrec = len(records)
+            except (AssertionError,IOError,OSError,ValueError):
+                nrec = None
+            if nrec == state.get('records'):
+                for key in ('offset','inode','head','head_len'):
+                    setattr(tail,key,state[key])
+        return tail
+
+    def _save_tail(self,nrec):
+        """ Stores the read position in the text log (atomically). """
+        tail = self._tail
+        state = {'offset':tail.offset,'inode':tail.inode,'head':tail.head,\
+                 'head_len':tail.head_len,'records':nrec}
+        with open(self.state_file + ".tmp",'w') as f:
+            json.dump(state,f)
+        os.replace(self.state_file + ".tmp",self.state_file)
+
+    def _read_tail(self):
+        """ Reads the new lines of the text log as records. """
+        times,values,triggers = self._tail.read()
+        flags = np.where(triggers,Binlog.FLAG_TRIGGERED,0).astype('u1')
+        return times,values,flags
+
+    def _update_sidecar(self):
+        """ Appends the new lines of the text log to the sidecar. Other
+        processes may have extended it meanwhile, so the read position is
+        reloaded under the lock. """
+        with _locked(self.sidecar + ".lock"):
+            self._tail = self._load_tail()
+            self._append_tail()
+
+    def _append_tail(self):
+        """ Reads the lines after the (reloaded) read position. """
+        tail = self._tail
+        fresh = tail.offset == 0
+        times,values,flags = self._read_tail()
+        if len(times) == 0:
+            if (fresh or tail.reset) and os.path.exists(self.sidecar):
+                # the text log is empty (again)
+                os.remove(self.sidecar)
+                self.records = None
+            return
+        nch = values.shape[1]
+        old = None
+        if not (fresh or tail.reset):
+            header,old = Binlog.open_binlog(self.sidecar)
+            if nch != len(header['channels']):
+                # the layout of the log changed: start over
+                tail.offset = 0
+                times,values,flags = self._read_tail()
+                nch = values.shape[1]
+                old = None
+        log = Binlog.BinaryLog(self.sidecar,\
+                               ["ch{}".format(i) for i in range(0,nch)],\
+                               meta={'source':os.path.basename(self.filename)})
+        log._checked = True
+        ordered = bool(np.all(np.diff(times) >= 0))
+        if old is not None and len(old) > 0:
+            ordered = ordered and times[0] >= old['time'][-1]
+        if old is None or not ordered:
+            # write the whole sidecar, sorted by time
+            rec = log.pack(times,values,flags)
+            if old is not None:
+                rec = np.concatenate((np.array(old),rec))
+            rec = rec[np.argsort(rec['time'],kind='stable')]
+            self.records = None
+            with open(self.sidecar + ".tmp",'wb') as f:
+                f.write(log.header_bytes())
+                f.write(rec.tobytes())
+            os.replace(self.sidecar + ".tmp",self.sidecar)
+            nrec = len(rec)
+        else:
+            log.append(times,values,flags)
+            nrec = len(old) + len(times)
+        self._save_tail(nrec)
+
+    def refresh(self):
+        """ Brings the memory map up to date with the log file. """
+        if not self.binary:
+            self._update_sidecar()
+        if not os.path.exists(self.sidecar):
+            self.header,self.records = None,None
+            return
+        size = os.path.getsize(self.sidecar)
+        if size != self._size or self.records is None:
+            self.header,self.records = Binlog.open_binlog(self.sidecar)
+            self._size = size
+            if len(self.records) < self._checked:
+                self._checked = 0
+                self.ordered = True
+        # binary logs are written in time order, unless the clock was set
+        # back; check the new records only
+        if self.ordered and len(self.records) > self._checked:
+            t = self.records['time'][max(self._checked-1,0):]
+            self.ordered = bool(np.all(np.diff(t) >= 0))
+            self._checked = len(self.records)
+
+    def channel_index(self,channels):
+        """ Converts channel names or indices to indices. """
+        if channels is None:
+            return None
+        names = self.header['channels'] if self.header else []
+        out = []
+        for c in channels:
+            if isinstance(c,str):
+                assert c in names,"Unknown channel '{}'!".format(c)
+                out.append(names.index(c))
+            else:
+                out.append(int(c))
+        return out
+
+    def range(self,start=None,end=None):
+        """ Returns the records with start <= time < end (ns; None: no
+        limit). Zero-copy slice of the memory map if the file is in time
+        order. """
+        if self.records is None:
+            return None
+        records = self.records
+        times = records['time']
+        if not self.ordered:
+            records = np.array(records)[np.argsort(times,kind='stable')]
+            times = records['time']
+        i0 = 0 if start is None else bisect.bisect_left(times,start)
+        i1 = len(times) if end is None else bisect.bisect_left(times,end)
+        return records[i0:i1]
+
+
+class HistoryStore():
+    """ Time-range queries over the daily log files in 'path'. """
+
+    _default = {\
+        'filemask':"Datalog_Slow_{2:04}-{1:02}-{0:02}.txt",\
+        'filemask_bin':"Datalog_Slow_{2:04}-{1:02}-{0:02}.bin",\
+        'cache_dir':None,\
+        'max_open':16,\
+        }
+
+    def __init__(self,path,**kwargs):
+        self.path = path
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        self._logs = {}
+
+    def day_file(self,day):
+        """ Log file for a date: the binary log if there is one, else the
+        text log. """
+        if self.filemask_bin:
+            name = os.path.join(self.path,\
+                   self.filemask_bin.format(day.day,day.month,day.year))
+            if os.path.exists(name):
+                return name
+        return os.path.join(self.path,\
+               self.filemask.format(day.day,day.month,day.year))
+
+    def log(self,filename):
+        """ Returns the (cached) DayLog of a file. """
+        if filename not in self._logs:
+            if len(self._logs) >= self.max_open:
+                self._logs.pop(next(iter(self._logs)))
+            self._logs[filename] = DayLog(filename,self.cache_dir)
+        return self._logs[filename]
+
+    def files(self,start=None,end=None):
+        """ Log files covering [start, end) (ns; default: today). """
+        today = datetime.datetime.now()
+        first = today if start is None else Binlog.ns2datetime(start)
+        last = today if end is None else Binlog.ns2datetime(end-1)
+        out = []
+        day = first.date()
+        while day <= last.date():
+            name = self.day_file(day)
+            if name not in out:
+                out.append(name)
+            day += datetime.timedelta(days=1)
+        return out
+
+    def version(self,start=None,end=None):
+        """ Refreshes the logs covering [start, end) and returns a value that
+        changes whenever their data changes (e.g. a cache key). """
+        out = []
+        for name in self.files(to_ns(start),to_ns(end)):
+            log = self.log(name)
+            log.refresh()
+            nrec = 0 if log.records is None else len(log.records)
+            out.append((os.path.basename(name),nrec))
+        return tuple(out)
+
+    def query(self,start=None,end=None,channels=None):
+        """ Returns (times [int64 ns], values [float32, samples x channels],
+        flags [uint8]) of the samples with start <= time < end. 'start' and
+        'end' are datetime objects, datetime64 or ns (default: today).
+        'channels' selects channels by index or name (default: all). Within
+        a single file, the arrays are views of the memory map (selected
+        channels are copied). """
+        start = to_ns(start)
+        end = to_ns(end)
+        parts = []
+        for name in self.files(start,end):
+            log = self.log(name)
+            log.refresh()
+            rec = log.range(start,end)
+            if rec is None or len(rec) == 0:
+                continue
+            parts.append((log,rec))
+        if len(parts) == 0:
+            return np.zeros(0,dtype=np.int64),\
+                   np.zeros((0,0),dtype=np.float32),np.zeros(0,dtype='u1')
+        times = []
+        values = []
+        flags = []
+        for log,rec in parts:
+            data = rec['data']
+            index = log.channel_index(channels)
+            if index is not None:
+                data = data[:,index]
+            times.append(rec['time'])
+            values.append(data)
+            flags.append(rec['flags'])
+        if len(parts) == 1:
+            return times[0],values[0],flags[0]
+        return np.concatenate(times),np.concatenate(values),\
+               np.concatenate(flags)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=\
+        "Prints the logged samples of a time range as CSV.")
+    parser.add_argument('logdir',help="directory with the daily log files")
+    parser.add_argument('start',help="start time, 'YYYY-MM-DD HH:MM'")
+    parser.add_argument('end',help="end time, 'YYYY-MM-DD HH:MM'")
+    parser.add_argument('--channels',nargs='*',default=None,\
+                        help="channel indices or names (default: all)")
+    parser.add_argument('--cache',default=None,\
+                        help="directory for the sidecar files (default: "\
+                        "in {})".format(CACHE_DIR))
+    args = parser.parse_args()
+    channels = None
+    if args.channels:
+        channels = [int(c) if c.isdigit() else c for c in args.channels]
+    store = HistoryStore(args.logdir,cache_dir=args.cache)
+    fmt = "%Y-%m-%d %H:%M"
+    times,values,flags = store.query(\
+        datetime.datetime.strptime(args.start,fmt),\
+        datetime.datetime.strptime(args.end,fmt),channels)
+    out = sys.stdout
+    for t,v,fl in zip(Logreader.ns2datetimes(times),values,flags):
+        out.write("{:%Y %m %d %H:%M:%S.%f},".format(t) \
+                  + ",".join(["{:.4f}".format(x) for x in v]) \
+                  + ",{}\n".format(1 if fl & Binlog.FLAG_TRIGGERED else 0))
@@ -0,0 +1,234 @@
+# Live stream of the DataLogger samples (Server-Sent Events)
+#
+#   The DataLogger publishes every averaged sample and every trigger edge to
+#   a StreamBroker, which numbers the events and keeps the last 'backlog'
+#   of them in memory. A StreamServer sends them over HTTP as Server-Sent
+#   Events:
+#       GET /stream                   new events
+#       GET /stream?since=1234        events after sequence number 1234
+#   Every connection starts with a 'hello' event holding the stream id
+#   (changes when the DataLogger restarts) and the range of sequence numbers
+#   in the backlog. Event ids are '<stream>-<seq>'. Browsers (EventSource)
+#   resume after a reconnect with the Last-Event-ID header, which is handled
+#   the same way as 'since': an id of an earlier run gets the whole backlog,
+#   since the sequence numbers start over with every run (also for
+#   '?since=<seq>&stream=<id>').
+#   If events a client asked for are no longer in the backlog, a 'gap' event
+#   with the number of 'missed' events precedes the others. Events:
+#       sample:   {'seq','t' (ns),'time','group','data','triggered','note'}
+#       trigger:  {'seq','t' (ns),'time','level' (1: rising, 0: falling)}
+#
+#   Follow a stream from Python with
+#       for seq,event,data in Livestream.subscribe("http://pi:8081/stream"):
+#   or from a shell with
+#       curl -N http://pi:8081/stream?since=0
+#
+from http.server import BaseHTTPRequestHandler,ThreadingHTTPServer
+from urllib.parse import urlparse,parse_qs
+from collections import deque
+import urllib.request
+import itertools
+import threading
+import json
+import time
+
+
+class StreamBroker():
+    """ Numbers published events and keeps the last 'backlog' of them. """
+
+    def __init__(self,backlog=10000):
+        self.backlog = backlog
+        self.stream_id = time.time_ns()
+        self.seq = 0
+        self._events = deque(maxlen=backlog)
+        self._cond = threading.Condition()
+
+    def publish(self,event,data):
+        """ Adds an event ('data' is a dictionary, which gets the sequence
+        number as 'seq'). Returns the sequence number. Cheap enough for the
+        acquisition loop: the data is encoded once for all clients. """
+        with self._cond:
+            self.seq += 1
+            data['seq'] = self.seq
+            self._events.append((self.seq,event,\
+                                 json.dumps(data,separators=(',',':'))))
+            self._cond.notify_all()
+            return self.seq
+
+    def first(self):
+        """ Sequence number of the oldest event in the backlog. """
+        return self.seq - len(self._events) + 1
+
+    def since(self,seq):
+        """ Returns (events after 'seq', number of missed events). A 'seq'
+        beyond the last event (e.g. from before a restart) replays the
+        backlog. """
+        with self._cond:
+            first = self.first()
+            if seq < 0 or seq > self.seq:
+                seq = first - 1
+            missed = max(0,first-seq-1)
+            start = max(0,seq-first+1)
+            return list(itertools.islice(self._events,start,None)),missed
+
+    def wait(self,seq,timeout=None):
+        """ Waits (up to 'timeout' seconds) for events after 'seq', then
+        returns them like since(). """
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > seq,timeout)
+        return self.since(seq)
+
+
+def parse_event_id(text):
+    """ Splits an event id '<stream>-<seq>' (or a bare '<seq>') into the
+    stream id (None if not given) and the sequence number. Raises
+    ValueError for anything else. """
+    stream,sep,seq = text.strip().rpartition("-")
+    return (stream if sep else None),int(seq)
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """ Sends the events of the server's broker as Server-Sent Events. """
+
+    def _event(self,seq,event,data):
+        out = ""
+        if seq is not None:
+            out += "id: {}-{}\n".format(self.server.broker.stream_id,seq)
+        return (out + "event: {}\ndata: {}\n\n".format(event,data)).encode()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/stream":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        since = query.get('since',[self.headers.get('Last-Event-ID')])[-1]
+        stream = query.get('stream',[None])[-1]
+        try:
+            if since is not None:
+                stream_id,since = parse_event_id(since)
+                if stream_id is not None:
+                    stream = stream_id
+        except ValueError:
+            self.send_error(400,"Bad sequence number")
+            return
+        broker = self.server.broker
+        if since is None:
+            since = broker.seq
+        elif since > broker.seq or (stream is not None \
+                                    and stream != str(broker.stream_id)):
+            # sequence number of an earlier run: replay the backlog
+            since = broker.first() - 1
+        self.send_response(200)
+        self.send_header('Content-Type','text/event-stream')
+        self.send_header('Cache-Control','no-cache')
+        self.send_header('Access-Control-Allow-Origin','*')
+        self.end_headers()
+        events,missed = broker.since(since)
+        hello = {'stream':broker.stream_id,'first':broker.first(),\
+                 'last':broker.seq}
+        try:
+            self.wfile.write(self._event(None,'hello',json.dumps(hello)))
+            while not self.server.closing:
+                if missed:
+                    self.wfile.write(self._event(None,'gap',\
+                                     json.dumps({'missed':missed})))
+                if len(events) == 0:
+                    # keeps proxies and clients from timing out
+                    self.wfile.write(b": keepalive\n\n")
+                else:
+                    self.wfile.write(b"".join([self._event(*e) \
+                                               for e in events]))
+                    since = events[-1][0]
+                self.wfile.flush()
+                events,missed = broker.wait(since,self.server.keepalive)
+        except (BrokenPipeError,ConnectionResetError):
+            pass
+
+    def log_message(self,format,*args):
+        # no line per client
+        pass
+
+
+class StreamServer():
+    """ Serves the events of a StreamBroker on 'port' in a background
+    thread. """
+
+    _default = {\
+        'host':"",\
+        'backlog':10000,\
+        'keepalive':15.0,\
+        }
+
+    def __init__(self,port,**kwargs):
+        self.port = port
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        self.broker = StreamBroker(self.backlog)
+        self._server = None
+        self._thread = None
+
+    def publish(self,event,data):
+        return self.broker.publish(event,data)
+
+    def start(self):
+        """ Starts serving. """
+        if self._server is not None:
+            return
+        self._server = ThreadingHTTPServer((self.host,self.port),StreamHandler)
+        self._server.daemon_threads = True
+        self._server.broker = self.broker
+        self._server.keepalive = self.keepalive
+        self._server.closing = False
+        self._thread = threading.Thread(target=self._server.serve_forever,\
+                                        name="Livestream server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """ Stops serving; open streams end with their next keepalive. """
+        if self._server is None:
+            return
+        self._server.closing = True
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+
+
+def subscribe(url,since=None,retry=5.0):
+    """ Yields (seq, event, data) from a stream, reconnecting after errors
+    and resuming after the last received event (its id names the run, so
+    a restarted DataLogger replays its backlog). 'hello' and 'gap' events
+    are yielded with seq None. """
+    last_id = None if since is None else str(since)
+    while True:
+        full = url
+        if last_id is not None:
+            full += ("&" if "?" in url else "?") + "since={}".format(last_id)
+        try:
+            with urllib.request.urlopen(full) as stream:
+                seq,event,data = None,"message",[]
+                for line in stream:
+                    line = line.decode().rstrip("\n")
+                    if line == "":
+                        if data:
+                            data = json.loads("\n".join(data))
+                            if seq is not None:
+                                last_id = event_id
+                            yield seq,event,data
+                        seq,event,data = None,"message",[]
+                    elif line.startswith("id:"):
+                        event_id = line[3:].strip()
+                        seq = parse_event_id(event_id)[1]
+                    elif line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        data.append(line[5:].strip())
+        except (IOError,OSError) as e:
+            print("Stream interrupted: {}".format(e))
+        time.sleep(retry)
@@ -0,0 +1,187 @@
+# Sparse time index for the pyKraken text logs
+#
+#   Next to a log 'Datalog_Slow_2020-04-13.txt', the index file
+#   'Datalog_Slow_2020-04-13.idx' holds (timestamp [int64 ns], byte offset
+#   [int64]) pairs for every Nth line of the log. A reader looks up the
+#   offsets around a time window and reads only those bytes, instead of
+#   scanning the log from the start of the day.
+#   The DataLogger extends the index while writing the log. Build the
+#   indexes of existing logs with
+#       python3 Logindex.py Datalog_Slow_2020-04-13.txt [more files ...]
+#
+import numpy as np
+import Logreader
+import argparse
+import os
+
+# index entry for every this many lines
+EVERY = 100
+# entries: timestamp (ns), byte offset of the line
+_ENTRY = np.dtype([('time','<i8'),('offset','<i8')])
+
+
+def index_name(logfile):
+    """ Returns the name of the index file of a log. """
+    return os.path.splitext(logfile)[0] + ".idx"
+
+def read_index(logfile):
+    """ Returns the index entries of a log as a structured array with the
+    fields 'time' and 'offset' (empty if there is no index). A partially
+    written trailing entry is ignored. """
+    filename = index_name(logfile)
+    if not os.path.exists(filename):
+        return np.zeros(0,dtype=_ENTRY)
+    with open(filename,'rb') as f:
+        data = f.read()
+    n = len(data)//_ENTRY.itemsize
+    return np.frombuffer(data[:n*_ENTRY.itemsize],dtype=_ENTRY)
+
+
+def _timestamps(data,offsets):
+    """ Parses the timestamps of the lines starting at 'offsets' in 'data'.
+    Returns (times [ns], valid [bool]). """
+    fields = []
+    for o in offsets:
+        end = data.find(b",",o,o+40)
+        fields.append(data[o:end] if end >= 0 else b"")
+    valid = np.array([len(x) >= 19 for x in fields],dtype=bool)
+    times = np.zeros(len(fields),dtype=np.int64)
+    if valid.any():
+        times[valid] = Logreader.parse_timestamps(\
+            [x for x,ok in zip(fields,valid) if ok])
+    return times,valid
+
+
+class LineIndex():
+    """ Extends the index of a text log while the log is written. """
+
+    def __init__(self,logfile,every=EVERY):
+        self.logfile = logfile
+        self.filename = index_name(logfile)
+        self.every = every
+        # lines since the last index entry (None: unknown) and end of the
+        # indexed part of the log
+        self._lines = None
+        self._end = 0
+
+    def _valid(self,entries):
+        """ Checks that the last index entry points to a line with its
+        timestamp (i.e. the log was not rewritten). """
+        if len(entries) == 0:
+            return True
+        t,offset = entries[-1]
+        if offset >= os.path.getsize(self.logfile):
+            return False
+        with open(self.logfile,'rb') as f:
+            f.seek(offset)
+            line = f.readline()
+        times,valid = _timestamps(line,[0])
+        return bool(valid[0]) and times[0] == t
+
+    def catch_up(self):
+        """ Indexes the lines of the log that are not yet in the index,
+        rebuilding the index if it does not match the log. """
+        if not os.path.exists(self.logfile):
+            self._lines = None
+            self._end = 0
+            return
+        entries = read_index(self.logfile)
+        if not self._valid(entries):
+            entries = entries[:0]
+        start = int(entries[-1]['offset']) if len(entries) else 0
+        with open(self.logfile,'rb') as f:
+            f.seek(start)
+            data = f.read()
+        data = data[:data.rfind(b"\n")+1]
+        # offsets of all complete lines from the last indexed one on, which
+        # is already in the index
+        ends = np.flatnonzero(np.frombuffer(data,dtype=np.uint8) == 10)+1
+        offsets = np.concatenate(([0],ends[:-1])) if len(ends) \
+                  else np.zeros(0,dtype=np.int64)
+        first = self.every if len(entries) else 0
+        sel = np.arange(first,len(offsets),self.every)
+        times,valid = _timestamps(data,offsets[sel])
+        new = np.zeros(int(valid.sum()),dtype=_ENTRY)
+        new['time'] = times[valid]
+        new['offset'] = start + offsets[sel][valid]
+        with open(self.filename,'ab' if len(entries) else 'wb') as f:
+            if len(entries):
+                # drop a partially written entry
+                f.truncate(len(entries)*_ENTRY.itemsize)
+            f.write(new.tobytes())
+        # lines since the last index entry
+        if len(sel):
+            self._lines = len(offsets) - int(sel[-1])
+        else:
+            self._lines = len(offsets) if len(entries) else 0
+        self._end = start + len(data)
+
+    def add(self,t,offset,length):
+        """ Registers a line of 'length' bytes with timestamp 't' (ns) that
+        is written to the log at byte 'offset'. """
+        if self._lines is None or offset != self._end:
+            self.catch_up()
+        if self._lines is None:
+            self._lines = 0
+        if self._lines == 0 or self._lines >= self.every:
+            entry = np.array([(t,offset)],dtype=_ENTRY)
+            with open(self.filename,'ab') as f:
+                f.write(entry.tobytes())
+            self._lines = 0
+        self._lines += 1
+        self._end = offset + length
+
+
+def build_index(logfile,every=EVERY):
+    """ (Re)builds the index of a log from scratch. Returns the number of
+    entries. """
+    filename = index_name(logfile)
+    if os.path.exists(filename):
+        os.remove(filename)
+    LineIndex(logfile,every).catch_up()
+    return len(read_index(logfile))
+
+def read_range(logfile,start=None,end=None):
+    """ Reads the lines of a log with start <= time < end (ns; None: no
+    limit), using the index to read only the bytes around the window.
+    Returns (times [int64 ns], values [float32], triggers [bool]) like
+    Logreader.read_log. Without a (usable) index, the whole log is read. """
+    entries = read_index(logfile)
+    lo = 0
+    hi = None
+    if len(entries) > 0 and np.all(np.diff(entries['time']) >= 0):
+        if start is not None:
+            # last indexed line before the window
+            i = np.searchsorted(entries['time'],start,side='left') - 1
+            if i >= 0:
+                lo = int(entries['offset'][i])
+        if end is not None:
+            # first indexed line at or after the end of the window
+            i = np.searchsorted(entries['time'],end,side='left')
+            if i < len(entries):
+                hi = int(entries['offset'][i])
+    with open(logfile,'rb') as f:
+        f.seek(lo)
+        data = f.read() if hi is None else f.read(hi-lo)
+    times,values,triggers = Logreader.parse_lines(data)
+    sel = np.ones(len(times),dtype=bool)
+    if start is not None:
+        sel &= times >= start
+    if end is not None:
+        sel &= times < end
+    if sel.all():
+        return times,values,triggers
+    return times[sel],values[sel],triggers[sel]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=\
+        "Builds the time indexes of pyKraken text logs.")
+    parser.add_argument('logs',nargs='+',help="log files")
+    parser.add_argument('--every',type=int,default=EVERY,\
+                        help="index every N-th line (default: {})"\
+                        .format(EVERY))
+    args = parser.parse_args()
+    for logfile in args.logs:
+        n = build_index(logfile,args.every)
+        print("{} > {} ({} entries)".format(logfile,index_name(logfile),n))
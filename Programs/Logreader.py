@@ -0,0 +1,333 @@
+# Fast reader for the pyKraken text logs
+#
+#   The logs have the fixed layout
+#       YYYY MM DD HH:MM:SS.ffffff,value,value,...,trigger
+#   so instead of letting pandas guess the timestamp format line by line, the
+#   lines and columns are found with vectorized byte operations, the numbers
+#   are read by the C parser of pandas (numpy's, if pandas is missing) as
+#   float32 and the timestamps are decoded with byte arithmetic into int64 ns (local wall-clock
+#   time since 1970-01-01, as in Binlog.py). The digits after the dot are the
+#   microseconds written by the logger.
+#
+#   LogTail follows a log that is being written: every read() returns only
+#   the complete lines appended since the last call. It remembers the byte
+#   offset, the inode and a checksum of the first bytes of the file, so that
+#   rotated, truncated or rewritten files are read again from the start.
+#
+#   Compare with the pandas path on a synthetic day of data with
+#       python3 Logreader.py [lines]
+#
+import numpy as np
+import tempfile
+import io
+import time
+import sys
+import zlib
+import os
+import Spool
+try:
+    import pandas as pd
+except ImportError:
+    # numpy's parser is used instead
+    pd = None
+
+# byte positions of the timestamp fields
+_FIELDS = {'year':(0,4),'month':(5,7),'day':(8,10),\
+           'hour':(11,13),'minute':(14,16),'second':(17,19)}
+_FRAC = 20
+
+
+def _number(digits,start,stop):
+    """ Decimal value of the digit columns [start, stop). """
+    out = np.zeros(digits.shape[0],dtype=np.int64)
+    for i in range(start,stop):
+        out = out*10 + digits[:,i]
+    return out
+
+def days_from_civil(y,m,d):
+    """ Days since 1970-01-01 for (proleptic Gregorian) dates given as
+    integer arrays. """
+    y = y - (m <= 2)
+    era = np.floor_divide(y,400)
+    yoe = y - era*400
+    doy = (153*(m + np.where(m > 2,-3,9)) + 2)//5 + d - 1
+    doe = yoe*365 + yoe//4 - yoe//100 + doy
+    return era*146097 + doe - 719468
+
+def parse_timestamp_bytes(raw,length=None):
+    """ Converts timestamps given as a uint8 matrix (one timestamp per row)
+    to int64 ns. 'length' gives the length of every timestamp (default: up
+    to the first non-digit after the dot). """
+    n = raw.shape[0]
+    if n == 0:
+        return np.zeros(0,dtype=np.int64)
+    assert raw.shape[1] >= _FRAC-1,"Unexpected timestamp format!"
+    if length is not None and raw.shape[1] >= _FRAC+6 \
+       and (length == _FRAC+6).all():
+        return _parse_us_timestamps(raw)
+    digits = raw[:,:_FRAC-1].astype(np.int64) - 48
+    f = {}
+    for key in _FIELDS:
+        f[key] = _number(digits,*_FIELDS[key])
+    days = days_from_civil(f['year'],f['month'],f['day'])
+    seconds = days*86400 + f['hour']*3600 + f['minute']*60 + f['second']
+    # fractional part: the microseconds as an integer of variable length
+    us = np.zeros(n,dtype=np.int64)
+    if raw.shape[1] > _FRAC:
+        frac = raw[:,_FRAC:].astype(np.int64) - 48
+        if length is None:
+            valid = np.cumprod((frac >= 0) & (frac <= 9),axis=1) > 0
+        else:
+            valid = np.arange(frac.shape[1]) < (length - _FRAC)[:,None]
+        for i in range(0,frac.shape[1]):
+            us = np.where(valid[:,i],us*10 + frac[:,i],us)
+    return (seconds*1000000 + us)*1000
+
+def _parse_us_timestamps(raw):
+    """ Fast path of parse_timestamp_bytes for the logger's format (six
+    digits after the dot): the fields are dot products of the digits, the
+    date is converted once if all rows share it (one log per day). """
+    digits = raw[:,11:_FRAC+6].astype(np.int32) - 48
+    seconds = digits[:,:8] @ np.array([36000,3600,0,600,60,0,10,1],\
+                                      dtype=np.int32)
+    us = digits[:,9:] @ np.array([100000,10000,1000,100,10,1],dtype=np.int32)
+    date = raw[:,:10]
+    if (date == date[0]).all():
+        date = date[:1]
+    date = date.astype(np.int64) - 48
+    days = days_from_civil(date[:,0:4] @ [1000,100,10,1],\
+                           date[:,5:7] @ [10,1],date[:,8:10] @ [10,1])
+    return ((days*86400 + seconds)*1000000 + us)*1000
+
+def parse_timestamps(ts):
+    """ Converts an array of timestamp strings (bytes) to int64 ns. """
+    ts = np.ascontiguousarray(np.asarray(ts,dtype='S'))
+    if len(ts) == 0:
+        return np.zeros(0,dtype=np.int64)
+    raw = np.frombuffer(ts.tobytes(),dtype=np.uint8)\
+          .reshape(len(ts),ts.dtype.itemsize)
+    return parse_timestamp_bytes(raw)
+
+def _empty():
+    return np.zeros(0,dtype=np.int64),np.zeros((0,0),dtype=np.float32),\
+           np.zeros(0,dtype=bool)
+
+def _read_numbers(text,ncol):
+    """ Reads columns 1 ... ncol-1 of clean log lines as float32, with the C
+    parser of pandas if available (faster than numpy's). """
+    if pd is not None:
+        return pd.read_csv(io.BytesIO(text),header=None,engine='c',\
+                           usecols=range(1,ncol),dtype=np.float32).values
+    return np.loadtxt(io.BytesIO(text),delimiter=",",ndmin=2,\
+                      usecols=range(1,ncol),dtype=np.float32)
+
+def _good_lines(text,buf,starts,ends):
+    """ Selects the complete lines with as many columns as the first
+    complete line. Returns (text, buffer, line starts, timestamp lengths,
+    columns) of these lines, or None. """
+    commas = np.flatnonzero(buf == 44)
+    if len(commas) == 0:
+        return None
+    first = np.searchsorted(commas,starts)
+    ncommas = np.searchsorted(commas,ends) - first
+    # the timestamp reaches up to the first comma; shorter ones are e.g. the
+    # rest of a line cut by 'offset'
+    length = commas[np.minimum(first,len(commas)-1)] - starts
+    complete = (ncommas > 0) & (length >= _FRAC-1)
+    if not complete.any():
+        return None
+    ncol = int(ncommas[np.argmax(complete)]) + 1
+    if ncol < 3:
+        return None
+    ok = complete & (ncommas == ncol-1)
+    starts,ends,length = starts[ok],ends[ok],length[ok]
+    text = b"\n".join([text[a:e].rstrip(b"\r") \
+                       for a,e in zip(starts,ends)]) + b"\n"
+    buf = np.frombuffer(text,dtype=np.uint8)
+    starts = np.concatenate(([0],np.flatnonzero(buf == 10)[:-1]+1))
+    return text,buf,starts,length,ncol
+
+def parse_lines(data):
+    """ Parses log lines (bytes). Incomplete trailing lines and lines with a
+    different number of columns than the first complete line are skipped.
+    Returns (times [int64 ns], values [float32, lines x channels], triggers
+    [bool]). """
+    text = data[:data.rfind(b"\n")+1]
+    if not text:
+        return _empty()
+    buf = np.frombuffer(text,dtype=np.uint8)
+    ends = np.flatnonzero(buf == 10)
+    starts = np.concatenate(([0],ends[:-1]+1))
+    # fast path: all lines have the columns of the first one, which is
+    # complete; the timestamp ends at the first comma of every line
+    table = None
+    head = None
+    ncol = text[:ends[0]].count(b",") + 1
+    if ncol >= 3 and pd is not None and b"\r" not in text \
+       and np.count_nonzero(buf == 44) == len(starts)*(ncol-1):
+        index = starts[:,None] + np.arange(_FRAC+7)
+        index[-1] = np.minimum(index[-1],len(buf)-1)
+        head = buf[index]
+        length = np.argmax(head == 44,axis=1)
+        if (length >= _FRAC-1).all():
+            head = head[:,:_FRAC+6]
+            try:
+                table = _read_numbers(text,ncol)
+            except ValueError:
+                table = None
+            # a short line (and a long one to match the comma count)
+            if table is not None and (len(table) != len(starts) \
+                                      or np.isnan(table[:,-1]).any()):
+                table = None
+    if table is None:
+        good = _good_lines(text,buf,starts,ends)
+        if good is None:
+            return _empty()
+        text,buf,starts,length,ncol = good
+        table = _read_numbers(text,ncol)
+        # timestamps: fixed byte positions from the start of each line
+        width = min(int(length.max()),_FRAC+6)
+        head = buf[starts[:,None] + np.arange(width)]
+    times = parse_timestamp_bytes(head,length)
+    return times,table[:,:-1],table[:,-1] != 0
+
+def read_log(filename,offset=0):
+    """ Reads a pyKraken text log, starting at byte 'offset'. Returns (times
+    [int64 ns], values [float32, lines x channels], triggers [bool]). """
+    with open(filename,'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    return parse_lines(data)
+
+def ns2datetimes(times):
+    """ Converts int64 ns (as returned by read_log) to a list of datetime
+    objects. """
+    return np.asarray(times,dtype=np.int64).view('datetime64[ns]')\
+           .astype('datetime64[us]').tolist()
+
+
+class LogTail():
+    """ Incremental reader of a growing log file. """
+
+    def __init__(self,filename):
+        self.filename = filename
+        self.offset = 0
+        self.inode = None
+        self.head = 0
+        self.head_len = 0
+        # True if the last read() started over at the beginning of the file
+        self.reset = False
+        self.resets = 0
+
+    def _changed(self,f,st):
+        """ Checks whether the open file 'f' is no longer the file read so
+        far (other inode, shorter, or different first bytes). """
+        if self.inode is None:
+            return False
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            return True
+        if self.head_len > 0:
+            f.seek(0)
+            return (zlib.crc32(f.read(self.head_len)) & 0xffffffff) != self.head
+        return False
+
+    def read(self):
+        """ Returns (times [int64 ns], values [float32], triggers [bool]) of
+        the complete lines appended since the last call. If the file was
+        rotated, truncated or rewritten, all its lines are returned and
+        'reset' is set. A missing file yields no lines. """
+        self.reset = False
+        try:
+            f = open(self.filename,'rb')
+        except (IOError,OSError):
+            return parse_lines(b"")
+        with f:
+            st = os.fstat(f.fileno())
+            if self._changed(f,st):
+                self.offset = 0
+                self.head = 0
+                self.head_len = 0
+                self.reset = True
+                self.resets += 1
+            self.inode = st.st_ino
+            f.seek(self.offset)
+            data = f.read()
+            data = data[:data.rfind(b"\n")+1]
+            self.offset += len(data)
+            if self.head_len < Spool.HEAD_BYTES and self.offset > 0:
+                self.head_len = min(Spool.HEAD_BYTES,self.offset)
+                f.seek(0)
+                self.head = zlib.crc32(f.read(self.head_len)) & 0xffffffff
+        return parse_lines(data)
+
+
+# --- benchmark against the pandas path used by the Plotter
+
+def synthetic_day(filename,lines=864000,nchannels=12,start=None):
+    """ Writes a synthetic log with 'lines' samples spread over one day. """
+    import datetime
+    if start is None:
+        start = datetime.datetime(2020,4,13)
+    step = 86400.0/lines
+    rng = np.random.default_rng(0)
+    values = 20 + rng.random((lines,nchannels))
+    with open(filename,'w') as f:
+        for i in range(0,lines):
+            now = start + datetime.timedelta(seconds=i*step)
+            f.write("{:04} {:02} {:02} {:02}:{:02}:{:02}.{:06},".format(\
+                now.year,now.month,now.day,now.hour,now.minute,now.second,\
+                now.microsecond) \
+                + ",".join(["{:.4f}".format(v) for v in values[i]]) \
+                + ",{}\n".format(i%2))
+
+def read_pandas(filename):
+    """ The pandas path of the Plotter: read_csv and to_datetime without a
+    format. """
+    import pandas as pd
+    data = pd.read_csv(filename,header=None)
+    times = pd.to_datetime(data.iloc[:,0])
+    return times,data.iloc[:,1:-1].values,data.iloc[:,-1].values
+
+def benchmark(lines=864000,nchannels=12,repeat=3):
+    """ Times read_log and the pandas path on a synthetic day of data.
+    Returns a dictionary with the best times in s. """
+    out = {'lines':lines,'channels':nchannels}
+    fd,filename = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        synthetic_day(filename,lines,nchannels)
+        out['bytes'] = os.path.getsize(filename)
+        best = None
+        for i in range(0,repeat):
+            start = time.perf_counter()
+            times,values,triggers = read_log(filename)
+            dt = time.perf_counter() - start
+            best = dt if best is None else min(best,dt)
+        out['read_log'] = best
+        try:
+            best = None
+            for i in range(0,repeat):
+                start = time.perf_counter()
+                p_times,p_values,p_triggers = read_pandas(filename)
+                dt = time.perf_counter() - start
+                best = dt if best is None else min(best,dt)
+            out['pandas'] = best
+            # both paths have to agree
+            assert np.array_equal(times,p_times.values\
+                                  .astype('datetime64[ns]').astype(np.int64))
+            assert np.allclose(values,p_values,atol=1e-4)
+        except ImportError:
+            out['pandas'] = None
+    finally:
+        os.remove(filename)
+    return out
+
+
+if __name__ == "__main__":
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 864000
+    res = benchmark(lines)
+    print("{lines} lines, {bytes} bytes".format(**res))
+    print("read_log: {:.3f} s".format(res['read_log']))
+    if res['pandas'] is not None:
+        print("pandas:   {:.3f} s ({:.1f}x)".format(res['pandas'],\
+              res['pandas']/res['read_log']))
@@ -0,0 +1,209 @@
+# Timing of the measurement loop: stage profile and cadence
+#
+#   A StageTimer collects the durations of named stages (e.g. 'acquire',
+#   'format', 'append') and keeps the last 'window' durations of every
+#   stage, from which summary() computes rolling percentiles. A stage is
+#   timed by passing the start time to lap(), which returns the end time,
+#   i.e. the start of the next stage:
+#       t = time.perf_counter()
+#       ...                               # stage 'format'
+#       t = timer.lap('format',t)
+#       ...                               # stage 'print'
+#       t = timer.lap('print',t)
+#   Callers keep the timer None when profiling is off, so a disabled
+#   profile costs one comparison per stage. Durations may be added from
+#   several threads.
+#   write() saves the summary as a small JSON file (replaced atomically),
+#   for example every few minutes when due() says so.
+#
+#   A CadenceMonitor follows a periodic loop: for every sweep it gets the
+#   intended and the actual start time and the duration, and keeps
+#   histograms of the lateness and the duration. A sweep that ends after
+#   the next deadline (lateness + duration > period) is an overrun, i.e. it
+#   delays the next one; 'overrun_limit' overruns in a row start a sustained
+#   overrun, which lasts until a sweep ends in time again.
+#
+from collections import deque
+import numpy as np
+import bisect
+import time
+import json
+import os
+
+PERCENTILES = (50,90,99)
+# upper edges (s) of the histogram bins; the last bin is open
+BINS = (0.0005,0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.0,2.0,5.0)
+
+
+def write_json(filename,out):
+    """ Writes a dictionary to a JSON file, replacing it atomically. """
+    temp = filename + ".tmp"
+    with open(temp,'w') as f:
+        json.dump(out,f,indent=1)
+    os.replace(temp,filename)
+
+def _local(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(t))
+
+
+class StageTimer():
+    """ Rolling durations of named stages. 'stages' fixes the order of the
+    stages in the summary (others are appended as they occur), 'period' is
+    the time in s between two writes of the summary. """
+
+    def __init__(self,stages=(),window=1000,period=300.0):
+        self.window = window
+        self.period = period
+        self._durations = {}
+        self._counts = {}
+        self._totals = {}
+        self._max = {}
+        for stage in stages:
+            self._add_stage(stage)
+        self.started = time.time()
+        self.last_write = time.monotonic()
+
+    def _add_stage(self,stage):
+        self._durations[stage] = deque(maxlen=self.window)
+        self._counts[stage] = 0
+        self._totals[stage] = 0.0
+        self._max[stage] = 0.0
+
+    def add(self,stage,duration):
+        """ Records a duration (s) of a stage. """
+        if stage not in self._durations:
+            self._add_stage(stage)
+        self._durations[stage].append(duration)
+        self._counts[stage] += 1
+        self._totals[stage] += duration
+        if duration > self._max[stage]:
+            self._max[stage] = duration
+
+    def lap(self,stage,start):
+        """ Records the time since 'start' (time.perf_counter) for a stage
+        and returns the current time. """
+        now = time.perf_counter()
+        self.add(stage,now-start)
+        return now
+
+    def summary(self):
+        """ Returns a dictionary with the statistics of every stage in ms:
+        percentiles, mean and maximum of the last 'window' durations, and
+        count, total and maximum since the start. """
+        stages = {}
+        for stage in list(self._durations):
+            d = np.array(self._durations[stage],dtype=np.float64)*1e3
+            entry = {'count':self._counts[stage],\
+                     'total_s':round(self._totals[stage],3),\
+                     'max_ever_ms':round(self._max[stage]*1e3,3),\
+                     'window':len(d)}
+            if len(d) > 0:
+                entry['mean_ms'] = round(float(d.mean()),3)
+                for p,v in zip(PERCENTILES,np.percentile(d,PERCENTILES)):
+                    entry['p{}_ms'.format(p)] = round(float(v),3)
+                entry['max_ms'] = round(float(d.max()),3)
+            stages[stage] = entry
+        return {'time':_local(time.time()),'since':_local(self.started),\
+                'stages':stages}
+
+    def due(self):
+        """ True if 'period' has passed since the last write. """
+        return time.monotonic() - self.last_write >= self.period
+
+    def write(self,filename,extra=None):
+        """ Saves the summary (and the dictionary 'extra') to 'filename'.
+        Returns the summary. """
+        self.last_write = time.monotonic()
+        out = self.summary()
+        if extra:
+            out.update(extra)
+        write_json(filename,out)
+        return out
+
+
+class CadenceMonitor():
+    """ Lateness and duration of the sweeps of a loop with the given
+    'period' (s). """
+
+    def __init__(self,period,overrun_limit=10,bins=BINS):
+        self.period = period
+        self.overrun_limit = overrun_limit
+        self.bins = tuple(bins)
+        self.late_hist = [0]*(len(self.bins)+1)
+        self.duration_hist = [0]*(len(self.bins)+1)
+        self.sweeps = 0
+        self.late_sum = 0.0
+        self.late_max = 0.0
+        self.duration_sum = 0.0
+        self.duration_max = 0.0
+        self.missed = 0                 # sweeps that ended after the deadline
+        self.streak = 0                 # overruns in a row
+        self.longest_streak = 0
+        self.overrun = False            # in a sustained overrun
+        self.overrun_since = None
+        self.overruns = 0               # sustained overruns so far
+        self.flag = False               # overrun since the last pop_flag()
+        self.last = None                # (intended, actual, duration)
+
+    def add(self,intended,actual,duration=0.0):
+        """ Records a sweep that should have started at 'intended', started
+        at 'actual' (s) and took 'duration' (s). Returns 'start' or 'end'
+        when a sustained overrun starts or ends, else None. """
+        late = actual - intended
+        if late < 0.0:
+            late = 0.0
+        self.last = (intended,actual,duration)
+        self.sweeps += 1
+        self.late_hist[bisect.bisect_left(self.bins,late)] += 1
+        self.duration_hist[bisect.bisect_left(self.bins,duration)] += 1
+        self.late_sum += late
+        self.duration_sum += duration
+        if late > self.late_max:
+            self.late_max = late
+        if duration > self.duration_max:
+            self.duration_max = duration
+        # period 0: as fast as possible, never late
+        if late + duration <= self.period or self.period <= 0:
+            self.streak = 0
+            if self.overrun:
+                self.overrun = False
+                return 'end'
+            return None
+        self.missed += 1
+        self.streak += 1
+        if self.streak > self.longest_streak:
+            self.longest_streak = self.streak
+        if self.overrun:
+            self.flag = True
+        elif self.streak >= self.overrun_limit:
+            self.overrun = True
+            self.overrun_since = intended
+            self.overruns += 1
+            self.flag = True
+            return 'start'
+        return None
+
+    def pop_flag(self):
+        """ True if the loop was in a sustained overrun since the last call. """
+        flag = self.flag
+        self.flag = self.overrun
+        return flag
+
+    def summary(self):
+        """ Returns the histograms (counts per bin, upper bin edges in ms)
+        and statistics in ms as a dictionary. """
+        n = max(self.sweeps,1)
+        return {'period_ms':round(self.period*1e3,3),'sweeps':self.sweeps,\
+                'bins_ms':[round(b*1e3,3) for b in self.bins],\
+                'late_hist':list(self.late_hist),\
+                'duration_hist':list(self.duration_hist),\
+                'late_mean_ms':round(self.late_sum/n*1e3,3),\
+                'late_max_ms':round(self.late_max*1e3,3),\
+                'duration_mean_ms':round(self.duration_sum/n*1e3,3),\
+                'duration_max_ms':round(self.duration_max*1e3,3),\
+                'missed':self.missed,\
+                'missed_fraction':round(self.missed/n,6),\
+                'longest_streak':self.longest_streak,\
+                'overruns':self.overruns,'overrun':self.overrun,\
+                'overrun_since':None if self.overrun_since is None \
+                                else _local(self.overrun_since)}
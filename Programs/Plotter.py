@@ -1,17 +1,84 @@
 import time
-from Autoplot_Lists import Plotobject
-import pandas as pd
+import matplotlib
+import matplotlib.dates as mdates
+import multiprocessing
+import numpy as np
+import Trigger
+import History
+import Ringbuffer
+import Sharedmem
 import RPi.GPIO as gpio
+import sys
+
+# integers shared with the render process besides the data windows
+SNAPSHOT_META = ('slow_count','slow_channels','fast_count','fast_channels',\
+                 'triggers','stop','rendered','dropped','render_us')
+
+
+def render_process(snapshot,settings):
+    """ Draws the newest state of the shared snapshot, in its own process.
+    States published while a frame is drawn are skipped (only the newest
+    one is drawn) and counted as dropped frames. """
+    # headless: render image files with Agg (before the figures exist)
+    if settings['headless']:
+        matplotlib.use('Agg')
+    from Autoplot_Lists import Plotobject
+    plotobj = Plotobject(headless=settings['headless'],\
+                         image_path=settings['image_path'],\
+                         image_formats=settings['image_formats'],\
+                         plotframe=settings['plot_rows'],\
+                         cycle_t=settings['cycle_rows'])
+    last = 0
+    triggers = 0
+    rendered = 0
+    dropped = 0
+    while True:
+        if not snapshot.wait(timeout=0.1):
+            plotobj.process_events()
+            continue
+        seq,arrays,meta = snapshot.read()
+        if meta['stop']:
+            break
+        if seq == last:
+            continue
+        dropped += seq - last - 1
+        last = seq
+        received_trigger = meta['triggers'] != triggers
+        triggers = meta['triggers']
+        try:
+            plotobj.show_snapshot(received_trigger,\
+                (arrays['slow_t'],arrays['slow'][:,:meta['slow_channels']],\
+                 meta['slow_count']),\
+                (arrays['fast_t'],arrays['fast'][:,:meta['fast_channels']],\
+                 meta['fast_count']))
+        except Exception as e:
+            print("Plotting failed: {}".format(e))
+            continue
+        rendered += 1
+        snapshot.set_meta(rendered=rendered,dropped=dropped,\
+                          render_us=int(plotobj.render_times[-1]*1e6))
+    snapshot.close()
+
 
 class Plotter():
     
     _default = {\
         'path':"/home/pi/YDrive/share/Pi_Monitoring/Logs/",\
-        'filemask_fast':"DataLog_Fast.txt",\
-        'filemask_slow':"DataLog_Slow_{2:04}-{1:02}-{0:02}.txt",\
+        'filemask_fast':"Datalog_Fast.txt",\
+        'filemask_slow':"Datalog_Slow_{2:04}-{1:02}-{0:02}.txt",\
+        'filemask_bin':"Datalog_Slow_{2:04}-{1:02}-{0:02}.bin",\
+        'cache_path':None,\
         'trigger_pin':16,\
         'trigger_enable':True,\
         'plot_period':30*1000,\
+        'headless':False,\
+        'image_path':None,\
+        'image_formats':("png",),\
+        'plot_rows':int(24*60*60/30),\
+        'cycle_rows':int(1.25*60/0.25),\
+        'max_channels':32,\
+        'status_every':20,\
+        'shm_name':None,\
         }
 
     def __init__(self,**kwargs):
@@ -23,61 +90,150 @@ class Plotter():
                    "Unknown keyword '{}!'".format(kw)
             setattr(self,kw,kwargs[kw])
 
+    def settings(self):
+        """ Settings of the render process. """
+        image_path = self.image_path
+        if image_path is None:
+            image_path = self.path + "Plots/"
+        return {'headless':self.headless,'image_path':image_path,\
+                'image_formats':tuple(self.image_formats),\
+                'plot_rows':self.plot_rows,'cycle_rows':self.cycle_rows}
+
+    def create_snapshot(self,ctx):
+        """ Shared memory for the data windows handed to the renderer. """
+        fields = {'slow_t':((self.plot_rows,),'f8'),\
+                  'slow':((self.plot_rows,self.max_channels),'f8'),\
+                  'fast_t':((self.cycle_rows,),'f8'),\
+                  'fast':((self.cycle_rows,self.max_channels),'f8')}
+        return Sharedmem.SharedSnapshot(fields,meta=SNAPSHOT_META,ctx=ctx)
+
+    def start_renderer(self,ctx,snapshot):
+        renderer = ctx.Process(target=render_process,\
+                               args=(snapshot,self.settings()),\
+                               name="Plotter-render",daemon=True)
+        renderer.start()
+        return renderer
+
+    def append_rows(self,buffer,capacity,times,values):
+        """ Appends rows (times in ns) to a window of the plot data, as
+        date numbers. The window is recreated if the channels change. """
+        if len(times) == 0:
+            return buffer
+        values = np.asarray(values)[:,:self.max_channels]
+        if buffer is None or buffer.nchannels != values.shape[1]:
+            buffer = Ringbuffer.RingBuffer(capacity,values.shape[1])
+        buffer.extend(mdates.date2num(times.astype('datetime64[ns]')),values)
+        return buffer
+
+    def status(self,snapshot):
+        """ Returns the frame counters of the render process. """
+        meta = snapshot.get_meta()
+        return {'published':snapshot.seq,'rendered':meta['rendered'],\
+                'dropped':meta['dropped'],'render_ms':meta['render_us']/1000}
+
     def Start_Plotting(self):
-        plotobj = Plotobject()
-        previous_index = 0
-        previous_time = time.localtime()
+        # data files and triggers are read here, the figures are drawn by a
+        # separate process, so a slow refresh delays neither; the newest data
+        # windows are handed over in shared memory
+        ctx = multiprocessing.get_context('spawn')
+        snapshot = self.create_snapshot(ctx)
+        renderer = self.start_renderer(ctx,snapshot)
         received_trigger = False
-        while True:
-            if self.trigger_enable:
-                res = gpio.wait_for_edge(self.trigger_pin,\
-                                         gpio.RISING,\
-                                         timeout=self.plot_period)
-                if res == None:
-                    received_trigger = False
+        # edges are recorded by a GPIO callback, so triggers arriving while
+        # reading are not missed
+        trigger = None
+        rising = 0
+        if self.trigger_enable:
+            trigger = Trigger.TriggerMonitor(self.trigger_pin)
+            trigger.start()
+            rising = trigger.rising
+        # the history stores read only the lines appended since the last
+        # refresh; samples that are not newer than the plotted ones (e.g.
+        # after a rewrite of the fast file) are skipped
+        store_fast = History.HistoryStore(self.path,\
+            filemask=self.filemask_fast,filemask_bin=None,\
+            cache_dir=self.cache_path)
+        store_slow = History.HistoryStore(self.path,\
+            filemask=self.filemask_slow,filemask_bin=self.filemask_bin,\
+            cache_dir=self.cache_path)
+        # the DataLogger on this Pi hands its samples over in shared memory;
+        # without it, the fast log file is read
+        reader = None
+        if self.shm_name is not None:
+            reader = Sharedmem.SampleReader(self.shm_name)
+        last_fast = None
+        last_slow = None
+        slow = None
+        fast = None
+        triggers = 0
+        try:
+            while True:
+                if trigger is not None:
+                    res = trigger.wait_rising(timeout=self.plot_period/1000.0,\
+                                              since=rising)
+                    if res == None:
+                        received_trigger = False
+                    else:
+                        received_trigger = True
+                        rising = res
                 else:
-                    received_trigger = True
-            else:
-                time.sleep(self.plot_period)
-                received_trigger = False
-                
-            now = time.localtime()
-            #Reconsider this indexing stuff. For 'fast' datafiles, read the whole file.
-            if now.tm_mday != previous_time.tm_mday:
-                previous_index = 0
-                
-            outfile_fast = self.path + self.filemask_fast.\
-                format(now.tm_mday,now.tm_mon,now.tm_year)
-            outfile_slow = self.path + self.filemask_slow.\
-                format(now.tm_mday,now.tm_mon,now.tm_year)
-            try:
-                data_fast = pd.read_csv(outfile_fast,
-                                        header = None)
-                data_slow = pd.read_csv(outfile_slow,
-                                        header = None)
-                
-                #Is splitting into 3 really necessary? Could this be two lines?
-                times_fast = pd.to_datetime(data_fast.iloc[:,0]).tolist()
-                times_slow = pd.to_datetime(data_slow.iloc[previous_index::,0]).tolist()
-                measurements_fast = data_fast.iloc[:,1:-1].values.tolist()
-                measurements_slow = data_slow.iloc[previous_index::,1:-1].values.tolist()
-                triggers_fast = data_fast.iloc[:,-1].values.tolist()
-                triggers_slow = data_fast.iloc[previous_index::,-1].values.tolist()
-                
-                previous_index = previous_index + len(times_slow)
-                previous_time = now
+                    time.sleep(self.plot_period/1000.0)
+                    received_trigger = False
+                if received_trigger:
+                    triggers += 1
+
+                try:
+                    # the first refresh plots all of today
+                    if reader is not None and reader.attach():
+                        times_fast,measurements_fast,flags_fast = reader.read()
+                        if last_fast is not None:
+                            new = times_fast > last_fast
+                            times_fast = times_fast[new]
+                            measurements_fast = measurements_fast[new]
+                    else:
+                        times_fast,measurements_fast,flags_fast = \
+                            store_fast.query(\
+                            None if last_fast is None else last_fast+1)
+                    times_slow,measurements_slow,flags_slow = store_slow.query(\
+                        None if last_slow is None else last_slow+1)
+                    if len(times_fast) > 0:
+                        last_fast = times_fast[-1]
+                    if len(times_slow) > 0:
+                        last_slow = times_slow[-1]
+                    slow = self.append_rows(slow,self.plot_rows,\
+                                            times_slow,measurements_slow)
+                    fast = self.append_rows(fast,self.cycle_rows,\
+                                            times_fast,measurements_fast)
+                    arrays = {}
+                    meta = {'triggers':triggers}
+                    for name,buffer in (('slow',slow),('fast',fast)):
+                        if buffer is None:
+                            continue
+                        arrays[name + '_t'],arrays[name] = buffer.view()
+                        meta[name + '_count'] = buffer.count
+                        meta[name + '_channels'] = buffer.nchannels
+                    snapshot.publish(arrays,**meta)
+                except Exception as e:
+                    print("Plotter: reading the logs failed: {!r}".format(e))
+                    continue
+                if not renderer.is_alive():
+                    print("Render process stopped (exit code {}), restarting"\
+                          .format(renderer.exitcode))
+                    renderer = self.start_renderer(ctx,snapshot)
+                if self.status_every and snapshot.seq % self.status_every == 0:
+                    print("Plotter: {published} updates, {rendered} frames, "\
+                          "{dropped} dropped, last frame {render_ms:.0f} ms"\
+                          .format(**self.status(snapshot)))
+        finally:
+            snapshot.publish({},stop=1)
+            renderer.join(timeout=5)
+            snapshot.close()
 
-                # This is fine. Just add the data, have the deques sort out what to plot. 
-                # For the 'slow' data, append to the deque.
-                # For the 'fast' data, only plot if triggered?
-                plotobj.add_plot_data(received_trigger, times_fast, measurements_fast, triggers_fast,\
-                                      times_slow, measurements_slow, triggers_slow)
-            except:
-                continue
-                #Do nothing
-        
 if __name__ == "__main__":
     gpio.setmode(gpio.BCM)
     gpio.setup(16,gpio.IN)
-    Plot_Instance = Plotter()
+    # 'python3 Plotter.py headless' writes the figures to Logs/Plots/ instead
+    headless = len(sys.argv) > 1 and sys.argv[1] == "headless"
+    Plot_Instance = Plotter(headless=headless,image_formats=("png","svg"),\
+                            shm_name="pykraken")
     Plot_Instance.Start_Plotting()
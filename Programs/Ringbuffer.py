@@ -0,0 +1,76 @@
+# Column-oriented ring buffer for plotting
+#
+#   Holds the last 'capacity' rows of a stream as a time column and a data
+#   array (rows x channels). Every row is written twice, at position i and
+#   i+capacity of a buffer of twice the size, so the last n rows are always
+#   one contiguous slice: view(n) returns numpy views without copying, and
+#   appending costs the same however full the buffer is.
+#
+import numpy as np
+
+
+class RingBuffer():
+    """ The last 'capacity' (time, values) rows of a stream. """
+
+    def __init__(self,capacity,nchannels,dtype=np.float64):
+        assert capacity > 0,"Capacity must be positive!"
+        self.capacity = capacity
+        self.nchannels = nchannels
+        self._t = np.zeros(2*capacity,dtype=np.float64)
+        self._data = np.zeros((2*capacity,nchannels),dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count,self.capacity)
+
+    def clear(self):
+        """ Removes all rows. """
+        self.count = 0
+
+    def extend(self,times,values):
+        """ Appends rows: 'times' (n) and 'values' (n x channels). """
+        times = np.asarray(times,dtype=np.float64).reshape(-1)
+        n = len(times)
+        if n == 0:
+            return
+        values = np.asarray(values,dtype=self._data.dtype)\
+                 .reshape(n,self.nchannels)
+        # older rows would be overwritten within this call anyway
+        if n > self.capacity:
+            times = times[-self.capacity:]
+            values = values[-self.capacity:]
+            self.count += n - self.capacity
+            n = self.capacity
+        pos = (self.count + np.arange(n)) % self.capacity
+        self._t[pos] = times
+        self._t[pos+self.capacity] = times
+        self._data[pos] = values
+        self._data[pos+self.capacity] = values
+        self.count += n
+
+    def sync(self,times,values,count):
+        """ Brings the buffer up to date with a stream of 'count' rows in
+        total, given its last rows (e.g. a copy of another buffer). Only the
+        rows not yet in the buffer are appended. Returns False if the buffer
+        had to be refilled (the stream restarted, or rows were missed). """
+        n = len(times)
+        new = count - self.count
+        if 0 <= new <= n:
+            self.extend(times[n-new:],values[n-new:])
+            return True
+        self.clear()
+        # keep the row numbering of the stream, if all of its rows that the
+        # buffer can hold are given
+        if n == count or n >= self.capacity:
+            self.count = count - n
+        self.extend(times,values)
+        return False
+
+    def view(self,n=None):
+        """ Returns (times, values) of the last 'n' rows (default: all), as
+        views into the buffer. They are valid until the next extend(). """
+        size = len(self)
+        n = size if n is None else min(n,size)
+        end = (self.count-1) % self.capacity + 1 + self.capacity \
+              if self.count else self.capacity
+        return self._t[end-n:end],self._data[end-n:end]
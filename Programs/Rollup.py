@@ -0,0 +1,170 @@
+# Offline rollup of the daily pyKraken logs into minute/hour/day aggregates
+#
+#   Scans a log directory for Datalog_Slow_YYYY-MM-DD.txt files and stores,
+#   for every day and level, the count, mean, min and max of every channel per
+#   minute, hour and day in a small .npz file. Only days whose log changed
+#   since the last run are processed, in parallel on all cores. Use
+#       python3 Rollup.py /home/pi/YDrive/share/Pi_Monitoring/Logs/
+#   and read the aggregates with query(), e.g.
+#       t,agg = Rollup.query(logdir,'hour',start,end,channels=[1,3])
+#
+import numpy as np
+import multiprocessing
+import argparse
+import datetime
+import json
+import re
+import os
+import Binlog
+import Logreader
+
+LEVELS = {'minute':60,'hour':3600,'day':86400}
+PATTERN = re.compile(r"^Datalog_Slow_(\d{4})-(\d{2})-(\d{2})\.txt$")
+MANIFEST = "rollup_manifest.json"
+
+
+def aggregate(times,values,period):
+    """ Aggregates samples into buckets of 'period' seconds (aligned to
+    the clock). Returns (bucket start times [ns], dictionary with 'count',
+    'mean', 'min' and 'max' arrays of shape buckets x channels). """
+    period_ns = int(period*1e9)
+    order = np.argsort(times,kind='stable')
+    times = times[order]
+    values = values[order].astype(np.float64)
+    bucket = times//period_ns
+    if len(bucket) == 0:
+        empty = np.zeros((0,values.shape[1] if values.ndim == 2 else 0))
+        return np.zeros(0,dtype=np.int64),\
+               {'count':empty.astype(np.int64),'mean':empty,\
+                'min':empty,'max':empty}
+    first = np.concatenate(([0],np.nonzero(np.diff(bucket))[0]+1))
+    count = np.diff(np.concatenate((first,[len(bucket)])))
+    out = {}
+    out['count'] = np.repeat(count[:,None],values.shape[1],axis=1)
+    out['mean'] = np.add.reduceat(values,first,axis=0)/count[:,None]
+    out['min'] = np.minimum.reduceat(values,first,axis=0)
+    out['max'] = np.maximum.reduceat(values,first,axis=0)
+    return bucket[first]*period_ns,out
+
+def rollup_day(args):
+    """ Builds the aggregates of all levels for a single log file. Returns
+    the log file name and its list of output files. """
+    logfile,outdir,day = args
+    times,values,triggers = Logreader.read_log(logfile)
+    outfiles = []
+    for level in LEVELS:
+        t,agg = aggregate(times,values,LEVELS[level])
+        outfile = os.path.join(outdir,"Rollup_{}_{}.npz".format(level,day))
+        tmp = outfile + ".tmp.npz"
+        np.savez(tmp,time=t,**agg)
+        os.replace(tmp,outfile)
+        outfiles.append(outfile)
+    return logfile,outfiles
+
+def log_days(logdir):
+    """ Returns a dictionary day ('YYYY-MM-DD') -> log file name. """
+    out = {}
+    for name in os.listdir(logdir):
+        m = PATTERN.match(name)
+        if m:
+            out["-".join(m.groups())] = os.path.join(logdir,name)
+    return out
+
+def rollup(logdir,outdir=None,processes=None,force=False):
+    """ Brings the aggregates in 'outdir' (default: logdir/Rollup) up to
+    date. Only new or changed days are processed (unless 'force'). Returns
+    the list of processed days. """
+    if outdir is None:
+        outdir = os.path.join(logdir,"Rollup")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest_file = os.path.join(outdir,MANIFEST)
+    manifest = {}
+    if not force and os.path.exists(manifest_file):
+        with open(manifest_file,'r') as f:
+            manifest = json.load(f)
+    # find new or changed days
+    todo = []
+    stamps = {}
+    for day,logfile in sorted(log_days(logdir).items()):
+        st = os.stat(logfile)
+        stamps[day] = [st.st_size,st.st_mtime]
+        if manifest.get(day) != stamps[day]:
+            todo.append((logfile,outdir,day))
+    # process days in parallel
+    if len(todo) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(rollup_day,todo)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in todo:
+            rollup_day(args)
+    for logfile,outdir_,day in todo:
+        manifest[day] = stamps[day]
+    with open(manifest_file + ".tmp",'w') as f:
+        json.dump(manifest,f)
+    os.replace(manifest_file + ".tmp",manifest_file)
+    return [day for logfile,outdir_,day in todo]
+
+def query(logdir,level,start=None,end=None,channels=None,outdir=None):
+    """ Returns the aggregates of 'level' ('minute', 'hour' or 'day') with
+    bucket start in [start, end) as (times [datetime64[ns]], dictionary of
+    'count', 'mean', 'min', 'max' arrays, buckets x channels). 'start' and
+    'end' are datetime objects (default: no limit); 'channels' selects
+    channel indices (default: all). """
+    assert level in LEVELS,"Unknown level '{}'!".format(level)
+    if outdir is None:
+        outdir = os.path.join(logdir,"Rollup")
+    t0 = None if start is None else Binlog.datetime2ns(start)
+    t1 = None if end is None else Binlog.datetime2ns(end)
+    times = []
+    parts = {'count':[],'mean':[],'min':[],'max':[]}
+    pattern = re.compile(r"^Rollup_{}_(\d{{4}}-\d{{2}}-\d{{2}})\.npz$"\
+                         .format(level))
+    for name in sorted(os.listdir(outdir)):
+        m = pattern.match(name)
+        if not m:
+            continue
+        # skip whole days outside the range
+        day = Binlog.datetime2ns(datetime.datetime.strptime(m.group(1),\
+                                                           "%Y-%m-%d"))
+        if (t1 is not None and day >= t1) or \
+           (t0 is not None and day + 86400*10**9 <= t0):
+            continue
+        with np.load(os.path.join(outdir,name)) as data:
+            t = data['time']
+            sel = np.ones(len(t),dtype=bool)
+            if t0 is not None:
+                sel &= t >= t0
+            if t1 is not None:
+                sel &= t < t1
+            times.append(t[sel])
+            for key in parts:
+                a = data[key][sel]
+                if channels is not None:
+                    a = a[:,channels]
+                parts[key].append(a)
+    if len(times) == 0:
+        return np.zeros(0,dtype='datetime64[ns]'),{}
+    out = {}
+    for key in parts:
+        out[key] = np.concatenate(parts[key])
+    return np.concatenate(times).view('datetime64[ns]'),out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=\
+        "Builds minute/hour/day aggregates of the Datalog_Slow logs.")
+    parser.add_argument('logdir',help="directory with the daily log files")
+    parser.add_argument('--out',default=None,\
+                        help="output directory (default: LOGDIR/Rollup)")
+    parser.add_argument('--jobs',type=int,default=None,\
+                        help="number of parallel processes (default: all cores)")
+    parser.add_argument('--force',action='store_true',\
+                        help="rebuild all days")
+    args = parser.parse_args()
+    days = rollup(args.logdir,args.out,processes=args.jobs,force=args.force)
+    print("Processed {} day(s): {}".format(len(days)," ".join(days)))
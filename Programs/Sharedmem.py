@@ -0,0 +1,346 @@
+# Shared memory between the processes of the monitoring programs
+#
+#   A SharedSnapshot holds the latest state of a fixed set of arrays (e.g.
+#   the plot windows) in a block of shared memory. A producer publishes a
+#   new state with publish(), consumers wait() for it and read() a copy.
+#   Every publication increments a sequence number; a consumer that is
+#   slower than the producer simply skips to the newest state and can count
+#   the states it never saw from the gaps in the sequence numbers.
+#   Besides the arrays, a snapshot holds a few named integers ('meta'), which
+#   either side can update, e.g. counters or a stop request.
+#
+#   The snapshot can be passed to a multiprocessing.Process (also with the
+#   'spawn' start method); the child attaches to the same memory.
+#
+#   A SampleRing is a ring buffer of samples (time, flags, values) in a named
+#   block of shared memory, written by one process (the DataLogger) and read
+#   by any number of unrelated processes on the same machine with a
+#   SampleReader. There is no lock (the readers are unrelated processes):
+#   every slot carries its sample number (as sequence word 2*k+2) and a
+#   CRC32 of its contents. A reader checks both on its copy of the slots and
+#   discards slots that are torn or from another pass of the ring. Unlike a
+#   seqlock, this does not depend on the order in which the writer's stores
+#   become visible, which ARM (the Pi) does not guarantee. Slots at the end
+#   that do not check out yet are read again by the next call.
+#
+from multiprocessing import shared_memory,resource_tracker
+import multiprocessing
+import numpy as np
+import zlib
+import time
+
+# header of a SampleRing: magic, capacity, channels, samples written,
+# stream id (creation time), closed
+_RING_MAGIC = 0x52494e4732
+_RING_HEADER = 64
+
+
+class SharedSnapshot():
+    """ Latest state of named arrays in shared memory. 'fields' maps names
+    to (shape, dtype); the first dimension is the capacity in rows, and
+    every publication may fill fewer rows. 'meta' names integer values. """
+
+    def __init__(self,fields,meta=(),ctx=None):
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+        self.fields = {name:(tuple(shape),np.dtype(dtype).str) \
+                       for name,(shape,dtype) in fields.items()}
+        self.meta = tuple(meta)
+        self._lock = ctx.Lock()
+        self._event = ctx.Event()
+        self._shm = shared_memory.SharedMemory(create=True,size=self._size())
+        self._owner = True
+        self._attach()
+
+    def _layout(self):
+        """ Header names (sequence number, rows of every field, meta) and the
+        byte offsets of the fields. """
+        header = ['seq'] + ['rows_' + name for name in self.fields] \
+                 + list(self.meta)
+        offsets = {}
+        pos = 8*len(header)
+        for name,(shape,dtype) in self.fields.items():
+            pos = (pos+63)//64*64
+            offsets[name] = pos
+            pos += int(np.prod(shape))*np.dtype(dtype).itemsize
+        return header,offsets,pos
+
+    def _size(self):
+        return max(self._layout()[2],1)
+
+    def _attach(self):
+        """ Creates the numpy views of the shared memory. """
+        header,offsets,size = self._layout()
+        buf = self._shm.buf
+        self._index = {name:i for i,name in enumerate(header)}
+        self._header = np.ndarray((len(header),),dtype=np.int64,buffer=buf)
+        self._arrays = {name:np.ndarray(shape,dtype=dtype,buffer=buf,\
+                                        offset=offsets[name]) \
+                        for name,(shape,dtype) in self.fields.items()}
+
+    def __getstate__(self):
+        return {'fields':self.fields,'meta':self.meta,'lock':self._lock,\
+                'event':self._event,'name':self._shm.name}
+
+    def __setstate__(self,state):
+        self.fields = state['fields']
+        self.meta = state['meta']
+        self._lock = state['lock']
+        self._event = state['event']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = False
+        self._attach()
+
+    @property
+    def seq(self):
+        """ Sequence number of the latest state (0: nothing published). """
+        return int(self._header[0])
+
+    def publish(self,arrays,**meta):
+        """ Writes a new state: 'arrays' maps field names to arrays with at
+        most the capacity in rows (fields not given keep their rows), 'meta'
+        sets meta values. Returns the new sequence number. """
+        with self._lock:
+            for name,data in arrays.items():
+                data = np.asarray(data)
+                n = len(data)
+                target = self._arrays[name]
+                assert n <= target.shape[0],\
+                       "Too many rows for field '{}'!".format(name)
+                if data.ndim > 1 and data.shape[1] < target.shape[1]:
+                    target[:n,:data.shape[1]] = data
+                else:
+                    target[:n] = data
+                self._header[self._index['rows_' + name]] = n
+            for key,value in meta.items():
+                self._header[self._index[key]] = value
+            self._header[0] += 1
+            seq = int(self._header[0])
+        self._event.set()
+        return seq
+
+    def set_meta(self,**meta):
+        """ Sets meta values without publishing a new state. """
+        with self._lock:
+            for key,value in meta.items():
+                self._header[self._index[key]] = value
+
+    def get_meta(self):
+        """ Returns the meta values as a dictionary. """
+        with self._lock:
+            return {key:int(self._header[self._index[key]]) \
+                    for key in self.meta}
+
+    def wait(self,timeout=None):
+        """ Waits for a state that was not read yet. Returns False on timeout. """
+        return self._event.wait(timeout)
+
+    def read(self):
+        """ Returns (seq, arrays, meta) of the latest state. The arrays are
+        copies of the filled rows, so the producer can go on publishing. """
+        with self._lock:
+            self._event.clear()
+            seq = int(self._header[0])
+            arrays = {name:np.array(data[:self._header[\
+                                    self._index['rows_' + name]]]) \
+                      for name,data in self._arrays.items()}
+            meta = {key:int(self._header[self._index[key]]) \
+                    for key in self.meta}
+        return seq,arrays,meta
+
+    def close(self):
+        """ Detaches from the shared memory (and frees it in the creating
+        process). """
+        self._header = None
+        self._arrays = {}
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def _ring_dtype(nchannels):
+    # the checksum is the last field, over all bytes before it
+    return np.dtype([('seq','<i8'),('time','<i8'),('flags','<i8'),\
+                     ('data','<f8',(nchannels,)),('crc','<i8')])
+
+def _checked(rec):
+    """ True for every slot record (copy) whose checksum matches. """
+    raw = np.ascontiguousarray(rec).view(np.uint8)\
+          .reshape(len(rec),rec.dtype.itemsize)
+    return np.array([zlib.crc32(row[:-8]) for row in raw],dtype=np.int64) \
+           == rec['crc']
+
+def _attach(name):
+    """ Attaches to a named block of shared memory without handing it to the
+    resource tracker of this process, which would remove it when this
+    process ends, although the creating process still uses it. """
+    try:
+        shm = shared_memory.SharedMemory(name=name,track=False)
+    except TypeError:
+        # Python < 3.13
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name,'shared_memory')
+    return shm
+
+
+class SampleRing():
+    """ Writer of a ring of the last 'capacity' samples of 'nchannels'
+    values in the shared memory block 'name'. A ring left over by an earlier
+    run with the same layout is continued, otherwise it is replaced. """
+
+    def __init__(self,name,nchannels,capacity=100000):
+        self.name = name
+        self.nchannels = nchannels
+        self.capacity = capacity
+        dtype = _ring_dtype(nchannels)
+        size = _RING_HEADER + capacity*dtype.itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name=name,create=True,\
+                                                   size=size)
+            fresh = True
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+            header = np.ndarray((6,),dtype=np.int64,buffer=self._shm.buf)
+            if self._shm.size >= size and header[0] == _RING_MAGIC \
+               and header[1] == capacity and header[2] == nchannels:
+                fresh = False
+            else:
+                # different layout: readers attach to the new ring
+                header[5] = 1
+                del header
+                self._shm.unlink()
+                self._shm.close()
+                self._shm = shared_memory.SharedMemory(name=name,\
+                                                       create=True,size=size)
+                fresh = True
+        self._header = np.ndarray((6,),dtype=np.int64,buffer=self._shm.buf)
+        self._slots = np.ndarray((capacity,),dtype=dtype,buffer=self._shm.buf,\
+                                 offset=_RING_HEADER)
+        if fresh:
+            self._slots['seq'] = 0
+            self._header[:] = [_RING_MAGIC,capacity,nchannels,0,\
+                               time.time_ns(),0]
+
+    @property
+    def count(self):
+        """ Number of samples written (also by earlier runs). """
+        return int(self._header[3])
+
+    def write(self,t,values,flags=0):
+        """ Appends a sample: time 't' (ns), 'values' and 'flags'. """
+        k = int(self._header[3])
+        rec = np.zeros(1,dtype=self._slots.dtype)
+        rec['seq'] = 2*k + 2
+        rec['time'] = t
+        rec['flags'] = flags
+        rec['data'] = values
+        rec['crc'] = zlib.crc32(rec.view(np.uint8)[:-8])
+        self._slots[k % self.capacity] = rec[0]
+        self._header[3] = k + 1
+
+    def close(self):
+        """ Marks the ring as closed for the readers and removes it. """
+        self._header[5] = 1
+        self._header = None
+        self._slots = None
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class SampleReader():
+    """ Reads the new samples of a SampleRing. Each reader keeps its own
+    position, so any number of processes can read the same ring. """
+
+    def __init__(self,name):
+        self.name = name
+        self.next = None
+        self.missed = 0
+        self._shm = None
+        self._stream = None
+
+    def attach(self):
+        """ Attaches to the ring (again, if the writer replaced it). Returns
+        False if there is no ring. """
+        if self._shm is not None and self._header[5] == 0:
+            return True
+        self.detach()
+        try:
+            shm = _attach(self.name)
+        except FileNotFoundError:
+            return False
+        header = np.ndarray((6,),dtype=np.int64,buffer=shm.buf)
+        if header[0] != _RING_MAGIC or header[5] != 0:
+            del header
+            shm.close()
+            return False
+        self._shm = shm
+        self._header = header
+        self.capacity = int(header[1])
+        self.nchannels = int(header[2])
+        self._slots = np.ndarray((self.capacity,),\
+                                 dtype=_ring_dtype(self.nchannels),\
+                                 buffer=shm.buf,offset=_RING_HEADER)
+        if self._stream != int(header[4]):
+            # a new ring: start with the samples it holds
+            self._stream = int(header[4])
+            self.next = None
+        return True
+
+    def detach(self):
+        if self._shm is not None:
+            self._header = None
+            self._slots = None
+            self._shm.close()
+            self._shm = None
+
+    def read(self,since=None):
+        """ Returns (times [int64 ns], values [samples x channels], flags)
+        of the samples written since the last call (or since the absolute
+        sample number 'since'; first call: all samples in the ring). Samples
+        overwritten before they were read are counted in 'missed'. """
+        if not self.attach():
+            return np.zeros(0,dtype=np.int64),np.zeros((0,0)),\
+                   np.zeros(0,dtype=np.int64)
+        if since is not None:
+            self.next = since
+        end = int(self._header[3])
+        oldest = max(end-self.capacity,0)
+        if self.next is None or self.next > end:
+            # first read, or the ring was reset
+            start = oldest
+        else:
+            start = self.next
+            if start < oldest:
+                self.missed += oldest - start
+                start = oldest
+        index = np.arange(start,end) % self.capacity
+        expected = 2*np.arange(start,end) + 2
+        # torn slots and slots of another pass are dropped
+        rec = self._slots[index]
+        ok = (rec['seq'] == expected) & _checked(rec)
+        if not ok.all():
+            # the newest slots may not be complete yet: read them next time
+            while end > start and not ok[end-start-1]:
+                end -= 1
+            ok = ok[:end-start]
+            rec = rec[:end-start]
+            self.missed += int((~ok).sum())
+            rec = rec[ok]
+        self.next = end
+        return rec['time'],rec['data'],rec['flags']
+
+    def latest(self):
+        """ Returns (time, values, flags) of the newest sample, or None. """
+        if not self.attach():
+            return None
+        for retry in range(0,10):
+            k = int(self._header[3]) - 1
+            if k < 0:
+                return None
+            rec = self._slots[k % self.capacity:k % self.capacity + 1].copy()
+            if rec['seq'][0] == 2*k + 2 and _checked(rec)[0]:
+                return int(rec['time'][0]),rec['data'][0],int(rec['flags'][0])
+        return None
@@ -0,0 +1,304 @@
+# Background synchronization of a local spool directory to the network share
+#
+#   The DataLogger writes its files to a local spool directory (SD card or
+#   tmpfs). A Syncer thread appends new data from the spool to the share in
+#   batches. For every file it remembers how many bytes have been copied
+#   (resume offset) together with CRC32 checksums, so that an outage of the
+#   share only delays the copy and rewritten or truncated files are detected.
+#   A destination the Syncer has no state for (the spool was lost, e.g. a
+#   tmpfs after a reboot, or is new) is never overwritten: text logs are
+#   continued after their last line, other files go to '<name>.partN'. Only
+#   'temporary' files (e.g. the fast log) are replaced, and removed from the
+#   share when they disappear from the spool.
+#
+import threading
+import fnmatch
+import zlib
+import json
+import glob
+import time
+import os
+
+# number of leading bytes used to recognize rewritten files
+HEAD_BYTES = 256
+
+
+def crc32_file(filename,start=0,length=None):
+    """ Returns the CRC32 checksum of 'length' bytes of a file, beginning at
+    'start' (default: up to the end of the file). """
+    crc = 0
+    with open(filename,'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            n = 1<<16 if remaining is None else min(1<<16,remaining)
+            chunk = f.read(n)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk,crc)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return crc & 0xffffffff
+
+
+class Syncer():
+    """ Copies appended data from a spool directory to a destination
+    directory in the background. """
+
+    _default = {\
+        'src':"./spool/",\
+        'dst':"./",\
+        'sync_period':10.0,\
+        'batch_size':1<<20,\
+        'patterns':("*.txt","*.bin","*.idx","*.json",),\
+        'keep_days':7.0,\
+        'state_file':".sync_state.json",\
+        'retry_period':60.0,\
+        'temporary':(),\
+        }
+
+    def __init__(self,**kwargs):
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        if not os.path.isdir(self.src):
+            os.makedirs(self.src)
+        self._state = self.load_state()
+        self._thread = None
+        self._running = False
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self.stats = {'synced_bytes':0,'restarts':0,'errors':0,\
+                      'last_sync':None,'last_error':None,'pending_bytes':0}
+
+    # --- persistent state
+    def load_state(self):
+        """ Loads the resume offsets and checksums from the spool. """
+        try:
+            with open(os.path.join(self.src,self.state_file),'r') as f:
+                return json.load(f)
+        except (IOError,OSError,ValueError):
+            return {}
+
+    def save_state(self):
+        """ Stores resume offsets and checksums atomically in the spool. """
+        name = os.path.join(self.src,self.state_file)
+        with open(name + ".tmp",'w') as f:
+            json.dump(self._state,f)
+        os.replace(name + ".tmp",name)
+
+    # --- synchronization
+    def spooled_files(self):
+        """ Returns the names of all files in the spool that are synced. """
+        names = set()
+        for pattern in self.patterns:
+            for name in glob.glob(os.path.join(self.src,pattern)):
+                names.add(os.path.basename(name))
+        return sorted(names)
+
+    def is_temporary(self,name):
+        """ True if file 'name' matches one of the 'temporary' patterns. """
+        return any(fnmatch.fnmatch(name,p) for p in self.temporary)
+
+    def _new_state(self,name):
+        """ Returns the state of a spool file that was not synced before.
+        The destination keeps its content ('base' bytes) unless the file is
+        temporary: text files are continued after it, others are copied to
+        '<name>.partN'. """
+        target = name
+        base = 0
+        dst = os.path.join(self.dst,name)
+        if os.path.exists(dst) and os.path.getsize(dst) > 0 \
+           and not self.is_temporary(name):
+            if name.endswith(".txt"):
+                with open(dst,'r+b') as f:
+                    f.seek(-1,os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        # last line of an interrupted copy
+                        f.write(b"\n")
+                base = os.path.getsize(dst)
+                print("Continuing '{}' after its {} bytes on the share"\
+                      .format(name,base))
+            else:
+                k = 1
+                while os.path.exists("{}.part{}".format(dst,k)):
+                    k += 1
+                target = "{}.part{}".format(name,k)
+                print("'{}' exists on the share; copying to '{}'"\
+                      .format(name,target))
+        return {'offset':0,'crc':0,'head':0,'head_len':0,\
+                'base':base,'dst':target}
+
+    def _restart(self,st):
+        """ Starts copying a file from scratch (e.g. after it was rewritten
+        in the spool or lost on the share). Only the bytes copied from the
+        spool are removed from the destination. """
+        dst = os.path.join(self.dst,st['dst'])
+        size = os.path.getsize(dst) if os.path.exists(dst) else 0
+        st['base'] = min(st['base'],size)
+        with open(dst,'ab') as f:
+            f.truncate(st['base'])
+        st.update({'offset':0,'crc':0,'head':0,'head_len':0})
+        self.stats['restarts'] += 1
+
+    def sync_file(self,name):
+        """ Appends the not yet copied part of spool file 'name' to the
+        destination, at most 'batch_size' bytes per call. Returns the number
+        of bytes copied. Raises IOError/OSError if the share is not
+        available. """
+        src = os.path.join(self.src,name)
+        size = os.path.getsize(src)
+        st = self._state.get(name)
+        if st is None:
+            st = self._new_state(name)
+            self._state[name] = st
+        # (state saved before destinations were kept)
+        st.setdefault('base',0)
+        st.setdefault('dst',name)
+        dst = os.path.join(self.dst,st['dst'])
+        # detect truncated or rewritten spool files
+        if size < st['offset'] \
+           or (st['head_len'] > 0 and \
+               crc32_file(src,0,st['head_len']) != st['head']):
+            self._restart(st)
+        # make the destination match the resume offset
+        end = st['base'] + st['offset']
+        dst_size = os.path.getsize(dst) if os.path.exists(dst) else 0
+        if dst_size > end:
+            # left-over from an interrupted copy
+            with open(dst,'r+b') as f:
+                f.truncate(end)
+        elif dst_size < end:
+            # destination lost data; copy everything again
+            self._restart(st)
+            end = st['base']
+        # read the next batch; text files only up to the last full line
+        with open(src,'rb') as f:
+            f.seek(st['offset'])
+            chunk = f.read(self.batch_size)
+        if name.endswith(".txt"):
+            chunk = chunk[:chunk.rfind(b"\n")+1]
+        if not chunk:
+            return 0
+        # append, flush and verify the copied data
+        with open(dst,'ab') as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        crc = zlib.crc32(chunk) & 0xffffffff
+        if crc32_file(dst,end,len(chunk)) != crc:
+            with open(dst,'r+b') as f:
+                f.truncate(end)
+            raise IOError("Checksum mismatch for '{}'!".format(dst))
+        st['offset'] += len(chunk)
+        st['crc'] = zlib.crc32(chunk,st['crc']) & 0xffffffff
+        if st['head_len'] < HEAD_BYTES:
+            st['head_len'] = min(HEAD_BYTES,st['offset'])
+            st['head'] = crc32_file(src,0,st['head_len'])
+        return len(chunk)
+
+    def sync(self):
+        """ Copies all pending data from the spool to the destination.
+        Returns the number of bytes copied. """
+        with self._lock:
+            if not os.path.isdir(self.dst):
+                self.stats['errors'] += 1
+                self.stats['last_error'] = "{} not available".format(self.dst)
+                raise IOError("Destination '{}' not available!"\
+                              .format(self.dst))
+            total = 0
+            names = self.spooled_files()
+            # temporary files removed from the spool by the logger are
+            # removed from the share, too; others are kept there
+            for name in list(self._state):
+                if name not in names:
+                    st = self._state.pop(name)
+                    if not self.is_temporary(name):
+                        continue
+                    try:
+                        os.remove(os.path.join(self.dst,st.get('dst',name)))
+                    except (IOError,OSError):
+                        pass
+            pending = 0
+            for name in names:
+                try:
+                    while True:
+                        n = self.sync_file(name)
+                        total += n
+                        if n < self.batch_size:
+                            break
+                except (IOError,OSError) as e:
+                    # spool file removed in the meantime or share not available
+                    if not os.path.exists(os.path.join(self.src,name)):
+                        continue
+                    self.stats['errors'] += 1
+                    self.stats['last_error'] = "{}: {}".format(name,e)
+                    self.save_state()
+                    raise
+                try:
+                    pending += os.path.getsize(os.path.join(self.src,name)) \
+                               - self._state[name]['offset']
+                except (IOError,OSError):
+                    pass
+            self.save_state()
+            self.stats['synced_bytes'] += total
+            self.stats['pending_bytes'] = pending
+            self.stats['last_sync'] = time.time()
+            return total
+
+    def prune(self):
+        """ Removes fully synced files older than 'keep_days' from the spool.
+        The copies on the share are kept. """
+        with self._lock:
+            limit = time.time() - self.keep_days*86400
+            for name in self.spooled_files():
+                src = os.path.join(self.src,name)
+                st = self._state.get(name)
+                if st is None or st['offset'] != os.path.getsize(src):
+                    continue
+                if os.path.getmtime(src) < limit:
+                    os.remove(src)
+                    self._state.pop(name)
+            self.save_state()
+
+    # --- background operation
+    def start(self):
+        """ Starts the background synchronization thread. """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self.run,name="Syncer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self,timeout=10.0):
+        """ Requests a last synchronization and stops the thread. """
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """ Synchronization loop; waits 'retry_period' after a failure. """
+        wait = self.sync_period
+        while True:
+            try:
+                self.sync()
+                self.prune()
+                wait = self.sync_period
+            except Exception as e:
+                # share errors are counted by sync(); anything else here
+                if not isinstance(e,(IOError,OSError)):
+                    self.stats['errors'] += 1
+                    self.stats['last_error'] = "{!r}".format(e)
+                print("Sync to '{}' failed, retrying in {} s: {!r}".\
+                      format(self.dst,self.retry_period,e))
+                wait = self.retry_period
+            if not self._running:
+                break
+            self._wake.wait(wait)
+            self._wake.clear()
@@ -5,7 +5,8 @@ IFS=$'\n'
 LOGFILE='restart.txt'
 
 runscript(){
-  sudo mount -a
+  # the logger spools locally, so a hanging share must not block the restart
+  timeout 30 sudo mount -a || writelog "mount -a failed"
   python3 pyKraken_Lattice_New.py
 }
 
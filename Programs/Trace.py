@@ -0,0 +1,331 @@
+# Triggered trace capture for the raspberry pi and i2c devices
+#
+#   Successor of pyKraken.triggered_trace: samples are timed with
+#   time.perf_counter_ns() against an absolute schedule (start + i*dt), stored
+#   in preallocated numpy arrays, and the deviation of every sample from its
+#   schedule (jitter) is kept. Traces are saved in the binary log format, see
+#   Binlog.py.
+#   RingCapture samples continuously into a ring buffer and cuts one trace
+#   around every trigger, including the samples before the trigger edge.
+#
+import py2C as i2c
+import Binlog
+import Trigger
+import RPi.GPIO as gpio
+import numpy as np
+import threading
+import datetime
+import queue
+import time
+import sys
+
+# sleep until this close to the next sample, then spin (ns)
+SPIN_NS = 500000
+
+
+class Trace():
+    """ Result of a trace capture: sample times 't' (ns after start),
+    scheduled times 'scheduled' (ns after start, None without fixed 'dt'),
+    data (samples x devices) and the wall-clock time of the start. """
+
+    def __init__(self,t,data,scheduled=None,start=None,dt=None,\
+                 trigger_delay=None,channels=None,pre=0):
+        self.t = t
+        self.data = data
+        self.scheduled = scheduled
+        self.start = start if start is not None else datetime.datetime.now()
+        self.dt = dt
+        self.trigger_delay = trigger_delay
+        if channels is None:
+            channels = ["ch{}".format(i) for i in range(0,data.shape[1])]
+        self.channels = channels
+        # number of samples before the trigger
+        self.pre = pre
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def jitter(self):
+        """ Deviation of each sample from its schedule in ns. """
+        if self.scheduled is None:
+            return np.zeros(len(self.t),dtype=np.int64)
+        return self.t - self.scheduled
+
+    def stats(self):
+        """ Returns a dictionary with timing statistics (in us): mean, std,
+        median, 99th percentile and maximum of the jitter and of the sample
+        intervals, and the number of samples that were a full 'dt' late. """
+        out = {'samples':len(self.t)}
+        if len(self.t) == 0:
+            return out
+        jitter = self.jitter/1000.0
+        out['jitter_mean'] = float(np.mean(jitter))
+        out['jitter_std'] = float(np.std(jitter))
+        out['jitter_median'] = float(np.median(jitter))
+        out['jitter_p99'] = float(np.percentile(jitter,99))
+        out['jitter_max'] = float(np.max(jitter))
+        if len(self.t) > 1:
+            intervals = np.diff(self.t)/1000.0
+            out['interval_mean'] = float(np.mean(intervals))
+            out['interval_std'] = float(np.std(intervals))
+            out['interval_max'] = float(np.max(intervals))
+        if self.dt is not None:
+            out['late'] = int(np.sum(self.jitter >= self.dt*1e9))
+        if self.trigger_delay is not None:
+            out['trigger_delay'] = self.trigger_delay/1000.0
+        return out
+
+    def save(self,filename):
+        """ Saves the trace in the binary log format; the timing statistics
+        are stored in the header. """
+        start = Binlog.datetime2ns(self.start)
+        meta = {'kind':'trace','dt':self.dt,'pre':self.pre,\
+                'stats':self.stats()}
+        log = Binlog.BinaryLog(filename,self.channels,meta=meta)
+        with open(filename,'wb') as f:
+            f.write(log.header_bytes())
+        log.append(start + self.t,self.data)
+        return filename
+
+
+class TraceEngine():
+    """ Captures traces of one or more devices, optionally after a rising
+    edge on a trigger pin or reported by a Trigger.TriggerMonitor. """
+
+    _default = {\
+        'dt':None,\
+        'tmax':None,\
+        'nmax':10,\
+        'timeout':-1,\
+        'trigger_pin':None,\
+        'monitor':None,\
+        'channels':None,\
+        }
+
+    def __init__(self,devices,**kwargs):
+        # reshape and validate input
+        if type(devices) not in (tuple,list,):
+            devices = [devices]
+        for d in devices:
+            assert hasattr(d,'get'),"Devices need a get() method!"
+        self.devices = list(devices)
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        assert self.nmax != 0 or self.tmax != 0,"Missing break condition!"
+
+    def size(self):
+        """ Number of samples to preallocate. """
+        n = self.nmax if self.nmax else 0
+        if self.tmax is not None and self.dt is not None:
+            nt = int(self.tmax/self.dt) + 1
+            n = min(n,nt) if n else nt
+        assert n > 0,"Cannot preallocate without 'nmax' (or 'tmax' and 'dt')!"
+        return n
+
+    def wait_for_trigger(self):
+        """ Waits for the trigger. Returns the perf_counter_ns() time of the
+        edge if known (TriggerMonitor), else None. """
+        if self.monitor is not None:
+            timeout = None if self.timeout < 0 else self.timeout/1000.0
+            if self.monitor.wait_rising(timeout=timeout) is not None:
+                # convert the edge's wall-clock time to the perf counter
+                return time.perf_counter_ns() \
+                       - (time.time_ns()-self.monitor.last_edge)
+        elif self.trigger_pin is not None:
+            gpio.wait_for_edge(self.trigger_pin,gpio.RISING,\
+                               timeout=self.timeout)
+        return None
+
+    def capture(self):
+        """ Waits for the trigger, then accumulates samples until 'nmax'
+        samples are reached or 'tmax' has passed. With 'dt', the samples
+        follow the schedule start + i*dt. Returns a Trace. """
+        n = self.size()
+        ndev = len(self.devices)
+        t = np.zeros(n,dtype=np.int64)
+        data = np.zeros((n,ndev),dtype=np.float32)
+        dt_ns = None if self.dt is None else int(round(self.dt*1e9))
+        tmax_ns = None if self.tmax is None else int(round(self.tmax*1e9))
+        devices = self.devices
+        clock = time.perf_counter_ns
+        # start by waiting for the trigger
+        edge = self.wait_for_trigger()
+        start_wall = datetime.datetime.now()
+        start = clock()
+        i = 0
+        while i < n:
+            if dt_ns is not None:
+                # wait for the scheduled time of this sample
+                due = start + i*dt_ns
+                rest = due - clock()
+                if rest > SPIN_NS:
+                    time.sleep((rest-SPIN_NS)/1e9)
+                while clock() < due:
+                    pass
+            now = clock() - start
+            if tmax_ns is not None and now >= tmax_ns:
+                break
+            t[i] = now
+            for j in range(0,ndev):
+                data[i,j] = devices[j].get()
+            i += 1
+        scheduled = None
+        if dt_ns is not None:
+            scheduled = np.arange(0,i,dtype=np.int64)*dt_ns
+        delay = None if edge is None else start - edge
+        return Trace(t[:i],data[:i],scheduled=scheduled,start=start_wall,\
+                     dt=self.dt,trigger_delay=delay,channels=self.channels)
+
+
+class RingCapture():
+    """ Samples the devices continuously every 'dt' into a ring buffer. For
+    every rising edge seen by the TriggerMonitor 'monitor', a Trace of 'pre'
+    samples before and 'post' samples from the edge on is put into the queue
+    'traces'. Sampling never pauses, so consecutive triggers are covered
+    without gaps (their windows may overlap). Sample times in the traces are
+    relative to the trigger edge. """
+
+    _default = {\
+        'dt':0.004,\
+        'pre':250,\
+        'post':500,\
+        'depth':None,\
+        'monitor':None,\
+        'channels':None,\
+        'queue_size':100,\
+        }
+
+    def __init__(self,devices,**kwargs):
+        if type(devices) not in (tuple,list,):
+            devices = [devices]
+        for d in devices:
+            assert hasattr(d,'get'),"Devices need a get() method!"
+        self.devices = list(devices)
+        # first set defaults, then overwrite with possible user input
+        for kw in self._default:
+            setattr(self,kw,self._default[kw])
+        for kw in kwargs:
+            assert kw in self._default,\
+                   "Unknown keyword '{}!'".format(kw)
+            setattr(self,kw,kwargs[kw])
+        assert self.monitor is not None,"Need a Trigger.TriggerMonitor!"
+        assert self.dt > 0,"Need a positive sampling interval 'dt'!"
+        if self.depth is None:
+            self.depth = 2*(self.pre + self.post)
+        assert self.depth >= self.pre + self.post,\
+               "Ring buffer shorter than a trace!"
+        # ring buffers: sample times (perf counter) and data
+        self._t = np.zeros(self.depth,dtype=np.int64)
+        self._data = np.zeros((self.depth,len(self.devices)),dtype=np.float32)
+        self.count = 0
+        self.traces = queue.Queue(maxsize=self.queue_size)
+        self.dropped = 0
+        self._pending = []
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """ Starts continuous acquisition in a background thread. """
+        self._running = True
+        self._thread = threading.Thread(target=self.run,name="RingCapture")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self,timeout=5.0):
+        """ Stops the acquisition. """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def cut(self,trigger):
+        """ Copies the window around a trigger out of the ring buffer. """
+        k,edge,edge_wall = trigger
+        idx = np.arange(k-self.pre,k+self.post) % self.depth
+        t = self._t[idx] - edge
+        data = self._data[idx]
+        dt_ns = int(round(self.dt*1e9))
+        # schedule of the samples relative to the edge
+        scheduled = self._start + np.arange(k-self.pre,k+self.post,\
+                                            dtype=np.int64)*dt_ns - edge
+        return Trace(t,data,scheduled=scheduled,start=edge_wall,dt=self.dt,\
+                     trigger_delay=self._t[k%self.depth]-edge,\
+                     channels=self.channels,pre=self.pre)
+
+    def run(self):
+        """ Acquisition loop. """
+        devices = self.devices
+        ndev = len(devices)
+        clock = time.perf_counter_ns
+        dt_ns = int(round(self.dt*1e9))
+        rising = self.monitor.rising
+        self._start = clock()
+        while self._running:
+            k = self.count
+            # wait for the scheduled time of this sample
+            due = self._start + k*dt_ns
+            rest = due - clock()
+            if rest > SPIN_NS:
+                time.sleep((rest-SPIN_NS)/1e9)
+            while clock() < due:
+                pass
+            slot = k % self.depth
+            self._t[slot] = clock()
+            for j in range(0,ndev):
+                self._data[slot,j] = devices[j].get()
+            self.count = k+1
+            # new trigger edges: the trace starts 'pre' samples before the
+            # first sample after the edge
+            if self.monitor.rising != rising:
+                rising = self.monitor.rising
+                edge_ns = self.monitor.last_edge
+                edge = clock() - (time.time_ns()-edge_ns)
+                first = k if edge <= self._t[slot] else k+1
+                if first >= self.pre:
+                    self._pending.append((first,edge,\
+                                          Trigger.ns2local(edge_ns)))
+            # hand out all traces that are complete
+            while self._pending and self._pending[0][0]+self.post <= self.count:
+                trace = self.cut(self._pending.pop(0))
+                try:
+                    self.traces.put_nowait(trace)
+                except queue.Full:
+                    self.dropped += 1
+
+
+if __name__ == "__main__":
+    # setup a trigger pin (BCM indexing)
+    gpio.setmode(gpio.BCM)
+    gpio.setup(16,gpio.IN)
+    # ADS1015: 4-channel ADC
+    adc = i2c.ADS1015(addr=0x4a,cycle=[0b100,0b101,0b110,0b111])
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] == "ring":
+            # continuous mode: 1 s before and 2 s after every trigger
+            monitor = Trigger.TriggerMonitor(16)
+            monitor.start()
+            ring = RingCapture([adc,adc,adc,adc],monitor=monitor,\
+                               dt=0.004,pre=250,post=500)
+            ring.start()
+            print('Press CTRL-C to exit loop.')
+            while True:
+                trace = ring.traces.get()
+                print(trace.stats())
+                trace.save("Trace_{:%Y-%m-%d_%H%M%S_%f}.bin".\
+                           format(trace.start))
+        else:
+            engine = TraceEngine([adc,adc,adc,adc],trigger_pin=16,\
+                                 dt=0.004,tmax=2.0,nmax=100000)
+            print('Waiting for trigger ...')
+            trace = engine.capture()
+            print(trace.stats())
+            trace.save("Trace_{:%Y-%m-%d_%H%M%S}.bin".format(trace.start))
+    except KeyboardInterrupt:
+        print('Goodbye!')
+    finally:
+        gpio.cleanup()
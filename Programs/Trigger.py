@@ -0,0 +1,153 @@
+# Interrupt-driven capture of trigger edges on a GPIO pin
+#
+#   Instead of polling the trigger pin, a GPIO callback timestamps every
+#   rising and falling edge and appends it to a deque (appending and popping
+#   are atomic, so the callback never waits for the consumers). Counters of
+#   rising and falling edges let several consumers tag their samples with the
+#   exact trigger activity in their own time windows.
+#   The level is tracked by alternating it with every edge, since reading
+#   the pin in the callback could already see the end of a short pulse. An
+#   edge lost to bouncing (or two merged ones) would flip the level for good,
+#   so consumers call resync() from time to time, which takes over the pin
+#   level if no edge is on its way.
+#
+import RPi.GPIO as gpio
+from collections import deque
+import threading
+import datetime
+import time
+
+RISING = 1
+FALLING = 0
+
+
+def ns2local(t_ns):
+    """ Converts time.time_ns() to a (naive) local datetime object. """
+    dt = datetime.datetime.fromtimestamp(t_ns//1000000000)
+    return dt.replace(microsecond=(t_ns//1000)%1000000)
+
+
+class TriggerMonitor():
+    """ Records timestamped edges on a trigger pin. The pin has to be set up
+    as input before. Edges are stored as (time.time_ns(), level) tuples,
+    where level is 1 for a rising and 0 for a falling edge. """
+
+    def __init__(self,pin,bouncetime=None,maxlen=100000):
+        self.pin = pin
+        self.bouncetime = bouncetime
+        self._edges = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self.rising = 0
+        self.falling = 0
+        self.level = gpio.input(pin)
+        self.last_edge = None
+        self.resyncs = 0
+        self._started = False
+        self._listeners = []
+
+    def start(self):
+        """ Registers the edge callback. """
+        if self._started:
+            return
+        self.level = gpio.input(self.pin)
+        if self.bouncetime is None:
+            gpio.add_event_detect(self.pin,gpio.BOTH,callback=self._callback)
+        else:
+            gpio.add_event_detect(self.pin,gpio.BOTH,callback=self._callback,\
+                                  bouncetime=self.bouncetime)
+        self._started = True
+
+    def stop(self):
+        """ Removes the edge callback. """
+        if self._started:
+            gpio.remove_event_detect(self.pin)
+            self._started = False
+
+    def add_listener(self,listener):
+        """ Registers a function listener(t_ns,level) that is called for
+        every edge, in the GPIO thread; it has to return quickly. """
+        self._listeners.append(listener)
+
+    def _callback(self,channel):
+        """ Called by RPi.GPIO (in its own thread) for every edge. """
+        t = time.time_ns()
+        # edges alternate; reading the pin here could already see the end
+        # of a short pulse
+        with self._lock:
+            level = 1 - self.level
+            self.level = level
+            if level:
+                self.rising += 1
+            else:
+                self.falling += 1
+            self.last_edge = t
+        self._edges.append((t,level))
+        for listener in self._listeners:
+            try:
+                listener(t,level)
+            except Exception as e:
+                print("Trigger listener failed: {}".format(e))
+        if level:
+            with self._cond:
+                self._cond.notify_all()
+
+    def resync(self,settle=0.005):
+        """ Re-reads the pin level, e.g. after edges were lost to bouncing.
+        A level that differs from the tracked one is taken over only if it
+        holds for 'settle' seconds without an edge, since the callback of a
+        fresh edge may still be pending. Returns True if the level was
+        corrected. """
+        level = gpio.input(self.pin)
+        if level == self.level:
+            return False
+        edges = self.rising + self.falling
+        time.sleep(settle)
+        with self._lock:
+            if self.rising + self.falling != edges \
+               or gpio.input(self.pin) != level:
+                return False
+            self.level = level
+            self.resyncs += 1
+        return True
+
+    def snapshot(self):
+        """ Returns (level, rising count, falling count), used to mark the
+        beginning of a time window. """
+        return (self.level,self.rising,self.falling)
+
+    def window(self,start,end=None):
+        """ Summarizes the trigger activity between the snapshots 'start'
+        and 'end' (default: now). Returns a dictionary with the number of
+        'rising' and 'falling' edges, the 'level' at the end, and 'triggered'
+        (1 if the trigger was high at any time in the window, else 0). """
+        if end is None:
+            end = self.snapshot()
+        level0,rising0,falling0 = start
+        level,rising,falling = end
+        rising -= rising0
+        falling -= falling0
+        triggered = 1 if (level0 or level or rising > 0) else 0
+        return {'rising':rising,'falling':falling,'level':level,\
+                'triggered':triggered}
+
+    def drain(self):
+        """ Returns all edges recorded since the last call, oldest first.
+        Only one consumer should drain the edges. """
+        out = []
+        while True:
+            try:
+                out.append(self._edges.popleft())
+            except IndexError:
+                return out
+
+    def wait_rising(self,timeout=None,since=None):
+        """ Waits (up to 'timeout' seconds) until the rising-edge counter
+        exceeds 'since' (default: the current count). Returns the counter
+        value, or None on a timeout. Passing the previous return value as
+        'since' does not miss edges that occurred in the meantime. """
+        if since is None:
+            since = self.rising
+        with self._cond:
+            ok = self._cond.wait_for(lambda: self.rising > since,timeout)
+        return self.rising if ok else None
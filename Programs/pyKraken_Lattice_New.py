@@ -3,12 +3,141 @@
 #   Running on 2.7.9; everything but gpio functionality works in 3.5 as well.
 #
 import py2C as i2c
+import Binlog
+import Spool
+import Trigger
+import Decimate
+import Logindex
+import Livestream
+import Sharedmem
+import Loopstats
 import RPi.GPIO as gpio
 import numpy as np
 import time
 import datetime
 import smbus
 import os
+import threading
+import queue
+
+def wait_until(t):
+    """ Waits until time.time() reaches 't'. Sleeps for most of the time and
+    spins for the last two milliseconds to keep the timing accurate. """
+    dt = t - time.time()
+    if dt > 0.002:
+        time.sleep(dt-0.002)
+    while time.time() < t:
+        pass
+
+def format_timestamp(now):
+    """ Returns the timestamp string used in the log files. """
+    return "{:04} {:02} {:02} {:02}:{:02}:{:02}.{:06}".\
+           format(now.year,now.month,now.day,now.hour,now.minute,now.second,now.microsecond)
+
+def check_device(device):
+    """ Asserts that 'device' is a measurement device the DataLogger can
+    read. """
+    assert isinstance(device,i2c.I2c_device),\
+           "Expecting instance of I2c_device!"
+    assert device.dev_class in (i2c.DEV_MEAS,i2c.DEV_ADC,),\
+           "Unsupported device class for device '{}'!"\
+           .format(device.dev_type)
+
+class DeviceGroup():
+    """ A set of devices that is sampled and averaged at its own rate. The
+    DataLogger interleaves the measurements of all its groups on the bus,
+    device by device; each group is written to its own set of log files. """
+
+    def __init__(self,name,devices,meas_period,avg_period,device_pause=0.0,\
+                 channel_names=None,channel_units=None):
+        for d in devices:
+            check_device(d)
+        assert avg_period > 0,"Averaging period must be positive!"
+        self.name = name
+        self.devices = devices
+        self.meas_period = meas_period
+        self.avg_period = avg_period
+        self.device_pause = device_pause
+        self.channel_names = channel_names
+        self.channel_units = channel_units
+        # acquisition state
+        self.data = []
+        self.next_meas = 0.0
+        self.window_end = 0.0
+        self.trigger_start = None
+        self.cadence = None
+        # sweep in progress (values so far), its start and the earliest time
+        # of the next device read (after 'device_pause')
+        self.sweep = None
+        self.sweep_start = 0.0
+        self.next_read = 0.0
+        self.busy = 0.0
+        # writer state
+        self.last_save = time.time()
+        self.binlog = None
+        self.index = None
+        self.slow = None
+        self.slow_flags = 0
+        self.decimator = None
+
+    def get_measurements(self):
+        """ Returns the list of measurement values obtained by each device's
+        get() method, pausing 'device_pause' between devices. """
+        results_list = [ ]
+        for device in self.devices:
+            results_list.append(device.get())
+            if self.device_pause > 0:
+                time.sleep(self.device_pause)
+        return results_list
+
+    def due(self):
+        """ Time at which the group needs the bus next: the next device of a
+        running sweep, else the start of the next sweep (not before the pause
+        after the last read). """
+        if self.sweep is not None:
+            return self.next_read
+        return max(self.next_meas,self.next_read)
+
+    def read_next(self):
+        """ Reads the next device of the current sweep, starting a sweep if
+        none is running. Returns the values of the sweep once it is
+        complete, else None. """
+        if self.sweep is None:
+            self.sweep = []
+            self.sweep_start = time.time()
+        self.sweep.append(self.devices[len(self.sweep)].get())
+        self.next_read = time.time() + self.device_pause
+        if len(self.sweep) < len(self.devices):
+            return None
+        values = self.sweep
+        self.sweep = None
+        return values
+
+    def average(self):
+        """ Returns the average of the measurements in the current window. """
+        return [(sum([data[i] for data in self.data]) / len(self.data)) \
+                for i in range(0,len(self.data[0]))]
+
+    def filename(self,mask,now,*args):
+        """ Builds a file name from 'mask' and the date 'now' (further
+        arguments fill the mask from {3} on). Files of named groups carry the
+        group name in front of the extension. """
+        name = mask.format(now.day,now.month,now.year,*args)
+        if self.name:
+            base,ext = os.path.splitext(name)
+            name = base + "_" + self.name + ext
+        return name
+
+    def get_schema(self):
+        """ Returns the channel schema of the group, see
+        Binlog.channel_schema. """
+        return Binlog.channel_schema(self.devices,\
+                                     names=self.channel_names,\
+                                     units=self.channel_units)
+
+# stages of the measurement loop timed with 'stage_stats'
+STAGES = ('acquire','average','format','print','append','rotate',\
+          'slow_write','decimate','edges')
 
 class DataLogger():
     """ A simple data-to-file logging class. """
@@ -25,6 +154,33 @@ class DataLogger():
         'filemask_temp':"Datalog_Temp.txt",\
         'filemask_fast':"Datalog_Fast.txt",\
         'filemask_slow':"Datalog_Slow_{2:04}-{1:02}-{0:02}.txt",\
+        'binary_enable':False,\
+        'filemask_bin':"Datalog_Slow_{2:04}-{1:02}-{0:02}.bin",\
+        'channel_names':None,\
+        'channel_units':None,\
+        'queue_size':1000,\
+        'queue_policy':'block',\
+        'spool_path':None,\
+        'sync_period':10.0,\
+        'device_pause':0.010,\
+        'groups':None,\
+        'trigger_bouncetime':None,\
+        'filemask_edges':"Datalog_Edges_{2:04}-{1:02}-{0:02}.txt",\
+        'decimate_levels':None,\
+        'filemask_agg':"Datalog_Agg{3}_{2:04}-{1:02}-{0:02}.txt",\
+        'index_every':Logindex.EVERY,\
+        'stream_port':None,\
+        'stream_backlog':10000,\
+        'shm_name':None,\
+        'shm_capacity':100000,\
+        'stage_stats':False,\
+        'stage_stats_period':300.0,\
+        'stage_stats_window':1000,\
+        'filemask_stage_stats':"Datalog_Stages.json",\
+        'cadence_enable':True,\
+        'cadence_period':300.0,\
+        'overrun_limit':10,\
+        'filemask_cadence':"Datalog_Cadence.json",\
         }
     
     def __init__(self,**kwargs):
@@ -33,12 +189,7 @@ class DataLogger():
         if 'devices' in kwargs:
             devices = kwargs.pop('devices')
             for d in devices:
-                assert isinstance(d,i2c.I2c_device),\
-                       "Expecting instance of I2c_device!"
-                assert d.dev_class in (i2c.DEV_MEAS,i2c.DEV_ADC,),\
-                       "Unsupported device class for device '{}'!"\
-                       .format(d.dev_type)
-                ## @@ check for device class as well.
+                check_device(d)
                 self._devices.append(d)
         else:
             devices = []
@@ -49,114 +200,583 @@ class DataLogger():
             assert kw in self._default,\
                    "Uknown keyword '{}!'".format(kw)
             setattr(self,kw,kwargs[kw])
-        # initialize data list
-        self._data = []
+        assert self.queue_policy in ('block','drop_newest','drop_oldest'),\
+               "Unknown queue policy '{}'!".format(self.queue_policy)
+        # additional device groups with their own rates
+        self._groups = {}
+        for g in (self.groups if self.groups else []):
+            g = dict(g)
+            assert g.get('name'),"Device groups need a (non-empty) name!"
+            g.setdefault('device_pause',self.device_pause)
+            self._groups[g['name']] = DeviceGroup(**g)
+        # bounded queue between acquisition and writer
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._writer = None
+        self._running = False
+        # write to a local spool and copy to 'path' in the background
+        self._syncer = None
+        self._trigger = None
+        self._edge_counts = [0,0]
+        if self.spool_path is not None:
+            # the temporary and fast logs (of every group) are replaced
+            temporary = [os.path.splitext(mask)[0] + "*" \
+                         + os.path.splitext(mask)[1] \
+                         for mask in (self.filemask_temp,self.filemask_fast)]
+            self._syncer = Spool.Syncer(src=self.spool_path,dst=self.path,\
+                                        sync_period=self.sync_period,\
+                                        temporary=temporary)
+        # shared-memory rings of the samples for local consumers (by group)
+        self._rings = {}
+        # live stream of the samples and trigger edges
+        self._stream = None
+        if self.stream_port is not None:
+            self._stream = Livestream.StreamServer(self.stream_port,\
+                                                   backlog=self.stream_backlog)
+        # timing profile of the loop stages (None: off)
+        self._stages = None
+        if self.stage_stats:
+            self._stages = Loopstats.StageTimer(STAGES,\
+                                                self.stage_stats_window,\
+                                                self.stage_stats_period)
+        self._cadence_written = time.monotonic()
+        self._stats = {'written':0,'dropped':0,'write_errors':0,\
+                       'queue_max_depth':0,'write_latency_last':0.0,\
+                       'write_latency_max':0.0,'write_latency_sum':0.0}
 
     def add_device(self,device):
         """ Append a new device to the end of the devices list. Note, that
         using the same device multiple times prompts a new measurement every
         time. Use cycling to access different 'channels' in one device. """
-        assert isinstance(device,i2c.I2c_device),\
-               "Expecting instance of I2c_device!"
-        assert d.dev_class in (i2c.DEV_MEAS,i2c.DEV_ADC,),\
-               "Unsupported device class for device '{}'!"\
-               .format(d.dev_type)
+        check_device(device)
         # append
         self._devices.append(device)
 
+    def main_group(self):
+        """ Returns the (unnamed) group of the devices passed to the
+        DataLogger itself, using 'meas_period' and 'avg_period'. """
+        g = self._groups.get("")
+        if g is None:
+            g = DeviceGroup("",self._devices,self.meas_period,\
+                            self.avg_period,self.device_pause,\
+                            self.channel_names,self.channel_units)
+            self._groups[""] = g
+        # follow changes of the DataLogger's settings
+        g.meas_period = self.meas_period
+        g.avg_period = self.avg_period
+        g.device_pause = self.device_pause
+        return g
+
     def get_measurements(self):
         """ Returns the list of measurement values obatained by each device's
         get() method. """
-        results_list = [ ]
-        #Add a short pause between reading devices.
-        for device in self._devices:
-            results_list.append(device.get())
-            time.sleep(0.010)
-        return results_list
-        #return [device.get() for device in self._devices]
+        return self.main_group().get_measurements()
+
+    def get_schema(self,group=""):
+        """ Returns the channel schema (names, units, device mapping) of
+        the logged data, see Binlog.channel_schema. """
+        if group == "":
+            return self.main_group().get_schema()
+        return self._groups[group].get_schema()
+
+    def write_binary(self,group,filename,now,data,flags,schema=None):
+        """ Appends a record to the binary log 'filename' of a group. A new
+        log gets 'schema' (taken by the acquisition thread), else the
+        group's current one. """
+        if group.binlog is None or group.binlog.filename != filename:
+            if schema is None:
+                schema = group.get_schema()
+            group.binlog = Binlog.BinaryLog(filename,schema['channels'],\
+                                            units=schema['units'],\
+                                            devices=schema['devices'])
+        group.binlog.append(Binlog.datetime2ns(now),data,flags)
+
+    def index_line(self,group,filename,now,offset,length):
+        """ Extends the sparse time index of a group's slow log by a line
+        written at byte 'offset', see Logindex.py. """
+        if group.index is None or group.index.logfile != filename:
+            group.index = Logindex.LineIndex(filename,self.index_every)
+        group.index.add(Binlog.datetime2ns(now),offset,length)
 
     def start_measurement_loop(self):
-        " Starts the measurement loop for this DataLogger. "
+        """ Starts the measurement loop for this DataLogger. Acquisition runs
+        in the calling thread and hands averaged samples to a writer thread
+        through a bounded queue, so slow file access does not delay the next
+        measurement. """
         print('STARTING MEASUREMENT LOOP')
-        # @@ cheap and dirty!!
-        last_save = time.time();
-        now = datetime.datetime.now()
+        self._running = True
+        self._writer = threading.Thread(target=self.writer_loop,\
+                                        name="DataLogger writer")
+        self._writer.daemon = True
+        if self.trigger_enable and self.trigger_pin != None:
+            self._trigger = Trigger.TriggerMonitor(self.trigger_pin,\
+                                    bouncetime=self.trigger_bouncetime)
+            if self._stream is not None:
+                self._trigger.add_listener(self.publish_edge)
+            self._trigger.start()
+        if self._stream is not None:
+            self._stream.start()
+        self._writer.start()
+        if self._syncer is not None:
+            self._syncer.start()
+        try:
+            self.acquisition_loop()
+        finally:
+            self.stop()
 
+    def stop(self,timeout=10.0):
+        """ Stops acquisition and lets the writer drain the queue. """
+        self._running = False
+        if self._trigger is not None:
+            self._trigger.stop()
+        if self._writer is not None and self._writer.is_alive():
+            try:
+                self._queue.put(None,timeout=timeout)
+                self._writer.join(timeout)
+            except queue.Full:
+                print("Writer does not drain the queue; stopping without it")
+        # last statistics, before the spool is synced for the last time
+        if self._stages is not None:
+            self.write_stage_stats()
+        if self.cadence_enable:
+            self.write_cadence()
+        if self._syncer is not None:
+            self._syncer.stop(timeout)
+        if self._stream is not None:
+            self._stream.stop()
+        for ring in self._rings.values():
+            ring.close()
+        self._rings = {}
+
+    def trigger_snapshot(self):
+        """ Marks the beginning of a window for the trigger edge counting. """
+        if self._trigger is None:
+            return None
+        return self._trigger.snapshot()
+
+    def acquisition_loop(self):
+        """ Takes measurements, averages them and pushes the results to the
+        writer queue. All device groups share the bus one device read at a
+        time: the group that needs the bus first (the next device of its
+        sweep, or the start of its next sweep) is served first, so the
+        device pauses of a slow group leave the bus to the others. A single
+        device read is never interrupted. Each group closes its averaging
+        windows at its own rate. """
+        groups = [g for g in self._groups.values() if g.name != ""]
+        if len(self._devices) > 0:
+            groups.insert(0,self.main_group())
+        assert len(groups) > 0,"No devices to measure!"
+        start = time.time()
+        for g in groups:
+            g.data = []
+            g.next_meas = start
+            g.window_end = start + g.avg_period
+            g.sweep = None
+            g.next_read = start
+            g.trigger_start = self.trigger_snapshot()
+            if self.cadence_enable:
+                g.cadence = {'sweep':Loopstats.CadenceMonitor(g.meas_period,\
+                                                self.overrun_limit),\
+                             'sample':Loopstats.CadenceMonitor(g.avg_period,\
+                                                self.overrun_limit)}
+        while self._running:
+            # serve the group that needs the bus first
+            g = min(groups,key=lambda g: g.due())
+            wait_until(g.due())
+            if g.sweep is None:
+                now = time.time()
+                # close the averaging window if it has passed
+                if now >= g.window_end and len(g.data) > 0:
+                    if g.cadence is not None:
+                        g.cadence['sample'].add(g.window_end,now)
+                    self.close_window(g)
+                    g.window_end += g.avg_period
+                    if g.window_end <= now:
+                        # fell behind; start a fresh window
+                        g.window_end = now + g.avg_period
+            # read the next device of the group's sweep
+            st = self._stages
+            if st is not None:
+                t = time.perf_counter()
+            values = g.read_next()
+            if st is not None:
+                g.busy += time.perf_counter() - t
+            if values is None:
+                continue
+            # the sweep is complete: schedule the next one
+            g.data.append(values)
+            if st is not None:
+                st.add('acquire',g.busy)
+                g.busy = 0.0
+            if g.cadence is not None:
+                self.check_cadence(g,g.sweep_start)
+            g.next_meas += g.meas_period
+            if g.next_meas < g.sweep_start:
+                g.next_meas = g.sweep_start
+
+    def check_cadence(self,group,start):
+        """ Records the intended and actual start and the duration of a
+        group's sweep and reports sustained overruns. """
+        sweeps = group.cadence['sweep']
+        change = sweeps.add(group.next_meas,start,time.time()-start)
+        if change == 'start':
+            print("Group '{}' overrunning: {} sweeps in a row ended after "\
+                  "their deadline ({:.3f} s)".format(group.name,\
+                  sweeps.streak,sweeps.period))
+        elif change == 'end':
+            print("Group '{}' back on time".format(group.name))
+
+    def close_window(self,group):
+        """ Averages the measurements of a group's window, hands the result
+        to the writer and opens the next window. """
+        st = self._stages
+        if st is not None:
+            t = time.perf_counter()
+        avg = group.average()
+        if st is not None:
+            st.lap('average',t)
+        group.data = []
+        # trigger activity within the window; the tracked level is checked
+        # against the pin, so a lost edge falsifies one window at most
+        sample = {'time':datetime.datetime.now(),'data':avg,\
+                  'triggered':"0",'note':"",'group':group.name}
+        if self._trigger is not None:
+            self._trigger.resync()
+        end = self.trigger_snapshot()
+        if end is not None:
+            tr = self._trigger.window(group.trigger_start,end)
+            sample['triggered'] = str(tr['triggered'])
+            sample['level'] = tr['level']
+            sample['edges'] = (tr['rising'],tr['falling'])
+            if tr['triggered']:
+                sample['note'] = "TR(+{}/-{})".format(tr['rising'],\
+                                                      tr['falling'])
+            else:
+                sample['note'] = "timeout"
+        group.trigger_start = end
+        if group.cadence is not None:
+            sample['overrun'] = group.cadence['sweep'].pop_flag()
+        # channel names follow the devices' cycles, which only this thread
+        # advances; between two sweeps they are consistent
+        if self.binary_enable:
+            sample['schema'] = group.get_schema()
+##        fast_data = avg[0:12]
+##        slow_data = avg[12::]
+##        #Hardcode some data filtering... bad?
+##        #Subtract bias from bipolar ADC channels.
+##        avg[0] = avg[0] - 1.72
+##        avg[1] = avg[1] - 1.72
+##        avg[2] = avg[2] - 1.72
+##        avg[3] = avg[3] - 1.72
+        #Dirty filtering of outliers
+        if max(avg) > 50: 
+            return
+        self.publish_sample(sample)
+        self.put_sample(sample)
+
+    def publish_sample(self,sample):
+        """ Hands a sample to the local consumers (shared-memory ring) and
+        the live stream, before it is written. """
+        now = sample['time']
+        if self.shm_name is not None:
+            self.ring_sample(sample)
+        if self._stream is None:
+            return
+        self._stream.publish('sample',{'t':Binlog.datetime2ns(now),\
+            'time':format_timestamp(now),'group':sample['group'],\
+            'data':[round(float(a),4) for a in sample['data']],\
+            'triggered':int(sample['triggered']),'note':sample['note']})
+
+    def ring_sample(self,sample):
+        """ Writes a sample to the shared-memory ring of its group, named
+        'shm_name' for the main group and 'shm_name'_<group> for the others;
+        a ring is (re)created with the number of values of the sample. """
+        group = sample['group']
+        data = sample['data']
+        ring = self._rings.get(group)
+        if ring is None or ring.nchannels != len(data):
+            if ring is not None:
+                ring.close()
+            name = self.shm_name if group == "" \
+                   else "{}_{}".format(self.shm_name,group)
+            ring = Sharedmem.SampleRing(name,len(data),self.shm_capacity)
+            self._rings[group] = ring
+        ring.write(Binlog.datetime2ns(sample['time']),data,\
+                   self.sample_flags(sample))
+
+    def publish_edge(self,t,level):
+        """ Sends a trigger edge to the live stream (GPIO callback). """
+        self._stream.publish('trigger',{'t':t,\
+            'time':format_timestamp(Trigger.ns2local(t)),'level':level})
+
+    def put_sample(self,sample):
+        """ Hands a sample to the writer queue, following 'queue_policy' if
+        the queue is full: 'block' waits for the writer, 'drop_newest'
+        discards the new sample and 'drop_oldest' the oldest queued one. """
+        if self.queue_policy == 'block':
+            self._queue.put(sample)
+            return
+        while True:
+            try:
+                self._queue.put_nowait(sample)
+                return
+            except queue.Full:
+                self._stats['dropped'] += 1
+                if self.queue_policy == 'drop_newest':
+                    return
+            # drop_oldest: make room and try again
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+
+    def writer_loop(self):
+        """ Drains the sample queue and writes the samples to file. Runs until
+        'stop' places the end marker in the queue. Errors are reported and
+        counted, but never end the thread: a dead writer would block the
+        acquisition with the 'block' policy. """
         while True:
-            line_note = ""
-            triggered = "0"
-            # wait for trigger if triggered operation is selected
-            if self.trigger_enable and self.trigger_pin != None:
-                #res = gpio.wait_for_edge(self.trigger_pin,\
-                #                        gpio.RISING,\
-                #                         timeout=self.trigger_timeout)
-                res = gpio.input(self.trigger_pin)
-                if res == 0:
-                    line_note = "timeout"
-                else:
-                    line_note = "TR({})".format(res)
-                    triggered = "1"
-            # initialize empty data list
-            ## @@ verify that there is no memory leak here (used .clear()
-            ## @@ before, which is not supported in 2.7.9)
-            self._data = []
-            last_avg = time.time()
-            while (time.time() - last_avg) < self.avg_period:
-                # get a measurement
-                last = time.time()
-                self._data.append(self.get_measurements())
-                # wait for next measurement
-                while (time.time() - last) < self.meas_period:
-                    pass
-            avg = [(sum([data[i] for data in self._data]) / len(self._data)) for i in range(0,len(self._data[0]))]
-##            fast_data = avg[0:12]
-##            slow_data = avg[12::]
-##            #Hardcode some data filtering... bad?
-##            #Subtract bias from bipolar ADC channels.
-##            avg[0] = avg[0] - 1.72
-##            avg[1] = avg[1] - 1.72
-##            avg[2] = avg[2] - 1.72
-##            avg[3] = avg[3] - 1.72
-            #Dirty filtering of outliers
-            if max(avg) > 50: 
+            sample = self._queue.get()
+            if sample is None:
+                try:
+                    self.flush_decimated()
+                except Exception as e:
+                    print("Failed to write decimated data: {!r}".format(e))
+                break
+            depth = self._queue.qsize()
+            if depth > self._stats['queue_max_depth']:
+                self._stats['queue_max_depth'] = depth
+            start = time.time()
+            try:
+                self.write_sample(sample)
+                self._stats['written'] += 1
+            except Exception as e:
+                # e.g. the share is gone or a sample does not fit the files
+                self._stats['write_errors'] += 1
+                print("Failed to write sample: {!r}".format(e))
+            latency = time.time() - start
+            self._stats['write_latency_last'] = latency
+            self._stats['write_latency_sum'] += latency
+            if latency > self._stats['write_latency_max']:
+                self._stats['write_latency_max'] = latency
+            try:
+                if self._stages is not None and self._stages.due():
+                    self.write_stage_stats()
+                if self.cadence_enable and time.monotonic() \
+                   - self._cadence_written >= self.cadence_period:
+                    self.write_cadence()
+            except Exception as e:
+                print("Failed to write statistics: {!r}".format(e))
+
+    def get_cadence(self):
+        """ Returns the cadence statistics (lateness and duration
+        histograms, missed deadlines, overruns) of the sweeps and samples of
+        every group, see Loopstats.CadenceMonitor. """
+        out = {}
+        for g in list(self._groups.values()):
+            if g.cadence is not None:
+                out[g.name] = {'meas_period':g.meas_period,\
+                               'avg_period':g.avg_period,\
+                               'sweep':g.cadence['sweep'].summary(),\
+                               'sample':g.cadence['sample'].summary()}
+        return out
+
+    def write_cadence(self):
+        """ Writes the cadence statistics to 'filemask_cadence' in the
+        local spool (if in use), from where it is copied to 'path'. """
+        self._cadence_written = time.monotonic()
+        out = {'time':format_timestamp(datetime.datetime.now()),\
+               'groups':self.get_cadence()}
+        try:
+            Loopstats.write_json(self.spool_dir() + self.filemask_cadence,out)
+        except (IOError,OSError) as e:
+            print("Failed to write cadence statistics: {}".format(e))
+
+    def flush_decimated(self):
+        """ Writes the open buckets of all decimators, e.g. when the logger
+        stops; a restart begins new buckets (the 'count' column tells
+        partial ones). """
+        for group in list(self._groups.values()):
+            if group.decimator is None:
                 continue
-            fast_data = avg
-            slow_data = avg
-            # build filename with current date
-            now = datetime.datetime.now()
-            outfile_temp = self.path + self.filemask_temp
-            outfile_fast = self.path + self.filemask_fast
-            outfile_slow = self.path + self.filemask_slow.\
-                      format(now.day,now.month,now.year)
-            # build timestamp
-            timestamp = "{:04} {:02} {:02} {:02}:{:02}:{:02}.{:03}".\
-                        format(now.year,now.month,now.day,now.hour,now.minute,now.second,now.microsecond)
-            # build line
-            fast_line = ",".join(["{:.4f}".format(a) for a in avg])
-            fast_line += "," + triggered
-            # print to standard output
-            print_line = " , ".join(["{:.4f}".format(a) for a in avg])
-            print(outfile_temp + " < " + print_line + "   @ " \
-                  + timestamp + "   " + line_note)
-            # append to file
-            with open(outfile_temp,'a') as f:
-                f.write(timestamp + "," +fast_line+"\n")
-            # Create another file for slow temperature/humidity logging, and copy contents of temporary fast log to another file
-            if (time.time() - last_save) > self.save_period:
-                slow_line = ",".join(["{:.4f}".format(sd) for sd in slow_data])
-                slow_line += "," + triggered
-                with open(outfile_slow,'a') as f:
-                    #Average here?
-                    f.write(timestamp + "," +slow_line+"\n")
-                #os.remove(outfile_fast)
-                with open(outfile_temp,'r') as f1:
-                    with open(outfile_fast,'w') as f2:
-                        #f2.seek(0)
-                        for line in f1:
-                            f2.write(line)
-                        #f2.truncate()
-                os.remove(outfile_temp)
-                last_save = time.time()
+            try:
+                self.write_buckets(group,self.spool_dir(),\
+                                   group.decimator.flush())
+            except (IOError,OSError) as e:
+                print("Failed to write decimated data: {}".format(e))
+
+    def write_stage_stats(self):
+        """ Writes the timing profile of the loop stages (percentiles in
+        ms) with the writer statistics to 'filemask_stage_stats' in the
+        local spool (if in use), and sends it to the live stream. """
+        outfile = self.spool_dir() + self.filemask_stage_stats
+        try:
+            out = self._stages.write(outfile,{'writer':self.get_stats()})
+        except (IOError,OSError) as e:
+            print("Failed to write stage statistics: {}".format(e))
+            return
+        if self._stream is not None:
+            self._stream.publish('stages',out)
+
+    def get_stats(self):
+        """ Returns a dictionary with the current queue depth and the writer
+        statistics (written and dropped samples, write latency in s). """
+        out = dict(self._stats)
+        out['queue_depth'] = self._queue.qsize()
+        out['write_latency_mean'] = out.pop('write_latency_sum')\
+                            /max(out['written']+out['write_errors'],1)
+        if self._syncer is not None:
+            out['sync'] = dict(self._syncer.stats)
+        if self._trigger is not None:
+            out['trigger_resyncs'] = self._trigger.resyncs
+        if self.cadence_enable:
+            out['overruns'] = {g.name:g.cadence['sweep'].overruns \
+                               for g in list(self._groups.values()) \
+                               if g.cadence is not None}
+        return out
+
+    def sample_flags(self,sample):
+        """ Returns the Binlog flag bits describing a sample's trigger. """
+        flags = 0
+        if sample['triggered'] == "1":
+            flags |= Binlog.FLAG_TRIGGERED
+        if sample.get('level'):
+            flags |= Binlog.FLAG_LEVEL
+        if sum(sample.get('edges',(0,0))) > 0:
+            flags |= Binlog.FLAG_EDGE
+        if sample.get('overrun'):
+            flags |= Binlog.FLAG_OVERRUN
+        return flags
+
+    def write_edges(self,path):
+        """ Appends all trigger edges recorded since the last call to the
+        edge log; one line per edge with timestamp, level (1: rising, 0:
+        falling) and the running counts of rising and falling edges. """
+        edges = self._trigger.drain()
+        if len(edges) == 0:
+            return
+        lines = {}
+        for t,level in edges:
+            self._edge_counts[1-level] += 1
+            dt = Trigger.ns2local(t)
+            outfile = path + self.filemask_edges.format(dt.day,dt.month,dt.year)
+            lines.setdefault(outfile,[]).append("{},{},{},{}\n".format(\
+                format_timestamp(dt),level,*self._edge_counts))
+        for outfile in lines:
+            with open(outfile,'a') as f:
+                f.writelines(lines[outfile])
+
+    def spool_dir(self):
+        """ Directory the files are written to: the local spool, if in use,
+        else 'path'. """
+        return self.path if self.spool_path is None else self.spool_path
+
+    def write_sample(self,sample):
+        """ Formats a sample, prints it and appends it to the log files. """
+        st = self._stages
+        if st is not None:
+            t = time.perf_counter()
+        group = self._groups[sample['group']]
+        now = sample['time']
+        avg = sample['data']
+        triggered = sample['triggered']
+        line_note = sample['note']
+        fast_data = avg
+        # aggregate the samples between two lines of the slow file
+        if group.slow is None:
+            group.slow = Decimate.Bucket(None,len(avg))
+            group.slow_flags = 0
+        group.slow.add(avg)
+        group.slow_flags |= self.sample_flags(sample)
+        # build filename with current date (local spool, if in use)
+        path = self.spool_dir()
+        outfile_temp = path + group.filename(self.filemask_temp,now)
+        outfile_fast = path + group.filename(self.filemask_fast,now)
+        outfile_slow = path + group.filename(self.filemask_slow,now)
+        # build timestamp
+        timestamp = format_timestamp(now)
+        # build line
+        fast_line = ",".join(["{:.4f}".format(a) for a in avg])
+        fast_line += "," + triggered
+        print_line = " , ".join(["{:.4f}".format(a) for a in avg])
+        if st is not None:
+            t = st.lap('format',t)
+        # print to standard output
+        print(outfile_temp + " < " + print_line + "   @ " \
+              + timestamp + "   " + line_note)
+        if st is not None:
+            t = st.lap('print',t)
+        # append to file
+        with open(outfile_temp,'a') as f:
+            f.write(timestamp + "," +fast_line+"\n")
+        if st is not None:
+            t = st.lap('append',t)
+        # Create another file for slow temperature/humidity logging, and copy contents of temporary fast log to another file
+        if (time.time() - group.last_save) > self.save_period:
+            # mean of all samples since the last save; triggered if any was
+            slow_data = group.slow.result()['mean']
+            slow_flags = group.slow_flags
+            group.slow = None
+            slow_line = ",".join(["{:.4f}".format(sd) for sd in slow_data])
+            slow_line += ",1" if slow_flags & Binlog.FLAG_TRIGGERED else ",0"
+            slow_line = timestamp + "," + slow_line + "\n"
+            with open(outfile_slow,'a') as f:
+                if self.index_every:
+                    self.index_line(group,outfile_slow,now,f.tell(),\
+                                    len(slow_line))
+                f.write(slow_line)
+            if self.binary_enable:
+                outfile_bin = path + group.filename(self.filemask_bin,now)
+                self.write_binary(group,outfile_bin,now,slow_data,\
+                                  slow_flags,sample.get('schema'))
+            if st is not None:
+                t = st.lap('slow_write',t)
+            #os.remove(outfile_fast)
+            with open(outfile_temp,'r') as f1:
+                with open(outfile_fast,'w') as f2:
+                    #f2.seek(0)
+                    for line in f1:
+                        f2.write(line)
+                    #f2.truncate()
+            os.remove(outfile_temp)
+            group.last_save = time.time()
+            if st is not None:
+                t = st.lap('rotate',t)
+        # envelopes at coarser resolutions
+        if self.decimate_levels:
+            self.write_decimated(group,path,now,avg)
+            if st is not None:
+                t = st.lap('decimate',t)
+        # timestamped trigger edges
+        if self._trigger is not None:
+            self.write_edges(path)
+            if st is not None:
+                st.lap('edges',t)
+
+    def write_decimated(self,group,path,now,data):
+        """ Feeds a sample to the group's decimator and appends completed
+        buckets (timestamp, mean/min/max/std per channel, count) to one file
+        per level. """
+        if group.decimator is None:
+            group.decimator = Decimate.Decimator(self.decimate_levels,\
+                                                 len(data))
+        done = group.decimator.add(Binlog.datetime2ns(now)/1e9,data)
+        self.write_buckets(group,path,done)
+
+    def write_buckets(self,group,path,done):
+        """ Appends completed buckets of a group's decimator to the files
+        of their levels. """
+        for period,start,res in done:
+            start = Binlog.ns2datetime(int(round(start*1e9)))
+            outfile = path + group.filename(self.filemask_agg,start,\
+                                            Decimate.level_label(period))
+            cols = []
+            for i in range(0,len(res['mean'])):
+                cols += [res['mean'][i],res['min'][i],res['max'][i],\
+                         res['std'][i]]
+            line = ",".join(["{:.4f}".format(c) for c in cols])
+            with open(outfile,'a') as f:
+                f.write(format_timestamp(start) + "," + line \
+                        + ",{}\n".format(res['count']))
 
             
 if __name__ == "__main__":       
@@ -190,14 +810,26 @@ if __name__ == "__main__":
                      filemask_fast="Datalog_Fast.txt",\
                      filemask_slow="Datalog_Slow_{2:04}-{1:02}-{0:02}.txt",\
                      path="/home/pi/YDrive/share/Pi_Monitoring/Logs/",\
+                     spool_path="/home/pi/Pi_Monitoring/Spool/",\
                      devices=[#adc1,adc1,adc1,adc1,adc2,adc2,adc2,adc2,adc3,adc3,adc3,adc3,
                               hih[0],hih[0],hih[1],hih[1],hih[2],hih[2],hih[3],hih[3],hih[4],hih[4],hih[5],hih[5]],\
+                     # fast ADC channels can run at their own rate, e.g.
+                     #groups=[{'name':'ADC','devices':[adc1,adc1,adc1,adc1],\
+                     #         'meas_period':0.0,'avg_period':0.1,\
+                     #         'device_pause':0.0}],\
                      meas_period=0.1,\
                      avg_period=0.1,\
+                     decimate_levels=[10,60,3600],\
                      save_period=30.0,\
                      trigger_pin=16,\
                      trigger_enable=True,\
-                     trigger_timeout=0.1*1000)
+                     trigger_timeout=0.1*1000,\
+                     # timing profile of the loop stages (every 5 min)
+                     #stage_stats=True,\
+                     # samples and trigger edges as Server-Sent Events
+                     stream_port=8081,\
+                     # samples for the Plotter on this Pi
+                     shm_name="pykraken")
     
     #Start the measurement loop
     try:
@@ -128,33 +128,33 @@ def triggered_trace(trigger_pin,devices,timeout=-1,tmax=None,nmax=10,\
     # start by waiting for the trigger
     gpio.wait_for_edge(trigger_pin,gpio.RISING,timeout=timeout)
     print('Go!')
-    start=time.clock()
+    start=time.perf_counter()
     # based on choices: slightly different loops
     if dt == None:
         if tmax == None:
             # continuous loop until nmax reached
             while len(data) < nmax:
-                data.append([time.clock()-start]\
+                data.append([time.perf_counter()-start]\
                             +[d.get() for d in devices])
         else:
             # continuous loop until nmax or tmax reached
-            while (len(data) < nmax) and (time.clock()-start < tmax):
-                data.append([time.clock()-start]\
+            while (len(data) < nmax) and (time.perf_counter()-start < tmax):
+                data.append([time.perf_counter()-start]\
                             +[d.get() for d in devices])
     else:
         if tmax == None:
             # continuous loop until nmax reached, waiting for dt
             while len(data) < nmax:
-                data.append([time.clock()-start]\
+                data.append([time.perf_counter()-start]\
                             +[d.get() for d in devices])
-                while (time.clock()-start < dt*len(data)):
+                while (time.perf_counter()-start < dt*len(data)):
                     pass
         else:
             # continuous loop until nmax or tmax reached, waiting for dt
-            while (len(data) < nmax) and (time.clock()-start < tmax):
-                data.append([time.clock()-start]\
+            while (len(data) < nmax) and (time.perf_counter()-start < tmax):
+                data.append([time.perf_counter()-start]\
                             +[d.get() for d in devices])
-                while (time.clock()-start < dt*len(data)):
+                while (time.perf_counter()-start < dt*len(data)):
                     pass
     # hand back the measurement result
     return data
@@ -2,7 +2,7 @@
 import tkinter as tk # developing with 8.6
 import numpy as np
 from functools import partial # to link callback functions with arguments
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pipe
 import time
 import i2c_v3 as i2c
 from gerty import Gerty as gerty
@@ -36,9 +36,19 @@ class fake_device():
         self.ct += 1
         return (0.001*self.ct)%2
 
-def meas_process(device,readQ,writeQ,*args):
-    " The measurement process. "
-    config = {'max_lag':1,'meas_rate':8,'max_data':64}
+# default configuration of meas_process
+MEAS_CONFIG = {'max_lag':1,'meas_rate':8,'max_data':64}
+
+def meas_process(device,readQ,writeQ,conn,*args):
+    " The measurement process. Fills a preallocated chunk of max_data rows \
+    (time, value) and sends it as raw float64 bytes through the pipe 'conn' \
+    when it is full, or the filled part when 'send' is requested, followed \
+    by an empty message. Text messages go through writeQ. \
+    The receiver needs a buffer of 16*max_data bytes. Sending blocks while \
+    the pipe buffer is full (typically 64 kB, about 4 chunks of \
+    max_data=1000), so the data has to be pulled at least every \
+    ~4*max_data/meas_rate s, else the sampling stalls until it is. "
+    config = dict(MEAS_CONFIG)
     if len(args) > 0 and type(args[0]) == dict:
         kwargs = args[0]
     else:
@@ -46,16 +56,17 @@ def meas_process(device,readQ,writeQ,*args):
     for kw in kwargs: config[kw] = kwargs[kw]
     print(config)
     Done = False
-    Send = False
     start = time.time()
     last = 0
-    data = []; 
+    chunk = np.empty((config['max_data'],2),dtype=np.float64)
+    n = 0
     # Measurement loop.
     while not Done:
         # Read new data from device and pair with current time.
         now = time.time() - start
-        data.append(now)
-        data.append(device.get())
+        chunk[n,0] = now
+        chunk[n,1] = device.get()
+        n += 1
         # Check lag in data acquisition (THIS IS NOT A REALTIME MEASUREMENT)
         if (now-last-1/config['meas_rate']) > config['max_lag']:
             writeQ.put("Lag exceeds allowance!")
@@ -69,19 +80,48 @@ def meas_process(device,readQ,writeQ,*args):
                 # Exits the loop.
                 Done = True
             elif cmd[:4] == "send":
-                writeQ.put("Sending data.")
-                writeQ.put(data)
-                data = []
-        # If holding more than max_data, push to writeQueue
-        if len(data) > 2*config['max_data']:
-            writeQ.put("Max data reached!")
-            writeQ.put(data)
-            data = []
+                if n > 0:
+                    conn.send_bytes(chunk[:n])
+                    n = 0
+                # empty message: end of the requested data
+                conn.send_bytes(b"")
+        # If the chunk is full, push it through the pipe (blocks while the
+        # parent leaves the pipe buffer full, see above)
+        if n == config['max_data']:
+            conn.send_bytes(chunk)
+            n = 0
         # Wait some time
         while (time.time()-start-last) < (1/config['meas_rate']):
             pass
                            
     writeQ.put("Measurement process ended.")
+    conn.close()
+
+
+def receive_chunks(conn,readQ,buf):
+    " Receives the chunks of meas_process up to the end marker into the \
+    preallocated bytearray 'buf' and returns them as an (n x 2) array of \
+    time and value. Prints the messages of the process. "
+    chunks = []
+    while True:
+        nbytes = conn.recv_bytes_into(buf)
+        if nbytes == 0:
+            break
+        chunks.append(np.frombuffer(buf,dtype=np.float64,\
+                                    count=nbytes//8).reshape(-1,2).copy())
+    while not readQ.empty():
+        print(readQ.get())
+    if len(chunks) == 0:
+        return np.empty((0,2),dtype=np.float64)
+    return np.concatenate(chunks)
+
+def stop_process(process,conn):
+    " Waits for a measurement process to end, discarding its data. "
+    while process.is_alive():
+        if conn.poll(0.1):
+            conn.recv_bytes()
+        process.join(0.01)
+    process.join()
 
 
 class continuousMeasurement():
@@ -90,8 +130,16 @@ class continuousMeasurement():
 
     def __init__(self,*args,**kwargs):
         self.config(**kwargs)
+        # configuration of the measurement process
+        self.meas_config = dict(MEAS_CONFIG)
+        for kw in kwargs:
+            if kw in self.meas_config:
+                self.meas_config[kw] = kwargs[kw]
         self.readQ = Queue()
         self.writeQ = Queue()
+        # data pipe and receive buffer of one chunk
+        self.conn,self.child_conn = Pipe(duplex=False)
+        self.buf = bytearray(16*self.meas_config['max_data'])
         self.started = False
 
     def start(self):
@@ -101,7 +149,8 @@ class continuousMeasurement():
             return
         self.started = True
         self.process = Process(target=meas_process, \
-                               args=(fake_device(),self.writeQ,self.readQ))
+                               args=(fake_device(),self.writeQ,self.readQ,\
+                                     self.child_conn,self.meas_config))
         self.process.start()
 
     def stop(self):
@@ -110,29 +159,17 @@ class continuousMeasurement():
         # empty the queue discarting all contents
         while not self.readQ.empty():
             self.readQ.get()
-        self.process.join()
+        stop_process(self.process,self.conn)
         self.started = False
 
     def pull_data(self):
+        " Returns the new (time, value) rows as an (n x 2) array. "
         if self.started:
             self.writeQ.put("send")
-            data = []
-            received = False
-            while not received:
-                read = self.readQ.get()
-                if read == "Sending data.":
-                    data = data + self.readQ.get()
-                    received = True
-                elif read == "Max data reached!":
-                    print(read)
-                    data = data + self.readQ.get()
-                    received = False
-                else:
-                    print(read)
-            return data
+            return receive_chunks(self.conn,self.readQ,self.buf)
         else:
             print("Process not started!")
-            return []
+            return np.empty((0,2))
 
     def config(self,**kwargs):
         " self.conig() returns a dictionary with the current configuration \
@@ -140,8 +177,7 @@ class continuousMeasurement():
         if len(kwargs) == 0:
             return self.get_config('all')
         else:
-            for kw in kwargs:
-                self.set_config(kw,kwarks[kw])
+            self.set_config(**kwargs)
 
     def get_config(self,*args):
         " For a single keyword, returns the configuration value. Returns a \
@@ -322,10 +358,10 @@ class dataCanvas(tk.Canvas):
                 elif len(self.data[0]) == 0: self.range[i] = [0,1]
                 elif len(self.data[0][0]) == 0: self.range[i] = [0,1]
                 else:
-                    self.range[i] = [min(self.data[0][i]),max(self.data[0][i])]
+                    self.range[i] = [np.min(self.data[0][i]),np.max(self.data[0][i])]
                     for idx in range(1,len(self.data)):
-                        self.range[i][0] = min([self.range[i][0],min(self.data[idx][i])])
-                        self.range[i][1] = max([self.range[i][1],max(self.data[idx][i])])
+                        self.range[i][0] = min([self.range[i][0],np.min(self.data[idx][i])])
+                        self.range[i][1] = max([self.range[i][1],np.max(self.data[idx][i])])
             else:
                 self.range[i] = draw_range[i]
             if self.range[i][0] == self.range[i][1]:
@@ -440,6 +476,8 @@ class dataCanvas(tk.Canvas):
 
     def canvas_coords(self,x,y):
         " Converts data coordinates into pixel coordinates. "
+        if isinstance(x,np.ndarray):
+            return self.canvas_coords_array(x,y)
         islist = True
         if type(x) is not list:
             x = [x]; y = [y]
@@ -459,9 +497,19 @@ class dataCanvas(tk.Canvas):
         if islist: return X,Y
         else: return X[0],Y[0]
 
+    def canvas_coords_array(self,x,y):
+        " Converts data coordinates (arrays) into pixel coordinates. "
+        W = int(self.cget('width'))
+        H = int(self.cget('height'))
+        X = (W-2)*(x - self.range[0][0])/(self.range[0][1] - self.range[0][0])+2
+        Y = H-1-(H-3)*(y - self.range[1][0])/(self.range[1][1] - self.range[1][0])
+        return X,Y
+
     def build_xy(self,x,y):
         " Merges x and y lists to a single list of xy pairs:\
         x0,y0,x1,y1, ... "
+        if isinstance(x,np.ndarray):
+            return np.column_stack((x,y)).ravel().tolist()
         if type(x) is not list:
             x = [x]; y = [y]
         assert len(x) == len(y)
@@ -484,6 +532,9 @@ class logObject():
         for kw in kwargs: self.__setattr__(kw,kwargs[kw])
         self.readQ = Queue()
         self.writeQ = Queue()
+        # data pipe (raw float64 chunks) and receive buffer of one chunk
+        self.conn,self.child_conn = Pipe(duplex=False)
+        self.buf = bytearray(16*self.max_data)
         self.started = False
         
 
@@ -576,6 +627,7 @@ class dataLogCanvas(dataCanvas):
                                    args=(self.log[i].device,\
                                          self.log[i].writeQ,\
                                          self.log[i].readQ,\
+                                         self.log[i].child_conn,\
                                          {'meas_rate':self.log[i].meas_rate,\
                                           'max_data':self.log[i].max_data,\
                                           'max_lag':self.log[i].max_lag}))
@@ -589,14 +641,11 @@ class dataLogCanvas(dataCanvas):
         for i in range(0,len(self.log)):
             idx = self.log[i].data_idx
             new_data = self.pull_data(idx=i)
-            assert len(new_data)%2 == 0
-            x = [new_data[2*i] for i in range(0,len(new_data)//2)]
-            y = [new_data[2*i+1] for i in range(0,len(new_data)//2)]
-            self.data[idx][0] = self.data[idx][0] + x
-            self.data[idx][1] = self.data[idx][1] + y
-            if len(self.data[idx][0]) > 4096:
-                self.data[idx][0] = self.data[idx][0][-4096:]
-                self.data[idx][1] = self.data[idx][1][-4096:]
+            # keep the last 4096 points as arrays
+            self.data[idx][0] = np.concatenate((self.data[idx][0],\
+                                                new_data[:,0]))[-4096:]
+            self.data[idx][1] = np.concatenate((self.data[idx][1],\
+                                                new_data[:,1]))[-4096:]
         self.change_range([None,None])
         self.draw_data()
         if self.started:
@@ -610,30 +659,19 @@ class dataLogCanvas(dataCanvas):
             # empty the queues discarting all contents
             while not self.log[i].readQ.empty():
                 self.log[i].readQ.get()
-            self.log[i].process.join()
+            stop_process(self.log[i].process,self.log[i].conn)
             self.log[i].started = False
         self.started = False
 
     def pull_data(self,idx=0):
+        " Returns the new (time, value) rows of a log as an (n x 2) array. "
         if self.started == True:
             self.log[idx].writeQ.put("send")
-            data = []
-            received = False
-            while not received:
-                read = self.log[idx].readQ.get()
-                if read == "Sending data.":
-                    data = data + self.log[idx].readQ.get()
-                    received = True
-                elif read == "Max data reached!":
-                    print(read)
-                    data = data + self.log[idx].readQ.get()
-                    received = False
-                else:
-                    print(read)
-            return data
+            return receive_chunks(self.log[idx].conn,self.log[idx].readQ,\
+                                  self.log[idx].buf)
         else:
             #print("Process not started!")
-            return []
+            return np.empty((0,2))
 
     
 